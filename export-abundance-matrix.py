@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Export a dense gene or CAG x sample matrix from an experiment collection."""
+
+import argparse
+import logging
+import sys
+from lib.experiment_collection import ExperimentCollection
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Export a dense gene or CAG x sample matrix from an experiment collection."""
+    )
+
+    parser.add_argument("--collection-hdf5",
+                        type=str,
+                        required=True,
+                        help="""Location of the experiment collection HDF5.""")
+    parser.add_argument("--output-prefix",
+                        type=str,
+                        required=True,
+                        help="""Prefix for the output files (PREFIX.npy, PREFIX.rows.txt, PREFIX.columns.txt).""")
+    parser.add_argument("--level",
+                        type=str,
+                        default="gene",
+                        choices=["gene", "cag"],
+                        help="""Export the abundance of genes or CAGs.""")
+    parser.add_argument("--metric",
+                        type=str,
+                        default="clr",
+                        help="""Abundance metric to export.""")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)-8s [export-matrix] %(message)s'
+    )
+
+    exp = ExperimentCollection(args.collection_hdf5)
+    logging.info("Writing {} x sample matrix of {} to {}.npy".format(
+        args.level, args.metric, args.output_prefix
+    ))
+    exp.export_abundance_matrix(
+        args.output_prefix,
+        level=args.level,
+        metric=args.metric
+    )
+    logging.info("Done")
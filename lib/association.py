@@ -0,0 +1,116 @@
+"""Vectorized association testing of abundances against a single covariate."""
+
+import numpy as np
+import pandas as pd
+
+from lib.experiment_collection import read_abundance_block
+
+
+def associate_block(
+    exp_col_fp,
+    table_prefix,
+    id_col,
+    value_col,
+    samples,
+    block_ids,
+    x,
+    method="ols",
+    combined=False
+):
+    """Read one block of rows for every sample, and test each of them for association with `x`."""
+
+    block = read_abundance_block(
+        exp_col_fp, table_prefix, id_col, value_col, samples, block_ids,
+        fill_value=np.nan,
+        combined=combined
+    )
+
+    # Missing values are below the limit of detection, so use the lowest observed value
+    row_min = np.nanmin(np.where(np.isnan(block), np.inf, block), axis=1)
+    row_min[np.isinf(row_min)] = 0
+    block = np.where(np.isnan(block), row_min[:, None], block)
+
+    if method == "ols":
+        df = ols_slopes(block, x)
+    else:
+        df = spearman_correlations(block, x)
+
+    df.index = pd.Index(block_ids)
+    return df
+
+
+def ols_slopes(y, x):
+    """
+
+    Fit `y[i] ~ intercept + slope * x` for every row of `y` at once.
+
+    Returns a DataFrame with the slope, its standard error, t statistic and
+    two-sided p-value for each row.
+
+    """
+    from scipy.stats import t as t_dist
+
+    n = len(x)
+    x_centered = x - x.mean()
+    sxx = (x_centered ** 2).sum()
+
+    y_centered = y - y.mean(axis=1, keepdims=True)
+    slope = y_centered @ x_centered / sxx
+
+    residuals = y_centered - slope[:, None] * x_centered[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std_err = np.sqrt((residuals ** 2).sum(axis=1) / (n - 2) / sxx)
+        t_stat = slope / std_err
+
+    return pd.DataFrame({
+        "estimate": slope,
+        "std_error": std_err,
+        "t_statistic": t_stat,
+        "p_value": np.nan_to_num(2 * t_dist.sf(np.abs(t_stat), n - 2), nan=1.),
+    })
+
+
+def spearman_correlations(y, x):
+    """
+
+    Calculate the Spearman correlation of every row of `y` with `x` at once.
+
+    The p-value uses the t approximation with n - 2 degrees of freedom.
+
+    """
+    from scipy.stats import rankdata
+    from scipy.stats import t as t_dist
+
+    n = len(x)
+    x_ranks = rankdata(x)
+    x_ranks = x_ranks - x_ranks.mean()
+    y_ranks = rankdata(y, axis=1)
+    y_ranks = y_ranks - y_ranks.mean(axis=1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = y_ranks @ x_ranks / np.sqrt((y_ranks ** 2).sum(axis=1) * (x_ranks ** 2).sum())
+        t_stat = rho * np.sqrt((n - 2) / (1 - rho ** 2))
+
+    return pd.DataFrame({
+        "estimate": rho,
+        "t_statistic": t_stat,
+        "p_value": np.nan_to_num(2 * t_dist.sf(np.abs(t_stat), n - 2), nan=1.),
+    })
+
+
+def benjamini_hochberg(p_values):
+    """Return the Benjamini-Hochberg FDR (q-value) for each p-value."""
+    p_values = np.asarray(p_values, dtype=float)
+    n = len(p_values)
+    if n == 0:
+        return p_values
+
+    order = np.argsort(p_values)
+    scaled = p_values[order] * n / np.arange(1, n + 1)
+
+    # Make the q-values monotonic, starting from the largest p-value
+    q_values = np.minimum.accumulate(scaled[::-1])[::-1]
+
+    fdr = np.empty(n)
+    fdr[order] = np.clip(q_values, 0, 1)
+    return fdr
@@ -0,0 +1,110 @@
+"""Query many experiment collections in parallel, and merge the results."""
+
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pandas as pd
+
+from lib.experiment_collection import ExperimentCollection
+
+
+def _query_collection(exp_col_fp, method_name, args, kwargs, collection_kwargs, count_values=False):
+    """Run a single query against one collection (in a worker process)."""
+    exp = ExperimentCollection(exp_col_fp, **collection_kwargs)
+    result = getattr(exp, method_name)(*args, **kwargs)
+
+    # Summarize annotations as the number of genes with each value, so
+    # that only the (much smaller) summary is passed back to the parent
+    if count_values:
+        if isinstance(result, pd.DataFrame):
+            result = result.iloc[:, 0]
+        result = result.value_counts()
+
+    return result
+
+
+class CollectionSet:
+    """Set of experiment collections which are queried together."""
+
+    def __init__(self, exp_col_fps, workers=4, **collection_kwargs):
+        """
+
+        Pass in a list of filepaths, or a dict of names and filepaths.
+
+        Queries are run against each collection in a pool of `workers` processes.
+        Any other keyword arguments are passed to ExperimentCollection.
+
+        """
+
+        if isinstance(exp_col_fps, dict):
+            self.exp_col_fps = exp_col_fps
+        else:
+            self.exp_col_fps = {
+                os.path.basename(fp).rsplit(".", 1)[0]: fp
+                for fp in exp_col_fps
+            }
+            assert len(self.exp_col_fps) == len(exp_col_fps), "Collection names must be unique"
+
+        for fp in self.exp_col_fps.values():
+            assert os.path.exists(fp), "File not found: " + fp
+
+        self.workers = workers
+        self.collection_kwargs = collection_kwargs
+
+    def iter_query(self, method_name, *args, count_values=False, **kwargs):
+        """Yield (collection name, result) for each collection, as soon as it is finished."""
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(
+                    _query_collection,
+                    exp_col_fp,
+                    method_name,
+                    args,
+                    kwargs,
+                    self.collection_kwargs,
+                    count_values
+                ): collection_name
+                for collection_name, exp_col_fp in self.exp_col_fps.items()
+            }
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def query(self, method_name, *args, **kwargs):
+        """Return a dict with the result of a query for each collection."""
+        results = dict(self.iter_query(method_name, *args, **kwargs))
+
+        # Keep the results in the order that the collections were provided
+        return {
+            collection_name: results[collection_name]
+            for collection_name in self.exp_col_fps
+        }
+
+    def _merge_columns(self, results):
+        """Align a dict of results on their index, with the collection as the first column level."""
+        return pd.concat(results, axis=1, sort=False)
+
+    def gene_abundance(self, **kwargs):
+        """Return the abundance of genes in every collection, with columns keyed by (collection, sample)."""
+        return self._merge_columns(self.query("gene_abundance", **kwargs))
+
+    def cag_abundance(self, **kwargs):
+        """Return the abundance of CAGs in every collection, with columns keyed by (collection, sample)."""
+        return self._merge_columns(self.query("cag_abundance", **kwargs))
+
+    def eggnog_annotation(self, annot_type="ko"):
+        """Return the number of genes with each KO (or eggNOG cluster) in every collection."""
+        return self._merge_columns(
+            self.query("eggnog_annotation", annot_type=annot_type, count_values=True)
+        ).fillna(0).astype(int)
+
+    def taxonomic_annotation(self):
+        """Return the number of genes assigned to each taxid in every collection."""
+        return self._merge_columns(
+            self.query("taxonomic_annotation", count_values=True)
+        ).fillna(0).astype(int)
+
+    def metadata(self):
+        """Return the metadata for every collection, with rows keyed by (collection, row)."""
+        return pd.concat(self.query("metadata"), sort=False)
@@ -1,15 +1,301 @@
 """Class to help read data from the experiment collection."""
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import os
 import pandas as pd
+import re
+import tables
+
+from lib.result_cache import cached_method
+from lib.result_cache import method_cache_key
+from lib.result_cache import parse_bytes
+from lib.result_cache import persisted_method
+from lib.result_cache import ResultCache
+from lib.result_cache import SidecarCache
+from lib.result_cache import split_link_target
+
+
+def open_abundance_matrix(prefix, mode="r"):
+    """
+    
+    Open a matrix written by `ExperimentCollection.export_abundance_matrix`.
+
+    Returns a tuple of (matrix, row labels, column labels). The matrix is a
+    read-only memory map by default, so that any number of processes opening
+    the same file share a single copy in the page cache.
+
+    """
+
+    for suffix in [".npy", ".rows.txt", ".columns.txt"]:
+        assert os.path.exists(prefix + suffix), "File not found: " + prefix + suffix
+
+    matrix = np.load(prefix + ".npy", mmap_mode=mode)
+
+    with open(prefix + ".rows.txt", "rt") as handle:
+        rows = [line.rstrip("\n") for line in handle]
+    with open(prefix + ".columns.txt", "rt") as handle:
+        columns = [line.rstrip("\n") for line in handle]
+
+    assert matrix.shape == (len(rows), len(columns)), "Labels do not match the matrix"
+
+    return matrix, rows, columns
+
+
+def natural_name(name):
+    """Make a name usable as a PyTables node, which must be a Python identifier without a reserved prefix."""
+    name = re.sub(r"[^0-9a-zA-Z_]", "_", str(name))
+    if name == "" or name[0].isdigit() or name.startswith(("_v_", "_f_", "_g_", "_c_", "_i_")):
+        name = "n" + name
+    return name
+
+
+def read_indexed_column(
+    exp_col_fp,
+    table_name,
+    index_col,
+    value_col,
+    index_values=None,
+    max_pushdown_values=1000,
+    where=None
+):
+    """
+    
+    Read a single column from a table, indexed by `index_col`.
+
+    When `index_values` is a short list, the selection is pushed down into
+    the PyTables query on the `index_col` data column, so that only the
+    matching rows are read. Long lists fall back to reading the whole
+    column, which is faster than issuing many small queries.
+
+    Rows may also be filtered with a `where` query (e.g. on the `sample`
+    column of a table holding many samples).
+
+    """
+
+    with pd.HDFStore(exp_col_fp, mode="r") as store:
+        storer = store.get_storer(table_name)
+        assert storer is not None, "{} not found in {}".format(table_name, exp_col_fp)
+        assert where is None or storer.is_table, "Cannot query {}, which is not a table".format(table_name)
+
+        pushdown = index_values is not None and \
+            len(index_values) <= max_pushdown_values and \
+            storer.is_table and \
+            index_col in storer.data_columns
+
+        if pushdown:
+            # PyTables evaluates at most ~30 values in a single `in` clause
+            chunks = [
+                store.select(
+                    table_name,
+                    where=[
+                        clause for clause in [
+                            where,
+                            "{} in {}".format(index_col, list(index_values[ix:ix + 30]))
+                        ]
+                        if clause is not None
+                    ],
+                    columns=[index_col, value_col]
+                )
+                for ix in range(0, len(index_values), 30)
+            ]
+            if len(chunks) > 0:
+                abund = pd.concat(chunks)
+            else:
+                abund = store.select(table_name, columns=[index_col, value_col], start=0, stop=0)
+
+        elif storer.is_table:
+            abund = store.select(table_name, where=where, columns=[index_col, value_col])
+        else:
+            abund = store.select(table_name)
+
+    for k in [index_col, value_col]:
+        assert k in abund.columns.values, "Column {} not found in {}".format(
+            k, table_name)
+
+    abund = abund.set_index(index_col)[value_col]
+
+    # Return the values in the order that they were requested
+    if index_values is not None:
+        abund = abund.reindex(list(index_values))
+
+    return abund
+
+
+def distance_block_stats(
+    exp_col_fp,
+    table_prefix,
+    id_col,
+    value_col,
+    samples,
+    block_ids,
+    metric,
+    pseudocount=1.,
+    combined=False
+):
+    """
+    
+    Read one block of rows (genes or CAGs) for every sample, and summarize it for `metric`.
+
+    The block (see `read_abundance_block`) is returned as a set of sums
+    which can be added across blocks (see `distance_block_kernel`).
+
+    """
+
+    block = read_abundance_block(
+        exp_col_fp, table_prefix, id_col, value_col, samples, block_ids,
+        combined=combined
+    )
+
+    return distance_block_kernel(block, metric, pseudocount=pseudocount)
+
+
+def read_abundance_block(
+    exp_col_fp,
+    table_prefix,
+    id_col,
+    value_col,
+    samples,
+    block_ids,
+    fill_value=0,
+    combined=False
+):
+    """
+    
+    Read a dense block (len(block_ids) x len(samples)) of abundances.
+
+    `block_ids` must be sorted, so that the block is read with a range query
+    on the indexed ID column. If `combined`, every sample is in a single
+    table (with a `sample` column) which is read with one query, otherwise
+    there is a table for each sample under `table_prefix`. Rows which are
+    missing from a sample are set to `fill_value`.
+
+    """
+
+    block_ids = pd.Index(block_ids)
+    block = np.full((len(block_ids), len(samples)), fill_value, dtype=float)
+
+    id_range = "({id_col} >= '{first}') & ({id_col} <= '{last}')".format(
+        id_col=id_col,
+        first=block_ids[0],
+        last=block_ids[-1]
+    )
+
+    with pd.HDFStore(exp_col_fp, mode="r") as store:
+        if combined:
+            block_df = store.select(
+                table_prefix.rstrip("/"),
+                where=id_range,
+                columns=["sample", id_col, value_col]
+            )
+            rows = block_ids.get_indexer(block_df[id_col].values)
+            cols = pd.Index(samples).get_indexer(block_df["sample"].values)
+            keep = (rows >= 0) & (cols >= 0)
+            block[rows[keep], cols[keep]] = block_df[value_col].values[keep]
+
+            return block
+
+        for sample_ix, sample_id in enumerate(samples):
+            sample_df = store.select(
+                table_prefix + sample_id,
+                where=id_range,
+                columns=[id_col, value_col]
+            )
+            positions = block_ids.get_indexer(sample_df[id_col].values)
+            keep = positions >= 0
+            block[positions[keep], sample_ix] = sample_df[value_col].values[keep]
+
+    return block
+
+
+def distance_block_kernel(block, metric, pseudocount=1.):
+    """
+    
+    Summarize a dense block (rows x samples) of abundances for a distance metric.
+
+    For "braycurtis" this is the sum of the pairwise minimum of each row, and
+    the total of each sample. Only the rows detected in each sample add to its
+    minimums, so the work follows the nonzero entries of the block. For
+    "aitchison" this is the Gram matrix, sums and sums of squares of the log
+    abundances (after adding `pseudocount`).
+
+    """
+
+    assert metric in ["braycurtis", "aitchison"]
+
+    if metric == "braycurtis":
+        shared = np.zeros((block.shape[1], block.shape[1]))
+        for sample_ix in range(block.shape[1]):
+            detected = block[:, sample_ix] > 0
+            if not detected.any():
+                continue
+            nonzero = block[detected]
+            shared[sample_ix] = np.minimum(nonzero[:, sample_ix:sample_ix + 1], nonzero).sum(axis=0)
+
+        return {
+            "shared": shared,
+            "totals": block.sum(axis=0),
+        }
+
+    log_block = np.log(block + pseudocount)
+    return {
+        "gram": log_block.T @ log_block,
+        "sums": log_block.sum(axis=0),
+        "squares": (log_block ** 2).sum(axis=0),
+        "n_rows": log_block.shape[0],
+    }
+
+
+def distances_from_block_stats(stats, metric):
+    """Combine the summed block statistics into a square matrix of distances."""
+
+    if metric == "braycurtis":
+        totals = stats["totals"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dist = 1 - 2 * stats["shared"] / (totals[:, None] + totals[None, :])
+        return np.nan_to_num(dist)
+
+    # The CLR centers each sample on its mean log abundance, which is
+    # removed from the squared Euclidean distance in the last term
+    squares = stats["squares"]
+    sums = stats["sums"]
+    dist2 = squares[:, None] + squares[None, :] - 2 * stats["gram"] - \
+        (sums[:, None] - sums[None, :]) ** 2 / stats["n_rows"]
+
+    return np.sqrt(np.clip(dist2, 0, None))
 
-from functools import lru_cache
 
 class ExperimentCollection:
 
-    def __init__(self, exp_col_fp, gene_id_key="id", abund_id_key="depth"):
-        """Pass in the filepath for the experiment collection."""
+    def __init__(
+        self,
+        exp_col_fp,
+        gene_id_key="id",
+        abund_id_key="depth",
+        cache_bytes="2GB",
+        max_pushdown_values=1000,
+        read_workers=1,
+        sidecar_cache=None
+    ):
+        """
+        Pass in the filepath for the experiment collection.
+
+        Tables read from the collection are kept in a cache which belongs to
+        this object, and which holds at most `cache_bytes` (e.g. "2GB", or None
+        for no limit). The least recently used tables are evicted first.
+
+        Requests for up to `max_pushdown_values` genes or CAGs are resolved
+        with indexed queries which only read the matching rows.
+
+        `gene_abundance` and `cag_abundance` read samples with `read_workers`
+        processes by default.
+
+        If `sidecar_cache` is True (or the path to a folder), derived results
+        such as `cag_abundance` and `cag_membership` are also saved next to the
+        collection, and reloaded in later sessions until the collection changes.
+
+        """
 
         # Save the filepath
         self.exp_col_fp = exp_col_fp
@@ -22,15 +308,61 @@ class ExperimentCollection:
         # Set the default abundance key
         self.abund_id_key = abund_id_key
 
+        # Largest list of genes or CAGs which is looked up with an indexed query
+        self.max_pushdown_values = max_pushdown_values
+
+        # Number of processes used to read samples in parallel
+        self.read_workers = read_workers
+
+        # Cache for the tables read from the collection
+        self.cache = ResultCache(max_bytes=cache_bytes)
+
+        # Cache for derived results which persists between sessions
+        if sidecar_cache is None or sidecar_cache is False:
+            self.sidecar = None
+        elif sidecar_cache is True:
+            self.sidecar = SidecarCache(self.exp_col_fp)
+        else:
+            self.sidecar = SidecarCache(self.exp_col_fp, folder=sidecar_cache)
+
+        # Tables which are stored in another file (e.g. the integrated assembly)
+        # and linked from the collection with an HDF5 external link
+        self.external_links = {}
+        with tables.open_file(self.exp_col_fp, mode="r") as h5:
+            for node in h5.root._f_iter_nodes():
+                if isinstance(node, tables.link.ExternalLink):
+                    self.external_links[node._v_pathname] = node.target
+
         # Get the list of all samples that have abundance information
         with pd.HDFStore(self.exp_col_fp, mode="r") as store:
-            self.all_samples = [
-                sample_id.replace("/abundance/", "")
-                for sample_id in store
-                if sample_id.startswith("/abundance/")
-            ]
+            # The builder writes every sample to a single table, with a `sample`
+            # column, while older collections have a table for each sample
+            node = store.get_node("abundance")
+            self.combined_abundance = node is not None and "pandas_type" in node._v_attrs
+
+            if self.combined_abundance and "abundance_samples" in store:
+                # Listed by the builder, so that the abundance table is not scanned
+                self.all_samples = store.select("abundance_samples")["sample"].tolist()
+            elif self.combined_abundance:
+                self.all_samples = pd.unique(
+                    store.select_column("abundance", "sample")
+                ).tolist()
+            else:
+                self.all_samples = [
+                    sample_id.replace("/abundance/", "")
+                    for sample_id in store
+                    if sample_id.startswith("/abundance/")
+                ]
 
-    def gene_abundance(self, genes=None, samples=None, metric=None):
+    def gene_abundance(
+        self,
+        genes=None,
+        samples=None,
+        metric=None,
+        min_prevalence=None,
+        min_mean=None,
+        workers=None
+    ):
         """
         
         Return a DataFrame with the abundance for a set of samples.
@@ -38,8 +370,25 @@ class ExperimentCollection:
         If `metric` is None, return the abundance key that was used in the input. 
         Another option would be "clr".
 
+        Genes may be filtered with `min_prevalence` and `min_mean` (of `metric`),
+        using the `gene_summary` table computed when the collection was built.
+
+        Samples are read in parallel with `workers` processes (default `read_workers`).
+
         """
 
+        if min_prevalence is not None or min_mean is not None:
+            passing_genes = self.filter_genes(
+                min_prevalence=min_prevalence,
+                min_mean=min_mean,
+                metric=metric
+            )
+            if genes is None:
+                genes = passing_genes
+            else:
+                passing_genes = set(passing_genes)
+                genes = [gene_id for gene_id in genes if gene_id in passing_genes]
+
         # Default to returning all samples
         if samples is None:
             samples = self.all_samples
@@ -52,26 +401,19 @@ class ExperimentCollection:
         if metric is None:
             metric = self.abund_id_key
 
-        # Store the data in a dict, keyed by sample
-        df = {}
-
-        # Iterate over the samples
-        for sample_id in samples:
-            # Read the abundance
-            df[sample_id] = self.sample_gene_abundance(
-                sample_id,
-                metric=metric
-            )
-            
-            # Subset to the genes of interest
-            if genes is not None:
-                df[sample_id] = df[sample_id].reindex(genes)
-
-        # Format as a DataFrame
-        return pd.DataFrame(df)
+        return self._abundance_frame(
+            "sample_gene_abundance",
+            "/abundance/",
+            self.gene_id_key,
+            samples,
+            metric,
+            "genes",
+            None if genes is None else tuple(genes),
+            workers
+        )
 
-    @lru_cache(maxsize=512)
-    def sample_gene_abundance(self, sample_id, metric=None):
+    @cached_method
+    def sample_gene_abundance(self, sample_id, metric=None, genes=None):
         """
         
         Return a DataFrame with the abundance for a single sample.
@@ -79,23 +421,25 @@ class ExperimentCollection:
         If `metric` is None, return the abundance key that was used in the input. 
         Another option would be "clr".
 
+        If `genes` is provided, only those rows are read from the collection.
+
         """
 
         # Set the metric to return
         if metric is None:
             metric = self.abund_id_key
 
-        # Read the abundance
-        abund = pd.read_hdf(self.exp_col_fp, "/abundance/" + sample_id)
-
-        for k in [self.gene_id_key, metric]:
-            assert k in abund.columns.values, "Column {} not found for {}".format(
-                k, sample_id)
-
-        return abund.set_index(self.gene_id_key)[metric]
+        table_name, where = self._sample_table("/abundance/", sample_id)
+        return self._read_indexed_column(
+            table_name,
+            self.gene_id_key,
+            metric,
+            index_values=genes,
+            where=where
+        )
 
-    @lru_cache(maxsize=512)
-    def sample_cag_abundance(self, sample_id, metric=None):
+    @cached_method
+    def sample_cag_abundance(self, sample_id, metric=None, cags=None):
         """
         
         Return a DataFrame with the abundance of CAGs for a single sample.
@@ -103,27 +447,481 @@ class ExperimentCollection:
         If `metric` is None, return the abundance key that was used in the input. 
         Another option would be "clr".
 
+        If `cags` is provided, only those rows are read from the collection.
+
         """
 
         # Set the metric to return
         if metric is None:
             metric = self.abund_id_key
 
-        # Read the abundance
-        abund = pd.read_hdf(self.exp_col_fp, "/cag_abundance/" + sample_id)
+        table_name, where = self._sample_table("/cag_abundance/", sample_id)
+        return self._read_indexed_column(
+            table_name,
+            "cag_id",
+            metric,
+            index_values=cags,
+            where=where
+        )
+
+    def _read_indexed_column(self, table_name, index_col, value_col, index_values=None, where=None):
+        """Read a single column from a table in this collection, indexed by `index_col`."""
+        return read_indexed_column(
+            self.exp_col_fp,
+            table_name,
+            index_col,
+            value_col,
+            index_values=index_values,
+            max_pushdown_values=self.max_pushdown_values,
+            where=where
+        )
+
+    def _sample_table(self, table_prefix, sample_id):
+        """
+
+        Return the (table name, where clause) holding a single sample, for "/abundance/" or "/cag_abundance/".
+
+        The where clause is None for collections with a table for each sample.
+
+        """
+        if self.combined_abundance:
+            return table_prefix.rstrip("/"), "sample == '{}'".format(sample_id)
+
+        return table_prefix + sample_id, None
+
+    def top_k(self, k, metric=None, samples=None, level="cag"):
+        """
+        
+        Return the `k` most abundant CAGs (or genes) in each sample.
+
+        The result is a DataFrame with the sample, the ID, its `rank` within
+        the sample, and `metric`. Only the top `k` rows of each sample are
+        read, using the rank stored when the collection was built. Because
+        the rank orders the input abundance, it also orders "clr" and
+        "rel_abund". Any other metric is ranked after reading its column.
+
+        """
+
+        table_prefix, id_col = self._abundance_table(level)
+
+        if samples is None:
+            samples = self.all_samples
+
+        # Set the metric to return
+        if metric is None:
+            metric = self.abund_id_key
+
+        rank_ordered = metric in [self.abund_id_key, "clr", "rel_abund"]
+
+        top_dfs = []
+        for sample_id in samples:
+            table_name, where = self._sample_table(table_prefix, sample_id)
+            if rank_ordered:
+                sample_df = self._read_table(
+                    table_name,
+                    where=[
+                        clause for clause in [where, "rank <= {}".format(int(k))]
+                        if clause is not None
+                    ],
+                    columns=[id_col, "rank", metric]
+                )
+            else:
+                sample_df = self._read_table(
+                    table_name,
+                    where=where,
+                    columns=[id_col, metric]
+                ).nlargest(k, metric)
+                sample_df["rank"] = range(1, sample_df.shape[0] + 1)
+
+            sample_df = sample_df.sort_values(by="rank").reindex(columns=[id_col, "rank", metric])
+            sample_df.insert(0, "sample", sample_id)
+            top_dfs.append(sample_df)
+
+        if len(top_dfs) == 0:
+            return pd.DataFrame(columns=["sample", id_col, "rank", metric])
+
+        return pd.concat(top_dfs, ignore_index=True)
+
+    def threshold(self, value, metric=None, min_samples=1, samples=None, level="gene"):
+        """
+        
+        Return the genes (or CAGs) with `metric` above `value` in at least `min_samples` samples.
+
+        Each sample is scanned with a query on the indexed `metric` column, so
+        only the passing rows are read. Returns a Series with the number of
+        samples passing the threshold, for each ID.
+
+        """
+
+        table_prefix, id_col = self._abundance_table(level)
+
+        if samples is None:
+            samples = self.all_samples
+
+        # Set the metric to filter on
+        if metric is None:
+            metric = self.abund_id_key
+
+        counts = pd.Series(dtype=int)
+        for sample_id in samples:
+            table_name, where = self._sample_table(table_prefix, sample_id)
+            passing = self._read_table(
+                table_name,
+                where=[
+                    clause for clause in [where, "{} > {}".format(metric, float(value))]
+                    if clause is not None
+                ],
+                columns=[id_col]
+            )[id_col]
+            counts = counts.add(pd.Series(1, index=passing.unique()), fill_value=0)
+
+        counts = counts.astype(int)
+        counts.name = "n_samples"
+        return counts.loc[counts >= min_samples].sort_values(ascending=False)
+
+    @cached_method
+    def sample_sketches(self):
+        """Return a dict with the sorted array of MinHash values sketching the genes in each sample."""
+        sketch_df = self._read_table("sample_sketches")
+
+        return {
+            sample_id: np.sort(sample_df["hash"].values)
+            for sample_id, sample_df in sketch_df.groupby("sample")
+        }
+
+    def sketch_similarity(self, samples=None):
+        """
+        
+        Estimate the shared gene content of every pair of samples from their sketches.
+
+        Returns a dict of DataFrames (samples x samples) with the "jaccard"
+        index, and the "containment" of the genes of each row sample in each
+        column sample. All pairs are compared at once through a sparse
+        sample x hash matrix.
+
+        """
+        from scipy import sparse
+
+        sketches = self.sample_sketches()
+
+        # Default to every sample which was sketched
+        if samples is None:
+            samples = list(sketches.keys())
+        else:
+            for sample_id in samples:
+                assert sample_id in sketches, "No sketch found for {}".format(sample_id)
+
+        # Give each distinct hash a column in the matrix
+        hashes = [sketches[sample_id] for sample_id in samples]
+        all_hashes, columns = np.unique(
+            np.concatenate(hashes + [np.array([], dtype=np.uint64)]),
+            return_inverse=True
+        )
+        rows = np.repeat(np.arange(len(samples)), [len(h) for h in hashes])
+
+        presence = sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.int32), (rows, columns)),
+            shape=(len(samples), len(all_hashes))
+        )
+
+        # Number of hashes shared by each pair of samples
+        shared = (presence @ presence.T).toarray().astype(float)
+        sizes = np.diag(shared).copy()
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            jaccard = shared / (sizes[:, None] + sizes[None, :] - shared)
+            containment = shared / sizes[:, None]
+
+        return {
+            "jaccard": pd.DataFrame(np.nan_to_num(jaccard), index=samples, columns=samples),
+            "containment": pd.DataFrame(np.nan_to_num(containment), index=samples, columns=samples),
+        }
+
+    def nearest_samples(self, sample_id, n=10, metric="jaccard"):
+        """Return the `n` samples with the most similar gene content to `sample_id`, from their sketches."""
+        assert metric in ["jaccard", "containment"]
+
+        similarity = self.sketch_similarity()[metric]
+        assert sample_id in similarity.index, "No sketch found for {}".format(sample_id)
+
+        return similarity.loc[sample_id].drop(sample_id).sort_values(ascending=False).head(n)
+
+    def distance_matrix(
+        self,
+        metric="braycurtis",
+        level="gene",
+        samples=None,
+        block_size=None,
+        block_bytes="256MB",
+        pseudocount=1.,
+        workers=None
+    ):
+        """
+        
+        Return the condensed matrix of distances between samples.
+
+        `metric` is "braycurtis" or "aitchison" (Euclidean distance of the CLR,
+        after adding `pseudocount`), and `level` is "gene", "cag" or "ko".
+        Genes and CAGs are read in blocks of rows, using range queries on the
+        ID column, so the dense table is never built. Each block holds
+        `block_size` rows, or by default as many as fit in `block_bytes` for
+        the number of samples. Blocks are summarized in `workers` processes
+        (default `read_workers`) and added together. The order of the result
+        follows `samples` (as in scipy.spatial.distance.squareform).
+
+        """
+        from scipy.spatial.distance import squareform
+
+        assert level in ["gene", "cag", "ko"]
+
+        if samples is None:
+            samples = self.all_samples
+
+        if workers is None:
+            workers = self.read_workers
+
+        # Limit the size of each dense block of 8-byte floats
+        if block_size is None:
+            block_size = max(1, parse_bytes(block_bytes) // (8 * max(1, len(samples))))
+
+        if level == "ko":
+            stats = self._ko_distance_stats(samples, metric, block_size, pseudocount)
+        else:
+            table_prefix, id_col = self._abundance_table(level)
+
+            # Every ID, sorted so that each block is a contiguous range
+            all_ids = self._all_ids(level)
+
+            blocks = [
+                all_ids[ix:ix + block_size]
+                for ix in range(0, len(all_ids), block_size)
+            ]
+            block_args = [
+                (
+                    self.exp_col_fp, table_prefix, id_col, self.abund_id_key, samples, block_ids,
+                    metric, pseudocount, self.combined_abundance
+                )
+                for block_ids in blocks
+            ]
+
+            if workers > 1 and len(blocks) > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    block_stats = executor.map(distance_block_stats, *zip(*block_args))
+                    stats = self._sum_block_stats(block_stats)
+            else:
+                stats = self._sum_block_stats(
+                    distance_block_stats(*args) for args in block_args
+                )
+
+        dist = distances_from_block_stats(stats, metric)
+        np.fill_diagonal(dist, 0)
+
+        return squareform(dist, checks=False)
+
+    def _sum_block_stats(self, block_stats):
+        """Add up the statistics from every block."""
+        stats = None
+        for block in block_stats:
+            if stats is None:
+                stats = block
+            else:
+                stats = {k: stats[k] + v for k, v in block.items()}
+
+        assert stats is not None, "No rows found"
+        return stats
+
+    def _ko_distance_stats(self, samples, metric, block_size, pseudocount):
+        """Sum the abundance of the genes with each KO, one sample at a time, and summarize for `metric`."""
+
+        gene_ko = self.eggnog_annotation("ko")
+        kos = pd.Index(np.sort(gene_ko.unique()))
+        gene_ko_codes = pd.Series(kos.get_indexer(gene_ko.values), index=gene_ko.index)
+
+        # The KO x sample table is far smaller than the gene x sample table
+        ko_abund = np.zeros((len(kos), len(samples)))
+        for sample_ix, sample_id in enumerate(samples):
+            table_name, where = self._sample_table("/abundance/", sample_id)
+            sample_abund = self._read_indexed_column(
+                table_name, self.gene_id_key, self.abund_id_key, where=where
+            )
+            # Genes with more than one KO count towards each of them
+            codes = gene_ko_codes.loc[gene_ko_codes.index.isin(sample_abund.index)]
+            np.add.at(
+                ko_abund[:, sample_ix],
+                codes.values,
+                sample_abund.reindex(codes.index).values
+            )
+
+        return self._sum_block_stats(
+            distance_block_kernel(ko_abund[ix:ix + block_size], metric, pseudocount=pseudocount)
+            for ix in range(0, len(kos), block_size)
+        )
+
+    def associate(
+        self,
+        metadata_col,
+        sample_col="sample",
+        method="ols",
+        level="cag",
+        metric="clr",
+        samples=None,
+        block_size=10000,
+        workers=None,
+        results_fp=None
+    ):
+        """
+        
+        Test every CAG (or gene) for association with a column of the metadata.
+
+        `method` is "ols" (least squares slope of `metric` on the metadata
+        value) or "spearman" (rank correlation). Every row in a block is fitted
+        at once in matrix form, and blocks are tested in `workers` processes.
+        Missing values are set to the lowest value observed for that row.
+
+        Returns a DataFrame with the estimate, p-value and Benjamini-Hochberg
+        FDR for each row. If `results_fp` is provided, the results are also
+        written to that HDF5 file as "associations/<level>_<metadata_col>_<method>"
+        (with any characters which are not allowed in a node name replaced by
+        "_"). The collection itself is never modified, so that its cached
+        results remain valid.
+
+        """
+        from lib.association import associate_block
+        from lib.association import benjamini_hochberg
+
+        assert method in ["ols", "spearman"]
+
+        if workers is None:
+            workers = self.read_workers
+
+        # Get the metadata value for each sample
+        metadata = self.metadata()
+        for k in [sample_col, metadata_col]:
+            assert k in metadata.columns.values, "Column {} not found in the metadata".format(k)
+        metadata = metadata.set_index(sample_col)[metadata_col]
+        metadata = pd.to_numeric(metadata, errors="coerce").dropna()
+
+        # The builder replaces "." and "-" in sample names with "_"
+        metadata.index = [
+            sample_id if sample_id in self.all_samples
+            else str(sample_id).replace(".", "_").replace("-", "_")
+            for sample_id in metadata.index
+        ]
+
+        if samples is None:
+            samples = self.all_samples
+        samples = [sample_id for sample_id in samples if sample_id in metadata.index]
+        assert len(samples) > 2, "Too few samples have a value for {}".format(metadata_col)
+
+        x = metadata.reindex(samples).values.astype(float)
+
+        table_prefix, id_col = self._abundance_table(level)
+        all_ids = self._all_ids(level)
+
+        block_args = [
+            (
+                self.exp_col_fp, table_prefix, id_col, metric, samples, all_ids[ix:ix + block_size],
+                x, method, self.combined_abundance
+            )
+            for ix in range(0, len(all_ids), block_size)
+        ]
+
+        if workers > 1 and len(block_args) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(associate_block, *zip(*block_args)))
+        else:
+            results = [associate_block(*args) for args in block_args]
+
+        results = pd.concat(results)
+        results["fdr"] = benjamini_hochberg(results["p_value"].values)
+        results.index.name = id_col
+
+        if results_fp is not None:
+            assert os.path.abspath(results_fp) != os.path.abspath(self.exp_col_fp), \
+                "Write the results to a file other than the collection"
+            results.reset_index().to_hdf(
+                results_fp,
+                "associations/" + natural_name("{}_{}_{}".format(level, metadata_col, method)),
+                format="table",
+                data_columns=[id_col, "p_value", "fdr"]
+            )
 
-        for k in ["cag_id", metric]:
-            assert k in abund.columns.values, "Column {} not found for {}".format(
-                k, sample_id)
+        return results
 
-        return abund.set_index("cag_id")[metric]
+    def _all_ids(self, level):
+        """Return the sorted array of every gene (or CAG) ID, preferably from the summary table."""
+        table_prefix, id_col = self._abundance_table(level)
+        summary_table = "gene_summary" if level == "gene" else "cag_summary"
 
-    @lru_cache(maxsize=1)
+        with pd.HDFStore(self.exp_col_fp, mode="r") as store:
+            if summary_table in store:
+                ids = store.select_column(summary_table, id_col)
+            elif self.combined_abundance:
+                ids = store.select_column(table_prefix.rstrip("/"), id_col)
+            else:
+                ids = pd.concat([
+                    store.select(table_prefix + sample_id, columns=[id_col])[id_col]
+                    for sample_id in self.all_samples
+                ])
+
+        return np.sort(pd.unique(ids.values.astype(str)))
+
+    def _abundance_table(self, level):
+        """Return the prefix of the per-sample tables, and the ID column, for "gene" or "cag"."""
+        assert level in ["gene", "cag"]
+
+        if level == "gene":
+            return "/abundance/", self.gene_id_key
+        else:
+            return "/cag_abundance/", "cag_id"
+
+    @cached_method
+    def gene_summary(self):
+        """Return the prevalence and summary statistics for every gene across all samples."""
+        return self._read_table("gene_summary").set_index(self.gene_id_key)
+
+    @cached_method
+    def cag_summary(self):
+        """Return the prevalence and summary statistics for every CAG across all samples."""
+        return self._read_table("cag_summary").set_index("cag_id")
+
+    def filter_genes(self, min_prevalence=None, min_mean=None, metric=None):
+        """Return the list of genes passing a minimum prevalence and/or mean `metric`."""
+        return self._filter_summary(
+            "gene_summary", self.gene_id_key, min_prevalence, min_mean, metric
+        )
+
+    def filter_cags(self, min_prevalence=None, min_mean=None, metric=None):
+        """Return the list of CAGs passing a minimum prevalence and/or mean `metric`."""
+        return self._filter_summary(
+            "cag_summary", "cag_id", min_prevalence, min_mean, metric
+        )
+
+    def _filter_summary(self, table_name, id_col, min_prevalence, min_mean, metric):
+        """Query a summary table for the IDs passing a set of thresholds."""
+
+        # Set the metric to filter on
+        if metric is None:
+            metric = self.abund_id_key
+
+        where = []
+        if min_prevalence is not None:
+            where.append("prevalence >= {}".format(float(min_prevalence)))
+        if min_mean is not None:
+            where.append("{}_mean >= {}".format(metric, float(min_mean)))
+
+        return self._read_table(
+            table_name,
+            where=" & ".join(where) if len(where) > 0 else None,
+            columns=[id_col]
+        )[id_col].tolist()
+
+    @cached_method
     def metadata(self):
         """Return the metadata table."""
-        return pd.read_hdf(self.exp_col_fp, "metadata")
+        return self._read_table("metadata")
 
-    @lru_cache(maxsize=2)
+    @cached_method
     def eggnog_annotation(self, annot_type="ko"):
         """Return the entire set of eggNOG annotations, 'ko' or 'cluster'."""
 
@@ -137,21 +935,62 @@ class ExperimentCollection:
             table_name = "eggnog_cluster"
             col_name = "eggnog_cluster"
 
-        return pd.read_hdf(
-            self.exp_col_fp, 
+        return self._read_table(
             table_name
         ).set_index("gene")[col_name]
 
-    @lru_cache(maxsize=1)
+    @cached_method
+    @persisted_method
     def taxonomic_annotation(self):
         """Return the entire set of taxonomic annotations."""
 
-        return pd.read_hdf(
-            self.exp_col_fp,
+        return self._read_table(
             "taxonomic_classification"
         ).set_index("gene")
 
-    def cag_abundance(self, cags=None, samples=None, metric=None):
+    @persisted_method
+    def genes_below_taxon(self, taxid):
+        """
+        
+        Return the taxonomic annotations of every gene assigned to `taxid` or anything below it.
+
+        This uses the preorder numbering of the taxonomy stored when the
+        collection was built, so that the subtree is a single range query.
+
+        """
+
+        assert self._has_table("taxonomy_intervals"), \
+            "{} has no taxonomy intervals, build it with --ncbi-names-dmp and --ncbi-nodes-dmp".format(
+                self.exp_col_fp
+            )
+
+        interval = self._read_table(
+            "taxonomy_intervals",
+            where="taxid == {}".format(int(taxid))
+        )
+
+        # Taxids which are not an ancestor of any assignment have no genes
+        if interval.shape[0] == 0:
+            return self._read_table("taxonomic_classification", start=0, stop=0).set_index("gene")
+
+        return self._read_table(
+            "taxonomic_classification",
+            where="(tax_order >= {}) & (tax_order < {})".format(
+                int(interval["start"].values[0]),
+                int(interval["stop"].values[0])
+            )
+        ).set_index("gene")
+
+    @persisted_method
+    def cag_abundance(
+        self,
+        cags=None,
+        samples=None,
+        metric=None,
+        min_prevalence=None,
+        min_mean=None,
+        workers=None
+    ):
         """
         
         Return a DataFrame with the abundance of CAGs for a set of samples.
@@ -159,8 +998,25 @@ class ExperimentCollection:
         If `metric` is None, return the abundance key that was used in the input. 
         Another option would be "clr".
 
+        CAGs may be filtered with `min_prevalence` and `min_mean` (of `metric`),
+        using the `cag_summary` table computed when the collection was built.
+
+        Samples are read in parallel with `workers` processes (default `read_workers`).
+
         """
 
+        if min_prevalence is not None or min_mean is not None:
+            passing_cags = self.filter_cags(
+                min_prevalence=min_prevalence,
+                min_mean=min_mean,
+                metric=metric
+            )
+            if cags is None:
+                cags = passing_cags
+            else:
+                passing_cags = set(passing_cags)
+                cags = [cag_id for cag_id in cags if cag_id in passing_cags]
+
         if samples is None:
             samples = self.all_samples
 
@@ -168,44 +1024,484 @@ class ExperimentCollection:
         if metric is None:
             metric = self.abund_id_key
 
-        # Store the data in a dict, keyed by sample
-        df = {}
+        return self._abundance_frame(
+            "sample_cag_abundance",
+            "/cag_abundance/",
+            "cag_id",
+            samples,
+            metric,
+            "cags",
+            None if cags is None else tuple(cags),
+            workers
+        )
+
+    def _normalize_cache_arguments(self, arguments):
+        """
+
+        Make equivalent calls share a cache key: fill in the metric which None
+        stands for, and drop the arguments which only change how the result is
+        computed (e.g. the number of worker processes), not the result itself.
+
+        """
+        if "metric" in arguments and arguments["metric"] is None:
+            arguments["metric"] = self.abund_id_key
+        arguments.pop("workers", None)
+        return arguments
+
+    def _sample_cache_key(self, method_name, sample_id, metric, subset_key, index_values):
+        """Key for the cached result of `sample_gene_abundance` or `sample_cag_abundance`."""
+        return method_cache_key(
+            getattr(type(self), method_name),
+            self,
+            sample_id,
+            metric=metric,
+            **{subset_key: index_values}
+        )
+
+    def _abundance_frame(
+        self,
+        method_name,
+        table_prefix,
+        index_col,
+        samples,
+        metric,
+        subset_key,
+        index_values,
+        workers
+    ):
+        """
+        
+        Read the abundance of each sample and combine them in a single DataFrame.
+
+        Samples which are not already in the cache are read in a pool of
+        `workers` processes (defaulting to `read_workers`), and every sample
+        is written directly into a preallocated array.
+
+        """
+
+        if workers is None:
+            workers = self.read_workers
 
-        # Iterate over the samples
+        # Get the samples which have already been read
+        sample_values = {}
         for sample_id in samples:
-            # Read the abundance
-            df[sample_id] = self.sample_cag_abundance(sample_id, metric=metric)
+            found, value = self.cache.get(self._sample_cache_key(
+                method_name, sample_id, metric, subset_key, index_values
+            ))
+            if found:
+                sample_values[sample_id] = value
+
+        # Read the rest of the samples
+        to_read = [sample_id for sample_id in samples if sample_id not in sample_values]
+
+        if workers > 1 and len(to_read) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                for sample_id in to_read:
+                    table_name, where = self._sample_table(table_prefix, sample_id)
+                    futures[sample_id] = executor.submit(
+                        read_indexed_column,
+                        self.exp_col_fp,
+                        table_name,
+                        index_col,
+                        metric,
+                        index_values=index_values,
+                        max_pushdown_values=self.max_pushdown_values,
+                        where=where
+                    )
+                for sample_id, future in futures.items():
+                    sample_values[sample_id] = future.result()
+        else:
+            for sample_id in to_read:
+                table_name, where = self._sample_table(table_prefix, sample_id)
+                sample_values[sample_id] = self._read_indexed_column(
+                    table_name,
+                    index_col,
+                    metric,
+                    index_values=index_values,
+                    where=where
+                )
+
+        # Add the newly read samples to the cache
+        for sample_id in to_read:
+            self.cache.put(
+                self._sample_cache_key(method_name, sample_id, metric, subset_key, index_values),
+                sample_values[sample_id]
+            )
+
+        # The rows are either the requested IDs, or every ID in any sample
+        if index_values is not None:
+            index = pd.Index(list(index_values))
+        elif len(samples) > 0:
+            index = sample_values[samples[0]].index
+            for sample_id in samples[1:]:
+                index = index.union(sample_values[sample_id].index)
+        else:
+            index = pd.Index([])
 
-            if cags is not None:
-                df[sample_id] = df[sample_id].reindex(cags)
+        # Fill in the values for each sample, leaving NaN where a row is missing
+        values = np.full((len(index), len(samples)), np.nan)
+        for sample_ix, sample_id in enumerate(samples):
+            sample_abund = sample_values[sample_id]
+            if index_values is not None:
+                values[:, sample_ix] = sample_abund.values
+            else:
+                values[index.get_indexer(sample_abund.index), sample_ix] = sample_abund.values
 
-        # Format as a DataFrame
-        return pd.DataFrame(df)
+        return pd.DataFrame(values, index=index, columns=samples)
 
-    @lru_cache(maxsize=1)
+    @cached_method
+    @persisted_method
     def cag_membership(self):
         """Return a dict with the genes in each CAG."""
-        cags = pd.read_hdf(self.exp_col_fp, "cags")
+
+        # Use the CAG index, if the collection has one
+        if self._has_table("cag_index_offsets"):
+            index = self.cag_index()
+            return {
+                cag_id: index["genes"][start:stop].tolist()
+                for cag_id, start, stop in zip(index["cags"], index["starts"], index["stops"])
+            }
+
+        cags = self._read_table("cags")
 
         return {
             cag_id: cag_df["gene"].tolist()
             for cag_id, cag_df in cags.groupby("cag")
         }
 
-    @lru_cache(maxsize=128)
+    @cached_method
+    def cag_index(self):
+        """
+        
+        Return the arrays which make up the index of CAG membership.
+
+        `genes` holds every gene grouped by CAG, and `gene_cag_codes` the
+        position in `cags` of each gene's CAG. The genes in CAG `cags[i]` are
+        `genes[starts[i]:stops[i]]`. `gene_codes` is a hashed index of `genes`.
+
+        """
+
+        offsets_df = self._read_table("cag_index_offsets")
+        genes_df = self._read_table("cag_index_genes")
+
+        return {
+            "cags": offsets_df["cag"].values,
+            "cag_codes": pd.Index(offsets_df["cag"].values),
+            "starts": offsets_df["start"].values,
+            "stops": offsets_df["stop"].values,
+            "genes": genes_df["gene"].values,
+            "gene_codes": pd.Index(genes_df["gene"].values),
+            "gene_cag_codes": genes_df["cag_code"].values,
+        }
+
+    def cag_of_gene(self, gene_id):
+        """Return the CAG containing a single gene (or None)."""
+        index = self.cag_index()
+        if gene_id not in index["gene_codes"]:
+            return None
+
+        return index["cags"][index["gene_cag_codes"][index["gene_codes"].get_loc(gene_id)]]
+
+    def cags_of_genes(self, genes):
+        """Return a Series with the CAG containing each gene (NaN for genes not in any CAG)."""
+        index = self.cag_index()
+        gene_codes = index["gene_codes"].get_indexer(genes)
+
+        cags = pd.Series(
+            index["cags"][index["gene_cag_codes"][gene_codes]],
+            index=genes,
+            dtype=object
+        )
+        cags[gene_codes < 0] = np.nan
+
+        return cags
+
+    def genes_in_cag(self, cag_id):
+        """Return the list of genes in a single CAG."""
+        index = self.cag_index()
+        assert cag_id in index["cag_codes"], "CAG not found: {}".format(cag_id)
+
+        cag_code = index["cag_codes"].get_loc(cag_id)
+        return index["genes"][index["starts"][cag_code]:index["stops"][cag_code]].tolist()
+
+    @cached_method
     def contigs_with_gene(self, gene_id):
         """Get the list of contigs that contain a given gene."""
-        return pd.read_hdf(
-            self.exp_col_fp, 
-            "gene_positions", 
+        return self._read_table(
+            "gene_positions",
             where="cluster == '{}'".format(gene_id)
         )["seqname"].tolist()
 
-    @lru_cache(maxsize=128)
+    @cached_method
     def contig_df(self, contig_id):
         """Get the summary of the structure of a contig."""
-        return pd.read_hdf(
-            self.exp_col_fp,
+        return self._read_table(
             "gene_positions",
             where="seqname == '{}'".format(contig_id)
         )
+
+    @cached_method
+    def contig_synteny(self, contig_id, min_prop=0.5):
+        """
+
+        Get the contigs which share at least `min_prop` of the clusters in a contig.
+
+        Returns a DataFrame with one row per `other_contig`, with the proportion
+        of shared clusters, whether it is in the reverse orientation, and the
+        offset which aligns it to this contig. These are read from the
+        `contig_synteny` table, which only holds pairs above the minimum used
+        when the collection was built. Without that table, they are calculated
+        from the positions of the genes on each contig.
+
+        """
+        from lib.synteny import contig_synteny
+
+        if self._has_table("contig_synteny"):
+            synteny_df = self._read_table(
+                "contig_synteny",
+                where="contig == '{}'".format(contig_id)
+            )
+            synteny_df = synteny_df.loc[synteny_df["shared_prop"] >= min_prop]
+
+        else:
+            # Only the contigs which share a cluster with this one are read
+            clusters = self.contig_df(contig_id)["cluster"].unique()
+            other_contigs = set([
+                other_contig
+                for cluster_id in clusters
+                for other_contig in self.contigs_with_gene(cluster_id)
+            ])
+            synteny_df = contig_synteny(
+                pd.concat([
+                    self.contig_df(other_contig)
+                    for other_contig in other_contigs | set([contig_id])
+                ]),
+                min_prop=min_prop,
+                contigs=[contig_id]
+            )
+
+        return synteny_df.sort_values(
+            by="shared_prop",
+            ascending=False
+        ).reset_index(drop=True)
+
+    def cache_stats(self):
+        """Return the number of hits, misses and evictions for the table cache."""
+        return self.cache.stats()
+
+    def clear_cache(self, method_name=None, sidecar=False):
+        """
+
+        Clear the table cache, either entirely or for a single method (e.g. "metadata").
+
+        If `sidecar`, also remove the matching results saved next to the collection.
+
+        """
+        self.cache.invalidate(method_name)
+        if sidecar and self.sidecar is not None:
+            self.sidecar.invalidate(method_name)
+
+    def _resolve_table(self, table_name):
+        """Return the (filepath, key) where a table is stored, following external links."""
+        if not table_name.startswith("/"):
+            table_name = "/" + table_name
+
+        for link_path, target in self.external_links.items():
+            if table_name == link_path or table_name.startswith(link_path + "/"):
+                target_fp, target_key = split_link_target(target)
+
+                # Relative links are relative to the collection itself
+                if not os.path.isabs(target_fp):
+                    target_fp = os.path.join(
+                        os.path.dirname(os.path.abspath(self.exp_col_fp)),
+                        target_fp
+                    )
+                assert os.path.exists(target_fp), "Linked file not found: " + target_fp
+
+                return target_fp, target_key + table_name[len(link_path):]
+
+        return self.exp_col_fp, table_name
+
+    def _has_table(self, table_name):
+        """Check whether a table is present in the collection (following external links)."""
+        fp, key = self._resolve_table(table_name)
+        with pd.HDFStore(fp, mode="r") as store:
+            return key in store
+
+    def _read_table(self, table_name, **kwargs):
+        """Read a table from the collection, following external links."""
+        fp, key = self._resolve_table(table_name)
+        return pd.read_hdf(fp, key, **kwargs)
+
+    def iter_table(self, table_name, columns=None, where=None, chunksize=100000):
+        """
+        
+        Yield a table from the collection in chunks of `chunksize` rows.
+
+        Only the `columns` which are specified are read from disk, and rows
+        may be filtered with a PyTables `where` query on any data column,
+        e.g. "gene == 'gene_1'". The entire table is never held in memory.
+
+        """
+
+        fp, key = self._resolve_table(table_name)
+
+        with pd.HDFStore(fp, mode="r") as store:
+            assert key in store, "{} not found in {}".format(key, fp)
+
+            for chunk in store.select(
+                key,
+                columns=columns,
+                where=where,
+                chunksize=chunksize
+            ):
+                yield chunk
+
+    def iter_gene_abundance(self, samples=None, metric=None, chunksize=100000):
+        """
+        
+        Yield the abundance of genes in chunks of `chunksize` rows.
+
+        Each chunk is a DataFrame with a column for the gene ID, the sample,
+        and the `metric` (which defaults to the abundance key used in the input).
+
+        """
+
+        # Default to returning all samples
+        if samples is None:
+            samples = self.all_samples
+
+        # Set the metric to return
+        if metric is None:
+            metric = self.abund_id_key
+
+        for sample_id in samples:
+            assert sample_id in self.all_samples, "{} is not a valid sample".format(sample_id)
+
+            table_name, where = self._sample_table("/abundance/", sample_id)
+            for chunk in self.iter_table(
+                table_name,
+                columns=[self.gene_id_key, metric],
+                where=where,
+                chunksize=chunksize
+            ):
+                chunk = chunk.reindex(columns=[self.gene_id_key, metric])
+                chunk.insert(1, "sample", sample_id)
+                yield chunk
+
+    def map_chunks(self, fn, table_name, reduce_fn=None, columns=None, where=None, chunksize=100000):
+        """
+        
+        Apply `fn` to every chunk of a table, returning the list of results.
+
+        If `reduce_fn` is provided, it is used to combine the results as they
+        are computed (e.g. `lambda a, b: a.add(b, fill_value=0)`), and only
+        the combined value is returned.
+
+        """
+
+        results = []
+        combined = None
+
+        for ix, chunk in enumerate(self.iter_table(
+            table_name,
+            columns=columns,
+            where=where,
+            chunksize=chunksize
+        )):
+            value = fn(chunk)
+
+            if reduce_fn is None:
+                results.append(value)
+            elif ix == 0:
+                combined = value
+            else:
+                combined = reduce_fn(combined, value)
+
+        if reduce_fn is None:
+            return results
+        else:
+            return combined
+
+    def export_abundance_matrix(
+        self,
+        prefix,
+        level="gene",
+        metric="clr",
+        samples=None,
+        fill_value=np.nan
+    ):
+        """
+        
+        Write a dense float32 (gene or CAG) x sample matrix to `prefix`.npy.
+
+        The matrix is filled one sample at a time through a memory map, so the
+        full table is never held in memory. Row and column labels are written
+        to `prefix`.rows.txt and `prefix`.columns.txt, and the result can be
+        read with `open_abundance_matrix(prefix)`.
+
+        """
+
+        assert level in ["gene", "cag"]
+
+        if level == "gene":
+            table_prefix = "/abundance/"
+            id_col = self.gene_id_key
+            summary_table = "gene_summary"
+        else:
+            table_prefix = "/cag_abundance/"
+            id_col = "cag_id"
+            summary_table = "cag_summary"
+
+        # Default to all samples
+        if samples is None:
+            samples = self.all_samples
+
+        # Get the complete set of rows, preferably from the summary table
+        with pd.HDFStore(self.exp_col_fp, mode="r") as store:
+            if summary_table in store:
+                rows = store.select(summary_table, columns=[id_col])[id_col]
+            elif self.combined_abundance:
+                rows = store.select_column(table_prefix.rstrip("/"), id_col).drop_duplicates()
+            else:
+                rows = pd.concat([
+                    store.select(table_prefix + sample_id, columns=[id_col])[id_col]
+                    for sample_id in samples
+                ]).drop_duplicates()
+        rows = pd.Index(rows.astype(str).values)
+
+        matrix = np.lib.format.open_memmap(
+            prefix + ".npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(rows), len(samples))
+        )
+        matrix[:] = fill_value
+
+        for sample_ix, sample_id in enumerate(samples):
+            # Read the values directly, without adding them to the cache
+            table_name, where = self._sample_table(table_prefix, sample_id)
+            values = self._read_indexed_column(
+                table_name, id_col, metric, where=where
+            )
+            positions = rows.get_indexer(values.index.astype(str))
+            assert (positions >= 0).all(), "Unexpected IDs in " + sample_id
+            matrix[positions, sample_ix] = values.values.astype(np.float32)
+
+        matrix.flush()
+        del matrix
+
+        with open(prefix + ".rows.txt", "wt") as handle:
+            handle.write("".join(v + "\n" for v in rows))
+        with open(prefix + ".columns.txt", "wt") as handle:
+            handle.write("".join(v + "\n" for v in samples))
+
+        return prefix + ".npy"
+
+    def abundance_matrix(self, prefix, **kwargs):
+        """Open the matrix at `prefix`, exporting it first if it does not exist yet."""
+        if not os.path.exists(prefix + ".npy"):
+            self.export_abundance_matrix(prefix, **kwargs)
+
+        return open_abundance_matrix(prefix)
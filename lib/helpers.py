@@ -1,5 +1,4 @@
 
-import boto3
 import gzip
 import io
 import json
@@ -8,11 +7,13 @@ import numpy as np
 import os
 import pandas as pd
 import shutil
-import subprocess
 import sys
+import tables
 import traceback
 
-from scipy.stats.mstats import gmean
+from functools import lru_cache
+from lib.ncbi_taxonomy import NCBITaxonomy
+from lib.result_cache import object_size
 
 
 def repack_hdf5(fp, filter_string="GZIP=7"):
@@ -30,6 +31,9 @@ def repack_hdf5(fp, filter_string="GZIP=7"):
     
     logging.info("Running command: {}".format(" ".join(commands)))
 
+    # Only needed when repacking, so it is imported here
+    import subprocess
+
     # Run the command
     p = subprocess.Popen(
         commands,
@@ -57,6 +61,39 @@ def repack_hdf5(fp, filter_string="GZIP=7"):
     shutil.copyfile(temp_fp, fp)
 
 
+def add_external_links(fp, target_fp):
+    """
+    
+    Link every top-level node in `target_fp` into the HDF5 at `fp`.
+
+    The tables stay in `target_fp`, and are read through HDF5 external links.
+    Nodes which already exist in `fp` are not replaced.
+
+    """
+    with tables.open_file(target_fp, mode="r") as target:
+        node_names = [node._v_name for node in target.root._f_iter_nodes()]
+
+    with tables.open_file(fp, mode="a") as h5:
+        for node_name in node_names:
+            if node_name in h5.root:
+                logging.info("Not linking {}, which already exists".format(node_name))
+                continue
+
+            logging.info("Linking /{} to {}".format(node_name, target_fp))
+            h5.create_external_link(
+                "/",
+                node_name,
+                "{}:/{}".format(target_fp, node_name)
+            )
+
+
+def copy_hdf5_node(fp, node_path, dest_fp):
+    """Copy a single node (e.g. a pandas table) from the HDF5 at `fp` into a new file at `dest_fp`."""
+    with tables.open_file(fp, mode="r") as source, tables.open_file(dest_fp, mode="w") as dest:
+        assert node_path in source, "{} not found in {}".format(node_path, fp)
+        source.copy_node(node_path, newparent=dest.root, recursive=True)
+
+
 def format_eggnog_ko_df(df):
     """Make a table with just genes and KOs."""
 
@@ -98,41 +135,166 @@ def format_eggnog_cluster_df(df):
     }).dropna()
 
 
-def add_table_to_store(
+def format_metadata_df(df):
+    """Keep the metadata table as it was read in."""
+    return df
+
+
+def format_taxonomic_classification_df(df, names_fp=None, nodes_fp=None, merged_fp=None):
+    """
+    Make a table with just genes and taxids, for genes which were classified.
+
+    If the NCBI taxonomy is provided, the `tax_order` column holds the
+    preorder number of each taxid (see `NCBITaxonomy.preorder_intervals`).
+
+    """
+    df = df.loc[df["taxid"] != 0, ["gene", "taxid"]]
+
+    if names_fp is not None:
+        intervals = load_ncbi_taxonomy(names_fp, nodes_fp, merged_fp).preorder_intervals()
+        df = df.assign(tax_order=df["taxid"].apply(
+            lambda taxid: intervals.get(str(taxid), (-1, -1))[0]
+        ))
+
+    return df
+
+
+def format_taxonomy_intervals_df(df, names_fp=None, nodes_fp=None, merged_fp=None):
+    """Make a table with the preorder interval of every taxid (and ancestor) in the classification."""
+    tax = load_ncbi_taxonomy(names_fp, nodes_fp, merged_fp)
+    intervals = tax.preorder_intervals()
+
+    taxids = set()
+    for taxid in df.loc[df["taxid"] != 0, "taxid"].apply(str).unique():
+        if taxid in tax.tax:
+            taxids.update(tax.path_to_root(taxid))
+
+    return pd.DataFrame([
+        {
+            "taxid": int(taxid),
+            "start": intervals[taxid][0],
+            "stop": intervals[taxid][1],
+        }
+        for taxid in sorted(taxids, key=int)
+        if taxid in intervals
+    ])
+
+
+@lru_cache(maxsize=1)
+def load_ncbi_taxonomy(names_fp, nodes_fp, merged_fp=None):
+    """Read in the NCBI taxonomy once per process."""
+    return NCBITaxonomy(names_fp, nodes_fp, merged_fp=merged_fp)
+
+
+def read_tables_for_store(
     metadata_table_fp,
-    store,
     filter_function_dict,
     sep="\t",
     header="infer",
     names=None,
-    data_columns=None,
     comment=None
 ):
     """
-    Add a table to the store.
+    Read in a table and format it as a set of tables for the store.
 
     In `filter_function_dict`, each key is the name of the table, 
     and the value is a function to transform the table.
 
-    This is somewhat convoluted, but it is one way to maximize code reuse.
-    
+    This does not touch the store, so it can be run in a worker process
+    (as long as the filter functions can be pickled).
+
     """
 
     # Read in the table with Pandas
     logging.info("Reading in {}".format(metadata_table_fp))
     df = pd.read_table(metadata_table_fp, sep=sep, header=header, names=names, comment=comment)
 
-    # Replace the NaN values with "none" to prevent errors writing to HDF5
-    df.fillna("none", inplace=True)
-
-    # Use each of the filter functions to write out a table to the store
+    # Use each of the filter functions to make a table, with the declared types
+    filtered_tables = {}
     for table_name, filter_function in filter_function_dict.items():
         logging.info("Applying filter function for {}".format(table_name))
-        filtered_df = filter_function(df)
+        filtered_tables[table_name] = apply_schema(
+            filter_function(df),
+            TABLE_SCHEMAS.get(table_name)
+        )
+
+    return filtered_tables
+
+
+# Declared column types for the tables added with `read_tables_for_store`.
+# Repeated strings are stored as categoricals, and missing values are left
+# as NaN (which pandas writes to string columns as `nan_rep`).
+# Tables without a schema (e.g. metadata) have their types inferred.
+TABLE_SCHEMAS = {
+    "taxonomic_classification": {
+        "gene": "str",
+        "taxid": "int64",
+        "evalue": "float64",
+        "tax_order": "int64",
+    },
+    "taxonomy_intervals": {
+        "taxid": "int64",
+        "start": "int64",
+        "stop": "int64",
+    },
+    "eggnog_ko": {
+        "gene": "str",
+        "ko": "category",
+    },
+    "eggnog_cluster": {
+        "gene": "str",
+        "eggnog_cluster": "category",
+    },
+}
+
+
+def apply_schema(df, schema=None, max_category_fraction=0.5):
+    """
+    Set the type of each column in a table.
+
+    With a `schema` (a dict of column names and types), each column which is
+    present is converted to that type. Otherwise numeric columns are detected,
+    and string columns with few distinct values become categoricals.
+
+    """
+    df = df.copy()
+
+    if schema is None:
+        schema = {}
+        for col_name in df.columns.values:
+            if df[col_name].dtype != object:
+                continue
+
+            numeric = pd.to_numeric(df[col_name], errors="coerce")
+            if numeric.notnull().sum() == df[col_name].notnull().sum():
+                schema[col_name] = "float64" if numeric.isnull().any() else numeric.dtype.name
+            elif df[col_name].nunique() <= max_category_fraction * df.shape[0]:
+                schema[col_name] = "category"
+            else:
+                schema[col_name] = "str"
+
+    for col_name, col_type in schema.items():
+        if col_name not in df.columns.values:
+            continue
+
+        if col_type == "str":
+            df[col_name] = df[col_name].where(df[col_name].isnull(), df[col_name].apply(str))
+        elif col_type == "category":
+            df[col_name] = df[col_name].astype("category")
+        else:
+            df[col_name] = pd.to_numeric(df[col_name], errors="coerce").astype(col_type)
 
-        logging.info("Writing a table with {:,} rows and {:,} columns to HDF5".format(
+    return df
+
+
+def write_tables_to_store(filtered_tables, store, data_columns=None):
+    """Write a dict of tables (keyed by table name) to the store."""
+
+    for table_name, filtered_df in filtered_tables.items():
+        logging.info("Writing a table with {:,} rows and {:,} columns to HDF5 ({})".format(
             filtered_df.shape[0],
-            filtered_df.shape[1]
+            filtered_df.shape[1],
+            table_name
         ))
 
         if data_columns is not None:
@@ -141,8 +303,9 @@ def add_table_to_store(
         else:
             filtered_data_columns = None
 
-        # Do not add any NaNs
-        assert filtered_df.shape[0] == filtered_df.dropna().shape[0], "NaNs in DataFrame"
+        # Every row must be labeled with a gene
+        if "gene" in filtered_df.columns.values:
+            assert filtered_df["gene"].notnull().all(), "Missing gene IDs in {}".format(table_name)
 
         filtered_df.to_hdf(
             store,
@@ -152,13 +315,54 @@ def add_table_to_store(
         )
 
 
-def add_cags_to_store(cags_json, store):
-    """Add a set of CAGs to the HDF5 file as a table."""
+def add_table_to_store(
+    metadata_table_fp,
+    store,
+    filter_function_dict,
+    sep="\t",
+    header="infer",
+    names=None,
+    data_columns=None,
+    comment=None
+):
+    """
+    Add a table to the store.
+
+    In `filter_function_dict`, each key is the name of the table, 
+    and the value is a function to transform the table.
+
+    This is somewhat convoluted, but it is one way to maximize code reuse.
+    
+    """
+
+    write_tables_to_store(
+        read_tables_for_store(
+            metadata_table_fp,
+            filter_function_dict,
+            sep=sep,
+            header=header,
+            names=names,
+            comment=comment
+        ),
+        store,
+        data_columns=data_columns
+    )
+
+
+def read_cags(cags_json):
+    """Read a set of CAGs, formatted as a dict of lists."""
     cags = read_json(cags_json)
     
     m = "CAGs must be formatted as a dict of lists"
     assert isinstance(cags, dict), m
     assert all([isinstance(v, list) for v in cags.values()]), m
+
+    return cags
+
+
+def add_cags_to_store(cags_json, store):
+    """Add a set of CAGs to the HDF5 file as a table."""
+    cags = read_cags(cags_json)
     
     cags_df = pd.DataFrame([
         {
@@ -173,9 +377,104 @@ def add_cags_to_store(cags_json, store):
 
     cags_df.to_hdf(store, "cags", format="table", data_columns=["cag", "gene"])
 
+    add_cag_index_to_store(cags, store)
+
     return cags
 
 
+def add_cag_index_to_store(cags, store):
+    """
+    
+    Add a compressed (CSR-style) index of CAG membership to the store.
+
+    `cag_index_genes` lists every gene, grouped by CAG, so that the position of
+    each gene is its code and `cag_code` gives its CAG. `cag_index_offsets`
+    lists every CAG with the `start` and `stop` of its genes in that table.
+
+    """
+
+    cag_ids = list(cags.keys())
+    sizes = np.array([len(cags[cag_id]) for cag_id in cag_ids], dtype=np.int64)
+    stops = np.cumsum(sizes)
+
+    offsets_df = pd.DataFrame({
+        "cag": cag_ids,
+        "start": stops - sizes,
+        "stop": stops,
+    })
+
+    genes_df = pd.DataFrame({
+        "gene": [gene_id for cag_id in cag_ids for gene_id in cags[cag_id]],
+        "cag_code": np.repeat(np.arange(len(cag_ids), dtype=np.int64), sizes),
+    })
+
+    logging.info("Writing the CAG index for {:,} genes in {:,} CAGs".format(
+        genes_df.shape[0], offsets_df.shape[0]
+    ))
+    offsets_df.to_hdf(store, "cag_index_offsets", format="table")
+    genes_df.to_hdf(store, "cag_index_genes", format="table")
+
+
+# Normalizations which can be calculated by `normalize_abundance`
+NORMALIZATIONS = ["clr", "rel_abund", "per_kb"]
+
+
+def normalize_abundance(
+    abund,
+    length=None,
+    normalizations=["clr"],
+    clr_pseudocount=0
+):
+    """
+    
+    Compute a set of normalizations for the abundances in a single sample.
+
+    Supported normalizations are "clr" (log10 centered log-ratio, after adding
+    `clr_pseudocount`), "rel_abund" (proportion of the sample total) and
+    "per_kb" (abundance per kilobase of `length`).
+
+    Returns a dict with an array for each normalization, as well as the
+    log10 geometric mean of the sample (None if the CLR was not computed).
+
+    """
+
+    for k in normalizations:
+        assert k in NORMALIZATIONS, "Normalization not recognized: {}".format(k)
+
+    abund = np.asarray(abund, dtype=np.float64)
+    output = {}
+    log_gmean = None
+
+    if "clr" in normalizations:
+        log_abund = abund + clr_pseudocount
+        # Make sure there are all positive values before trying to calculate the CLR
+        if (log_abund <= 0).any():
+            logging.info("Cannot calculate the CLR with values <= 0, consider a pseudocount")
+        else:
+            log_abund = np.log10(log_abund)
+            log_gmean = log_abund.mean()
+            output["clr"] = log_abund - log_gmean
+
+    if "rel_abund" in normalizations:
+        output["rel_abund"] = abund / abund.sum()
+
+    if "per_kb" in normalizations:
+        assert length is not None, "Length is required for per_kb normalization"
+        output["per_kb"] = abund / (np.asarray(length, dtype=np.float64) / 1000.)
+
+    return output, log_gmean
+
+
+def abundance_data_columns(id_key, abundance_key="depth"):
+    """Columns of an abundance table which are indexed for queries, including every normalization."""
+    return [id_key, "sample", "rank", abundance_key, "clr", "rel_abund", abundance_key + "_per_kb"]
+
+
+def rank_abundance(abund):
+    """Rank a set of abundances from most (1) to least abundant, breaking ties by position."""
+    return abund.rank(ascending=False, method="first").astype(int)
+
+
 def add_abundance_to_store(
     sample_name,
     sample_abundance_json_fp,
@@ -184,12 +483,30 @@ def add_abundance_to_store(
     results_key="results",
     abundance_key="depth",
     other_keys=["length", "coverage", "nreads"], 
-    gene_id_key="id"
+    gene_id_key="id",
+    normalizations=["clr"],
+    clr_pseudocount=0,
+    write_buffer=None,
+    sample_dat=None
 ):
-    """Add the abundance data from a single abundance JSON to the store."""
+    """
+    Add the abundance data from a single abundance JSON to the store.
+
+    Each of the `normalizations` (see `normalize_abundance`) is stored as its own
+    column, named "clr", "rel_abund", or e.g. "depth_per_kb".
+
+    If an `AbundanceWriteBuffer` is provided, the tables are added to that
+    buffer (to be written together with other samples) instead of being
+    appended to the store directly.
+
+    If the JSON has already been read (e.g. by a `SamplePrefetcher`), pass
+    it in as `sample_dat`.
+
+    """
     
     # Get the JSON for this particular sample
-    sample_dat = read_json(sample_abundance_json_fp)
+    if sample_dat is None:
+        sample_dat = read_json(sample_abundance_json_fp)
 
     # If this is a dict, check for the results key
     if isinstance(sample_dat, dict):
@@ -212,49 +529,48 @@ def add_abundance_to_store(
         assert gene_id_key in d
 
     # Format as a DataFrame
-    sample_dat = pd.DataFrame(
-        [
-            {
-                gene_id_key: d[gene_id_key],
-                abundance_key: float(d[abundance_key]),
-                **{
-                    k: d[k]
-                    for k in other_keys
-                }
-            }
-            for d in sample_dat
-        ]
+    sample_dat = pd.DataFrame(sample_dat).reindex(
+        columns=[gene_id_key, abundance_key] + other_keys
     )
+    sample_dat[abundance_key] = sample_dat[abundance_key].apply(float)
 
     # Add the sample name
     sample_dat["sample"] = sample_name
 
     logging.info("Sample {} contains {} genes".format(sample_name, sample_dat.shape[0]))
 
-    # If the abundance isn't a CLR, calculate the CLR
+    # If the abundance isn't a CLR, calculate the CLR (and any other normalizations)
+    if abundance_key == "clr":
+        normalizations = [k for k in normalizations if k != "clr"]
 
-    if abundance_key != "clr":
-        # Make sure there are all positive values before trying to calculate the CLR
-        if (sample_dat[abundance_key] <= 0).any():
-            logging.info("Cannot calculate the CLR with values <= 0")
-        else:
-            logging.info("Calculating the CLR")
-
-            # Get the geometric mean of the sample
-            sample_gmean = gmean(sample_dat[abundance_key])
+    logging.info("Calculating normalizations: {}".format(", ".join(normalizations)))
+    normalized, log_gmean = normalize_abundance(
+        sample_dat[abundance_key].values,
+        length=sample_dat["length"].values if "length" in sample_dat.columns.values else None,
+        normalizations=normalizations,
+        clr_pseudocount=clr_pseudocount
+    )
+    for k, v in normalized.items():
+        if k == "per_kb":
+            k = abundance_key + "_per_kb"
+        sample_dat[k] = v
 
-            # Calculate the CLR
-            sample_dat["clr"] = (sample_dat[abundance_key] / sample_gmean).apply(np.log10)
+    # Rank each gene within the sample (1 is the most abundant)
+    sample_dat["rank"] = rank_abundance(sample_dat[abundance_key])
 
     # Write to the HDF5
-    logging.info("Writing {} to HDF5".format(sample_name))
-    sample_dat.to_hdf(
-        store,
-        "abundance",
-        format="table",
-        data_columns=[gene_id_key, "sample"],
-        append=True
-    )
+    if write_buffer is None:
+        logging.info("Writing {} to HDF5".format(sample_name))
+        sample_dat.to_hdf(
+            store,
+            "abundance",
+            format="table",
+            data_columns=[
+                k for k in abundance_data_columns(gene_id_key, abundance_key)
+                if k in sample_dat.columns.values
+            ],
+            append=True
+        )
 
     # If the CAGs are provided, make a summary of their abundance
     if cags is not None:
@@ -279,38 +595,382 @@ def add_abundance_to_store(
         # Add the sample name
         cag_df["sample"] = sample_name
 
-        # Calculate the CLR
-        if abundance_key != "clr":
-            cag_df["clr"] = cag_df[abundance_key].apply(
-                lambda v: np.log10(v / sample_gmean)
+        # Calculate the CLR, relative to the geometric mean of all genes
+        if log_gmean is not None:
+            cag_df["clr"] = np.log10(
+                cag_df[abundance_key].values + clr_pseudocount
+            ) - log_gmean
+
+        # Calculate the proportion of the sample total
+        if "rel_abund" in normalizations:
+            cag_df["rel_abund"] = cag_df[abundance_key] / sample_dat[abundance_key].sum()
+
+        # Rank each CAG within the sample (1 is the most abundant)
+        cag_df["rank"] = rank_abundance(cag_df[abundance_key])
+
+        if write_buffer is None:
+            logging.info("Writing out the abundance for {:,} CAGs".format(
+                cag_df.shape[0]
+            ))
+            cag_df.to_hdf(
+                store,
+                "cag_abundance",
+                format="table",
+                data_columns=[
+                    k for k in abundance_data_columns("cag_id", abundance_key)
+                    if k in cag_df.columns.values
+                ],
+                append=True
             )
+    else:
+        cag_df = None
 
-        logging.info("Writing out the abundance for {:,} CAGs".format(
-            cag_df.shape[0]
-        ))
-        cag_df.to_hdf(
-            store,
-            "cag_abundance",
-            format="table",
-            data_columns=["cag_id", "sample"],
-            append=True
+    if write_buffer is not None:
+        write_buffer.add_sample(
+            sample_name,
+            {"abundance": sample_dat, "cag_abundance": cag_df}
         )
 
-
     logging.info("Done reading in abundance for {}".format(sample_name))
 
+    return sample_dat, cag_df
+
+
+class AbundanceWriteBuffer:
+    """
+    
+    Collect the abundance tables for many samples, and append them in large batches.
+
+    The width of each string column is fixed with `min_itemsize` when the
+    first batch is written, so that the order in which samples are added does
+    not matter. A batch is written once it holds at least `batch_rows` rows.
+    The indexed data columns (see `abundance_data_columns`) follow
+    `gene_id_key` and `abundance_key`, as in `add_abundance_to_store`.
+
+    """
+
+    def __init__(
+        self,
+        store,
+        min_itemsize,
+        gene_id_key="id",
+        abundance_key="depth",
+        batch_rows=5000000
+    ):
+        self.store = store
+        self.min_itemsize = min_itemsize
+        self.data_columns = {
+            "abundance": abundance_data_columns(gene_id_key, abundance_key),
+            "cag_abundance": abundance_data_columns("cag_id", abundance_key),
+        }
+        self.batch_rows = batch_rows
+
+        # Tables waiting to be written, keyed by table name
+        self.pending = {table_name: [] for table_name in self.data_columns}
+        self.pending_rows = 0
+        self.pending_samples = []
+
+    def add_sample(self, sample_name, sample_tables):
+        """Add the tables for a single sample, keyed by table name."""
+        for table_name, df in sample_tables.items():
+            if df is None:
+                continue
+            assert table_name in self.pending, "Unexpected table: " + table_name
+            self.pending[table_name].append(df)
+            self.pending_rows += df.shape[0]
+
+        self.pending_samples.append(sample_name)
+
+    def is_full(self):
+        return self.pending_rows >= self.batch_rows
+
+    def flush(self):
+        """Write out all of the pending tables, returning the names of the samples written."""
+        for table_name, df_list in self.pending.items():
+            if len(df_list) == 0:
+                continue
+
+            df = pd.concat(df_list, ignore_index=True)
+
+            # Only set the width of string columns which are present in the table
+            min_itemsize = {
+                k: v
+                for k, v in self.min_itemsize.items()
+                if k in df.columns.values and df[k].dtype == object
+            }
 
-def exit_and_clean_up(temp_folder):
-    """Log the error messages and delete the temporary folder."""
+            logging.info("Writing {:,} rows from {:,} samples to {}".format(
+                df.shape[0], len(self.pending_samples), table_name
+            ))
+            self.store.append(
+                table_name,
+                df,
+                format="table",
+                data_columns=[k for k in self.data_columns[table_name] if k in df.columns.values],
+                min_itemsize=min_itemsize,
+                chunksize=df.shape[0]
+            )
+
+        written_samples = self.pending_samples
+        self.pending = {table_name: [] for table_name in self.data_columns}
+        self.pending_rows = 0
+        self.pending_samples = []
+
+        return written_samples
+
+
+class AbundanceSummary:
+    """
+    
+    Running summary of the abundance of each gene (or CAG) across samples.
+
+    Every ID is given a fixed position the first time it is seen, and the
+    statistics are kept in arrays which only grow, so adding a sample only
+    touches the rows in that sample. The mean and variance are updated with
+    Welford's method, which stays accurate for values with a large mean and
+    a small variance.
+
+    """
+
+    def __init__(self, id_key, metrics=["depth", "clr"], total_keys=["nreads"]):
+        self.id_key = id_key
+        self.metrics = metrics
+        self.total_keys = total_keys
+
+        # Number of samples which have been added
+        self.n_samples = 0
+
+        # Position of each ID in the arrays, in the order they were first seen
+        self.positions = {}
+        self.ids = []
+
+        # Arrays of running statistics, with room for `capacity` IDs
+        self.capacity = 0
+        self.stats = {}
+
+        # Metrics and totals which were present in any sample
+        self.seen_keys = set()
+
+    def _grow(self, n_ids):
+        """Make room for at least `n_ids` IDs, doubling the size of the arrays as needed."""
+        if n_ids <= self.capacity:
+            return
+
+        capacity = max(n_ids, 2 * self.capacity, 1024)
+        initial_values = {"n_detected": 0}
+        for k in self.metrics:
+            initial_values.update({
+                k + "_n": 0,
+                k + "_mean": 0.,
+                k + "_m2": 0.,
+                k + "_min": np.inf,
+                k + "_max": -np.inf,
+            })
+        for k in self.total_keys:
+            initial_values[k + "_total"] = 0.
+
+        for k, v in initial_values.items():
+            arr = np.full(capacity, v, dtype=int if isinstance(v, int) else float)
+            if k in self.stats:
+                arr[:self.capacity] = self.stats[k]
+            self.stats[k] = arr
+
+        self.capacity = capacity
+
+    def add_sample(self, sample_df):
+        """Add the abundances from a single sample to the running totals."""
+        self.n_samples += 1
+
+        # Give a position to every ID seen for the first time
+        ids = sample_df[self.id_key].values
+        for id_value in ids:
+            if id_value not in self.positions:
+                self.positions[id_value] = len(self.ids)
+                self.ids.append(id_value)
+        self._grow(len(self.ids))
+
+        rows = np.fromiter(
+            (self.positions[id_value] for id_value in ids),
+            dtype=np.int64,
+            count=len(ids)
+        )
+        self.stats["n_detected"][rows] += 1
+
+        for k in self.metrics:
+            if k not in sample_df.columns.values:
+                continue
+            self.seen_keys.add(k)
+
+            values = sample_df[k].values.astype(float)
+            keep = ~np.isnan(values)
+            k_rows, values = rows[keep], values[keep]
+
+            # Welford's update, with a single new value for each row
+            n = self.stats[k + "_n"][k_rows] + 1
+            mean = self.stats[k + "_mean"][k_rows]
+            delta = values - mean
+            mean = mean + delta / n
+            self.stats[k + "_m2"][k_rows] += delta * (values - mean)
+            self.stats[k + "_mean"][k_rows] = mean
+            self.stats[k + "_n"][k_rows] = n
+
+            self.stats[k + "_min"][k_rows] = np.fmin(self.stats[k + "_min"][k_rows], values)
+            self.stats[k + "_max"][k_rows] = np.fmax(self.stats[k + "_max"][k_rows], values)
+
+        for k in self.total_keys:
+            if k in sample_df.columns.values:
+                self.seen_keys.add(k + "_total")
+                self.stats[k + "_total"][rows] += sample_df[k].values.astype(float)
+
+    def summary(self):
+        """
+        
+        Return a DataFrame summarizing each ID across all samples.
+
+        The mean, variance, min, and max of each metric are calculated over the
+        samples in which the ID was detected, while `prevalence` is the
+        proportion of all samples in which it was detected.
+
+        """
+        assert self.n_samples > 0, "No samples have been added"
+
+        n_ids = len(self.ids)
+        stats = {k: v[:n_ids] for k, v in self.stats.items()}
+
+        df = pd.DataFrame({
+            self.id_key: self.ids,
+            "n_detected": stats["n_detected"],
+            "prevalence": stats["n_detected"] / self.n_samples,
+        })
+
+        for k in self.metrics:
+            if k not in self.seen_keys:
+                continue
+            n = stats[k + "_n"]
+            detected = n > 0
+            df[k + "_mean"] = np.where(detected, stats[k + "_mean"], np.nan)
+            # Sample variance, which is zero for IDs detected only once
+            with np.errstate(divide="ignore", invalid="ignore"):
+                df[k + "_var"] = np.where(n > 1, stats[k + "_m2"] / (n - 1), 0)
+            df[k + "_min"] = np.where(detected, stats[k + "_min"], np.nan)
+            df[k + "_max"] = np.where(detected, stats[k + "_max"], np.nan)
+
+        for k in self.total_keys:
+            if k + "_total" in self.seen_keys:
+                df[k + "_total"] = stats[k + "_total"]
+
+        return df
+
+
+def add_sample_list_to_store(sample_names, store):
+    """Write the names of the samples with abundances, so that readers need not scan the abundance table."""
+    pd.DataFrame({"sample": list(sample_names)}).to_hdf(store, "abundance_samples", format="table")
+
+
+def add_summary_to_store(summary, store, table_name):
+    """Write the summary statistics from an AbundanceSummary to the store."""
+    summary_df = summary.summary()
+
+    logging.info("Writing summary statistics for {:,} rows to {}".format(
+        summary_df.shape[0],
+        table_name
+    ))
+
+    summary_df.to_hdf(
+        store,
+        table_name,
+        format="table",
+        data_columns=True
+    )
+
+
+def minhash_sketch(gene_ids, scaled=1000):
+    """
+    
+    Make a scaled MinHash sketch of a set of gene IDs.
+
+    Every ID is hashed to 64 bits, and only the hashes in the lowest
+    1 / `scaled` of the range are kept. Since the same hashes are kept for
+    every sample, the overlap of two sketches estimates the overlap of the
+    full sets. Returns a sorted array of unique hashes.
+
+    """
+    hashes = pd.util.hash_array(np.asarray(gene_ids, dtype=object))
+    max_hash = np.uint64((2 ** 64 - 1) // scaled)
+
+    return np.unique(hashes[hashes <= max_hash])
+
+
+def add_sketches_to_store(sketches, store, scaled=1000):
+    """Write the MinHash sketch of each sample (a dict of arrays) to the store."""
+    sketch_df = pd.DataFrame({
+        "sample": [
+            sample_name
+            for sample_name, hashes in sketches.items()
+            for _ in range(len(hashes))
+        ],
+        "hash": np.concatenate(
+            [hashes for hashes in sketches.values()] + [np.array([], dtype=np.uint64)]
+        ),
+    })
+
+    logging.info("Writing {:,} hashes for {:,} sample sketches".format(
+        sketch_df.shape[0], len(sketches)
+    ))
+    sketch_df.to_hdf(store, "sample_sketches", format="table", data_columns=["sample"])
+    store.get_storer("sample_sketches").attrs.scaled = scaled
+
+
+class BuildCheckpoint:
+    """Manifest of the stages and samples which have been written in a work folder."""
+
+    def __init__(self, work_folder):
+        self.fp = os.path.join(work_folder, "checkpoint.json")
+
+        if os.path.exists(self.fp):
+            with open(self.fp, "rt") as handle:
+                self.manifest = json.load(handle)
+        else:
+            self.manifest = {"stages": [], "samples": []}
+
+    def stage_done(self, stage):
+        return stage in self.manifest["stages"]
+
+    def sample_done(self, sample_name):
+        return sample_name in self.manifest["samples"]
+
+    def mark_stage_done(self, stage):
+        logging.info("Checkpoint: finished {}".format(stage))
+        self.manifest["stages"].append(stage)
+        self.save()
+
+    def mark_sample_done(self, sample_name):
+        self.manifest["samples"].append(sample_name)
+        self.save()
+
+    def save(self):
+        """Write the manifest atomically, so that a crash never leaves it truncated."""
+        temp_fp = self.fp + ".tmp"
+        with open(temp_fp, "wt") as handle:
+            json.dump(self.manifest, handle)
+        os.replace(temp_fp, self.fp)
+
+
+def exit_and_clean_up(temp_folder, keep=False):
+    """Log the error messages and delete the temporary folder (unless `keep`)."""
     # Capture the traceback
     logging.info("There was an unexpected failure")
     exc_type, exc_value, exc_traceback = sys.exc_info()
     for line in traceback.format_tb(exc_traceback):
         logging.info(line)
 
-    # Delete any files that were created for this sample
-    logging.info("Removing temporary folder: " + temp_folder)
-    shutil.rmtree(temp_folder)
+    if keep:
+        # Leave the completed stages in place, to be picked up with --resume
+        logging.info("Keeping work folder for --resume: " + temp_folder)
+    else:
+        # Delete any files that were created for this sample
+        logging.info("Removing temporary folder: " + temp_folder)
+        shutil.rmtree(temp_folder)
 
     # Exit
     logging.info("Exit type: {}".format(exc_type))
@@ -318,6 +978,158 @@ def exit_and_clean_up(temp_folder):
     sys.exit(exc_value)
 
 
+class SamplePrefetcher:
+    """
+    
+    Read the abundance JSON for upcoming samples in background threads.
+
+    Iterating yields (sample_name, fp, data) in the order of `sample_list`,
+    while up to `depth` of the following samples are downloaded and parsed.
+    No more samples are started while the samples being read (and waiting to
+    be yielded) are expected to take up more than `max_bytes` of memory once
+    parsed (the next sample is always started). If a file cannot be read in
+    the background, `data` is None and the caller reads it again.
+
+    The memory needed for each sample is estimated from the size of its file,
+    times the ratio of parsed to file size. That ratio starts from
+    `expansion` (for gzipped files, and a quarter of it for plain JSON) and
+    is replaced by the ratio measured for the first file which is read.
+
+    """
+
+    def __init__(self, sample_list, depth=4, max_bytes=2e9, expansion=25.):
+        self.sample_list = sample_list
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.expansion = expansion
+
+        # Ratio of parsed to file size, measured on the first file read
+        self.measured_expansion = None
+
+    def _expected_bytes(self, fp):
+        """Estimate the memory taken by the parsed JSON from a file."""
+        # Files which cannot be found fail again when the caller reads them
+        try:
+            size = file_size(fp)
+        except Exception as e:
+            logging.info("Could not find the size of {}: {}".format(fp, e))
+            return 0
+
+        if self.measured_expansion is not None:
+            return size * self.measured_expansion
+        elif fp.endswith(".gz"):
+            return size * self.expansion
+        else:
+            return size * self.expansion / 4
+
+    def _read(self, fp, measure=False):
+        """Read a file in a background thread, measuring the size of the result if `measure`."""
+        data = read_json(fp)
+        if measure:
+            self.measured_expansion = object_size(data) / max(1, file_size(fp))
+            logging.info("Parsed abundance files take ~{:.1f}x their size in memory".format(
+                self.measured_expansion
+            ))
+        return data
+
+    def __iter__(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        pending = []
+        pending_bytes = 0
+        next_ix = 0
+
+        with ThreadPoolExecutor(max_workers=self.depth) as executor:
+            while next_ix < len(self.sample_list) or len(pending) > 0:
+
+                # Start reading the upcoming samples
+                while next_ix < len(self.sample_list) and len(pending) < self.depth:
+                    sample_name, fp = self.sample_list[next_ix]
+                    expected_bytes = self._expected_bytes(fp)
+                    if len(pending) > 0 and pending_bytes + expected_bytes > self.max_bytes:
+                        break
+                    pending.append((
+                        sample_name,
+                        fp,
+                        expected_bytes,
+                        executor.submit(self._read, fp, measure=next_ix == 0)
+                    ))
+                    pending_bytes += expected_bytes
+                    next_ix += 1
+
+                sample_name, fp, expected_bytes, future = pending.pop(0)
+                pending_bytes -= expected_bytes
+
+                try:
+                    data = future.result()
+                except Exception as e:
+                    logging.info("Could not prefetch {}: {}".format(fp, e))
+                    data = None
+
+                yield sample_name, fp, data
+
+
+def sample_sheet_from_s3_prefix(prefix, suffixes=(".json.gz", ".json"), workers=8):
+    """
+    
+    Make a sample sheet from every abundance JSON under an S3 prefix.
+
+    Each folder directly below the prefix is listed in its own thread. The
+    sample name is the file name, without the suffix.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    assert prefix.startswith("s3://"), "Prefix must start with s3://"
+    bucket, key_prefix = prefix[5:].split("/", 1)
+    paginator = s3_client().get_paginator("list_objects_v2")
+
+    def list_keys(list_prefix, delimiter=None):
+        keys, folders = [], []
+        kwargs = dict(Bucket=bucket, Prefix=list_prefix)
+        if delimiter is not None:
+            kwargs["Delimiter"] = delimiter
+        for page in paginator.paginate(**kwargs):
+            keys.extend([obj["Key"] for obj in page.get("Contents", [])])
+            folders.extend([p["Prefix"] for p in page.get("CommonPrefixes", [])])
+        return keys, folders
+
+    # List the top level, and then each folder within it in parallel
+    keys, folders = list_keys(key_prefix, delimiter="/")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for folder_keys, _ in executor.map(list_keys, folders):
+            keys.extend(folder_keys)
+
+    sample_sheet = {}
+    for key in keys:
+        for suffix in suffixes:
+            if key.endswith(suffix):
+                sample_name = key.rsplit("/", 1)[-1][:-len(suffix)]
+                assert sample_name not in sample_sheet, "Duplicate sample: " + sample_name
+                sample_sheet[sample_name] = "s3://{}/{}".format(bucket, key)
+                break
+
+    logging.info("Found {:,} samples under {}".format(len(sample_sheet), prefix))
+    return sample_sheet
+
+
+def file_size(fp):
+    """Return the size of a local or S3 file, in bytes."""
+    if fp.startswith("s3://"):
+        bucket, key = fp[5:].split("/", 1)
+        return s3_client().head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+    assert os.path.exists(fp), "File not found: " + fp
+    return os.path.getsize(fp)
+
+
+@lru_cache(maxsize=1)
+def s3_client():
+    """Connect to AWS S3, importing boto3 only when an s3:// path is used."""
+    import boto3
+    return boto3.client('s3')
+
+
 def read_json(fp):
     assert fp.endswith((".json", ".json.gz"))
     logging.info("Reading in " + fp)
@@ -326,7 +1138,7 @@ def read_json(fp):
         bucket_name, key_name = fp[5:].split("/", 1)
 
         # Connect to the S3 boto3 client
-        s3 = boto3.client('s3')
+        s3 = s3_client()
 
         # Download the object
         retr = s3.get_object(Bucket=bucket_name, Key=key_name)
@@ -35,7 +35,11 @@ class NCBITaxonomy():
                 if parent != child:
                     self.tax[child]['parent'] = parent
 
+        # Preorder intervals, computed on demand by `preorder_intervals`
+        self.intervals = None
+
         # Read in the "merged" taxids
+        self.merged = {}
         if merged_fp is not None:
             assert os.path.exists(merged_fp)
             with open(merged_fp) as f:
@@ -46,6 +50,7 @@ class NCBITaxonomy():
                     assert new_taxid in self.tax
                     # Link the old taxid to the new taxid
                     self.tax[old_taxid] = self.tax[new_taxid]
+                    self.merged[old_taxid] = new_taxid
 
     def info(self, taxid):
         return self.tax.get(taxid)
@@ -60,9 +65,6 @@ class NCBITaxonomy():
         visited = [taxid]
         while 'parent' in self.tax[taxid]:
             taxid = self.tax[taxid]['parent']
-            if 'ancestors' in self.tax[taxid]:
-                visited.extend(self.tax[taxid]['ancestors'])
-                return visited
             assert taxid not in visited, visited
             visited.append(taxid)
         return visited
@@ -70,10 +72,53 @@ class NCBITaxonomy():
     def is_below(self, taxid, group_taxid):
         # Determine whether a taxid is part of a particular group
         assert taxid in self.tax, "Tax ID not found: {}".format(taxid)
-        if 'ancestors' not in self.tax[taxid]:
-            self.tax[taxid]['ancestors'] = self.path_to_root(taxid)
 
-        return group_taxid in self.tax[taxid]['ancestors']
+        # With the preorder intervals this is a range check
+        if self.intervals is not None and group_taxid in self.intervals:
+            start, stop = self.intervals[group_taxid]
+            return start <= self.intervals[taxid][0] < stop
+
+        return group_taxid in self.path_to_root(taxid)
+
+    def preorder_intervals(self, root="1"):
+        """
+        Number every taxid in a preorder traversal of the taxonomy.
+
+        Returns a dict with (start, stop) for each taxid, where `start` is its
+        own number and every taxid below it is numbered within [start, stop).
+
+        """
+        if self.intervals is not None:
+            return self.intervals
+
+        children = defaultdict(list)
+        for taxid, d in self.tax.items():
+            if taxid in self.merged:
+                continue
+            if 'parent' in d:
+                children[d['parent']].append(taxid)
+
+        self.intervals = {}
+        counter = 0
+        # Walk the tree without recursion, which would exceed the stack limit
+        stack = [(root, False)]
+        while len(stack) > 0:
+            taxid, visited = stack.pop()
+            if visited:
+                self.intervals[taxid] = (self.intervals[taxid][0], counter)
+                continue
+            self.intervals[taxid] = (counter, None)
+            counter += 1
+            stack.append((taxid, True))
+            for child in sorted(children[taxid], reverse=True):
+                stack.append((child, False))
+
+        # Merged taxids share the interval of the taxid they were merged into
+        for old_taxid, new_taxid in self.merged.items():
+            if new_taxid in self.intervals:
+                self.intervals[old_taxid] = self.intervals[new_taxid]
+
+        return self.intervals
 
     @lru_cache(maxsize=None)
     def lca(self, taxid1, taxid2):
@@ -1,17 +1,15 @@
 """Functions to help plotting data from the experiment collection."""
 
 import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import seaborn as sns
 
-from collections import defaultdict
 from matplotlib import patches
 
 def plot_single_contig(exp, contig_name, pdf=None):
     """Using data from an experiment collection `exp`, plot a contig."""
     # Get the set of clusters (protein-coding genes) on this contig
-    contig_gene_df = exp.contig_df(contig_name)
+    contig_gene_df = exp.contig_df(contig_name).copy()
 
     # Make the position numeric
     contig_gene_df["start"] = contig_gene_df["start"].apply(int)
@@ -91,29 +89,19 @@ def plot_contig_structure(exp, central_contig_name, min_prop=0.5):
     # Get the set of protein-coding genes on this contig
     clusters = exp.contig_df(central_contig_name)["cluster"].unique()
 
-    # For each cluster, get the set of contigs it was found in (>=90% sequence identity)
-    clusters_contigs = {
-        cluster_name: exp.contigs_with_gene(cluster_name)
-        for cluster_name in clusters
-    }
-
-    # Count up the proportion of the clusters found by each contig
-    contig_cluster_counts = defaultdict(int)
-    for cluster_id, contig_list in clusters_contigs.items():
-        for contig_id in contig_list:
-            contig_cluster_counts[contig_id] += 1
-    contig_cluster_counts = pd.Series(
-        contig_cluster_counts).sort_values(ascending=False)
+    # Get the contigs which share at least `min_prop` of those clusters,
+    # along with their orientation and offset relative to this contig
+    synteny_df = exp.contig_synteny(
+        central_contig_name,
+        min_prop=min_prop
+    ).set_index("other_contig")
 
-    # Take the proportion
-    contig_cluster_prop = contig_cluster_counts / clusters.shape[0]
+    # Plot this contig first, followed by the most similar contigs
+    contigs_to_plot = [central_contig_name] + synteny_df.index.tolist()
 
-    # Calculate the proportion of genes that are found
-    contigs_to_plot = contig_cluster_prop.index.values[contig_cluster_prop >= min_prop]
-
-    # Get the genes for each contig
+    # Get the genes for each contig (copied, so that the cached tables are not modified)
     contig_genes = {
-        contig_id: exp.contig_df(contig_id)
+        contig_id: exp.contig_df(contig_id).copy()
         for contig_id in contigs_to_plot
     }
 
@@ -124,8 +112,6 @@ def plot_contig_structure(exp, central_contig_name, min_prop=0.5):
     }
 
     # Calculate the relative plotting location for the genes in each contig
-    central_contig_cluster_start = contig_genes[central_contig_name].set_index("cluster")[
-        "start"].apply(int)
     for contig_name, contig_gene_df in contig_genes.items():
         # Convert the coordinates to numbers
         for k in ["start", "end"]:
@@ -136,40 +122,16 @@ def plot_contig_structure(exp, central_contig_name, min_prop=0.5):
         if contig_name == central_contig_name:
             continue
 
-        # Calculate the offset for each individual protein
-        offset_df = pd.DataFrame([
-            {
-                "cluster_id": r["cluster"],
-                "position": r["start"],
-                "central_contig_position": central_contig_cluster_start[r["cluster"]],
-                "offset": r["start"] - central_contig_cluster_start[r["cluster"]],
-            }
-            for _, r in contig_gene_df.iterrows()
-            if r["cluster"] in clusters
-        ])
-        offset_df.sort_values(by="position", inplace=True)
-
-        # Calculate the marginal offset, comparing one gene to the next immediately adjacent
-        marginal_offset = pd.Series(
-            offset_df["offset"].values[:-1] - offset_df["offset"].values[1:])
-
-        # If the median marginal offset == 0, the contig is in the correct orientation
-        # Otherwise, reverse the orientation of the contig
-        if np.abs(marginal_offset.median()) >= 1.:
+        # Reverse the orientation of the contig, if needed
+        if synteny_df.loc[contig_name, "reverse"]:
             contig_gene_df["start"], contig_gene_df["end"] = -1 * \
                 contig_gene_df["end"], -1 * contig_gene_df["start"]
 
             contig_gene_df["strand"] = contig_gene_df["strand"].apply(
                 lambda x: "-" if x == "+" else "+")
 
-        # Now calculate the average offset
-        avg_offset = np.mean([
-            r["start"] - central_contig_cluster_start[r["cluster"]]
-            for _, r in contig_gene_df.iterrows()
-            if r["cluster"] in clusters
-        ])
-
         # Now calculate the adjusted start and end positions
+        avg_offset = synteny_df.loc[contig_name, "offset"]
         contig_gene_df["start_adj"] = contig_gene_df["start"] - avg_offset
         contig_gene_df["end_adj"] = contig_gene_df["end"] - avg_offset
 
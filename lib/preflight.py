@@ -0,0 +1,424 @@
+"""Estimate the resources needed to build an experiment collection, without building it."""
+
+import gzip
+import logging
+import os
+
+import pandas as pd
+
+from lib.helpers import file_size
+from lib.helpers import read_json
+from lib.helpers import sample_sheet_from_s3_prefix
+from lib.result_cache import parse_bytes
+
+# Cost model for each row of data, used to size a job (memory, scratch disk,
+# wall time). Every value was measured by building tests/data (4 samples,
+# 173,936 abundance rows for 98,899 distinct genes, 50,451 genes in 1,823
+# CAGs, 92,940 taxonomic assignments) on a single core with pandas 2.0 and
+# PyTables 3.11: memory with `object_size` (and tracemalloc for transient
+# peaks), disk as the size of each table written to its own HDF5 before and
+# after repacking with GZIP=7, and time from the build log. That build
+# peaked at 385MB RSS, took 14s, and wrote a 12.9MB collection. Values are
+# rounded up, so that estimates err towards a larger job.
+COST_MODEL = {
+    # Memory of the Python interpreter with pandas, numpy and PyTables loaded
+    "base_memory_bytes": 80000000,
+    # One gene in a sample: as parsed from the JSON (a dict per gene, ~24x the
+    # gzipped file), and as a row of the formatted DataFrame
+    "abundance_row_parsed_bytes": 810,
+    "abundance_row_memory_bytes": 210,
+    # One distinct gene (or CAG) in the running AbundanceSummary (the arrays,
+    # plus its entry in the dict and list of IDs), and in the summary table
+    # made from it when it is written
+    "summary_id_memory_bytes": 385,
+    "summary_id_frame_bytes": 172,
+    # One abundance row (or summary row) in the HDF5, before and after repacking
+    "abundance_row_disk_bytes": 153,
+    "abundance_row_packed_bytes": 34,
+    "summary_id_disk_bytes": 170,
+    "summary_id_packed_bytes": 53,
+    # One gene in the CAGs: the dict of lists kept through the abundance
+    # stage, the transient peak while the tables and index are made, and
+    # on disk (the table and the CSR index)
+    "cag_dict_bytes_per_gene": 90,
+    "cag_build_bytes_per_gene": 520,
+    "cag_row_disk_bytes": 94,
+    "cag_row_packed_bytes": 13,
+    "genes_per_cag": 27,
+    # One row of an annotation table (taxonomy or eggNOG), at its peak while
+    # parsing, and on disk
+    "annotation_row_memory_bytes": 220,
+    "annotation_row_disk_bytes": 47,
+    "annotation_row_packed_bytes": 10,
+    # One hash in a MinHash sketch (one per `sketch_scaled` genes)
+    "sketch_hash_bytes": 8,
+    # Throughput of each stage: parsing, normalizing, summarizing and
+    # sketching each sample, appending the abundance tables, writing the
+    # summary tables, parsing and writing an annotation table, and reading
+    # and writing the CAGs
+    "abundance_rows_per_second": 35000,
+    "abundance_write_rows_per_second": 70000,
+    "summary_ids_per_second": 80000,
+    "annotation_rows_per_second": 120000,
+    "cag_genes_per_second": 70000,
+    # Bytes of the CAG JSON per gene listed, gzipped or not
+    "cag_json_bytes_per_gene": 31.5,
+    "cag_json_gz_bytes_per_gene": 3.8,
+    # Bytes per line of an annotation table, and the fraction remaining
+    # after gzip (only used for S3 files, which are not read)
+    "text_line_bytes": 40,
+    "gzip_ratio": 0.2,
+    # The NCBI taxonomy, loaded by the worker which formats the taxonomic
+    # classification (a dict per taxid with its names, rank and parent, and
+    # the preorder intervals), per byte of names.dmp and nodes.dmp, and the
+    # rate at which they are read. tests/data has no taxonomy, so these were
+    # measured on a synthetic one with 200,000 nodes and 300,000 names.
+    "ncbi_memory_bytes_per_dmp_byte": 6.2,
+    "ncbi_dmp_bytes_per_second": 10000000,
+    # Contig synteny, also measured on a synthetic integrated assembly
+    # (200,000 genes on 20,000 contigs): the peak memory for each gene, and
+    # for each row of the join of contigs on their shared clusters (the sum
+    # of the squared number of contigs with each cluster), the rate of each,
+    # and one gene position (as copied for the worker) and one row of the
+    # synteny table on disk
+    "synteny_row_memory_bytes": 550,
+    "synteny_pair_memory_bytes": 170,
+    "synteny_rows_per_second": 18000,
+    "synteny_pairs_per_second": 350000,
+    "gene_position_row_disk_bytes": 60,
+    "synteny_row_disk_bytes": 52,
+    "synteny_row_packed_bytes": 10,
+    # Buffer used by PyTables to copy a table between files, whatever its size
+    "hdf5_copy_buffer_bytes": 34000000,
+    # Repacking throughput, in bytes (before repacking) per second. This was
+    # measured with ptrepack, and h5repack is usually faster.
+    "repack_bytes_per_second": 10000000,
+}
+
+
+def estimate_rows(fp, n_lines=10000):
+    """
+
+    Estimate the number of lines in a (possibly gzipped) text file.
+
+    For local files, the first `n_lines` lines are read to measure the number
+    of (compressed) bytes per line. S3 files are estimated from their size.
+
+    """
+    size = file_size(fp)
+
+    if fp.startswith("s3://"):
+        bytes_per_line = COST_MODEL["text_line_bytes"] * (COST_MODEL["gzip_ratio"] if fp.endswith(".gz") else 1)
+        return int(size / bytes_per_line)
+
+    with open(fp, "rb") as raw:
+        handle = gzip.GzipFile(fileobj=raw) if fp.endswith(".gz") else raw
+        n_read = 0
+        for _ in handle:
+            n_read += 1
+            if n_read >= n_lines:
+                break
+        # Position in the (compressed) file after reading those lines
+        bytes_read = raw.tell()
+
+    if n_read < n_lines or bytes_read == 0:
+        return n_read
+
+    return int(size * n_read / bytes_read)
+
+
+def count_synteny_pairs(fp, max_cluster_contigs=None):
+    """
+
+    Measure the work of comparing the contigs in a local integrated assembly.
+
+    Only the contig and cluster of each gene position are read. Returns the
+    number of gene positions, the number of rows in the join of contigs on
+    their shared clusters (ignoring clusters on more than
+    `max_cluster_contigs` contigs, as `contig_synteny` does), and the
+    average number of clusters on each contig.
+
+    """
+    with pd.HDFStore(fp, mode="r") as store:
+        assert "gene_positions" in store, "gene_positions not found in " + fp
+        if store.get_storer("gene_positions").is_table:
+            df = store.select("gene_positions", columns=["seqname", "cluster"])
+        else:
+            df = store["gene_positions"].reindex(columns=["seqname", "cluster"])
+
+    first = df.drop_duplicates()
+    cluster_contigs = first.groupby("cluster").size()
+    if max_cluster_contigs is not None:
+        cluster_contigs = cluster_contigs.loc[cluster_contigs <= max_cluster_contigs]
+
+    return (
+        df.shape[0],
+        int((cluster_contigs ** 2).sum()),
+        first.shape[0] / max(1, first["seqname"].nunique())
+    )
+
+
+def available_memory():
+    """Return the total physical memory of this machine, in bytes (or None)."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_build(
+    abundance_sample_sheet=None,
+    abundance_s3_prefix=None,
+    cags_json=None,
+    metadata_table=None,
+    taxonomic_classification_tsv=None,
+    eggnog_mapper_tsv=None,
+    integrated_assembly=None,
+    link_integrated_assembly=False,
+    ncbi_names_dmp=None,
+    ncbi_nodes_dmp=None,
+    skip_contig_synteny=False,
+    synteny_min_prop=0.5,
+    synteny_max_cluster_contigs=1000,
+    write_batch_rows=None,
+    prefetch_depth=4,
+    prefetch_memory="2GB",
+    sketch_scaled=1000,
+    n_sampled_samples=3,
+    **kwargs
+):
+    """
+
+    Inspect the inputs for a build, and estimate the resources it will need.
+
+    Only the sample sheet (and the listing of `abundance_s3_prefix`), the
+    first `n_sampled_samples` abundance files, and the contigs and clusters
+    of a local integrated assembly are read in full; every other input is
+    measured by its size, and by the first lines of text. The
+    number of distinct genes is extrapolated from the number of new genes
+    in the last sampled file. Returns a dict with the estimates for each
+    stage, the totals, and recommended settings.
+
+    """
+
+    stages = {}
+    m = COST_MODEL
+
+    # Batch the abundance writes to use no more than ~10% of the memory
+    memory = available_memory()
+    if memory is not None:
+        recommended_batch_rows = int(max(100000, min(
+            20000000,
+            0.1 * memory / m["abundance_row_memory_bytes"]
+        )))
+    else:
+        recommended_batch_rows = 5000000
+    if write_batch_rows is None:
+        write_batch_rows = recommended_batch_rows
+
+    # The CAGs are kept in memory while the abundances are added
+    cag_memory = 0
+    n_cags = 0
+    if cags_json is not None:
+        n_genes = int(file_size(cags_json) / (
+            m["cag_json_gz_bytes_per_gene"] if cags_json.endswith(".gz") else m["cag_json_bytes_per_gene"]
+        ))
+        n_cags = int(n_genes / m["genes_per_cag"])
+        cag_memory = n_genes * m["cag_dict_bytes_per_gene"]
+        stages["cags"] = {
+            "rows": n_genes,
+            "memory": n_genes * m["cag_build_bytes_per_gene"],
+            "disk": n_genes * m["cag_row_disk_bytes"],
+            "output": n_genes * m["cag_row_packed_bytes"],
+            "seconds": n_genes / m["cag_genes_per_second"],
+        }
+
+    n_samples = 0
+    genes_per_sample = 0
+    if abundance_sample_sheet is not None or abundance_s3_prefix is not None:
+        sample_sheet = {}
+        if abundance_s3_prefix is not None:
+            sample_sheet.update(sample_sheet_from_s3_prefix(abundance_s3_prefix))
+        if abundance_sample_sheet is not None:
+            listed_samples = read_json(abundance_sample_sheet)
+            assert isinstance(listed_samples, dict), "Sample sheet must be a dict"
+            sample_sheet.update(listed_samples)
+        n_samples = len(sample_sheet)
+
+        # Read a few samples to measure the number of genes in each, and
+        # the number of genes not seen in any previous sample
+        sampled_counts = []
+        sampled_ids = set()
+        n_new_ids = 0
+        for sample_fp in list(sample_sheet.values())[:n_sampled_samples]:
+            dat = read_json(sample_fp)
+            if isinstance(dat, dict):
+                dat = dat.get("results", [])
+            sampled_counts.append(len(dat))
+            n_seen = len(sampled_ids)
+            sampled_ids.update(d.get("id") for d in dat if isinstance(d, dict))
+            n_new_ids = len(sampled_ids) - n_seen
+        genes_per_sample = int(sum(sampled_counts) / max(1, len(sampled_counts)))
+
+        n_rows = n_samples * genes_per_sample
+        n_ids = min(
+            n_rows,
+            len(sampled_ids) + max(0, n_samples - len(sampled_counts)) * n_new_ids
+        )
+        n_summary_rows = n_ids + n_cags
+
+        # Parsed samples waiting in the prefetcher, plus the one being added
+        sample_memory = genes_per_sample * m["abundance_row_parsed_bytes"]
+        prefetched_memory = min(parse_bytes(prefetch_memory), prefetch_depth * sample_memory)
+
+        stages["abundance"] = {
+            "rows": n_rows,
+            "memory": prefetched_memory + sample_memory + sum([
+                genes_per_sample * m["abundance_row_memory_bytes"],
+                # The pending batch, and its concatenated copy when written
+                2 * min(n_rows, write_batch_rows) * m["abundance_row_memory_bytes"],
+                n_summary_rows * (m["summary_id_memory_bytes"] + m["summary_id_frame_bytes"]),
+                n_rows * m["sketch_hash_bytes"] / sketch_scaled,
+            ]),
+            "disk": n_rows * m["abundance_row_disk_bytes"] + n_summary_rows * m["summary_id_disk_bytes"],
+            "output": n_rows * m["abundance_row_packed_bytes"] + n_summary_rows * m["summary_id_packed_bytes"],
+            "seconds": sum([
+                n_rows / m["abundance_rows_per_second"],
+                n_rows / m["abundance_write_rows_per_second"],
+                n_summary_rows / m["summary_ids_per_second"],
+            ]),
+        }
+
+    for stage, fp in [
+        ("metadata", metadata_table),
+        ("taxonomic_classification", taxonomic_classification_tsv),
+        ("eggnog", eggnog_mapper_tsv),
+    ]:
+        if fp is None:
+            continue
+        n_rows = estimate_rows(fp)
+        stages[stage] = {
+            "rows": n_rows,
+            "memory": n_rows * m["annotation_row_memory_bytes"],
+            "disk": n_rows * m["annotation_row_disk_bytes"],
+            "output": n_rows * m["annotation_row_packed_bytes"],
+            "seconds": n_rows / m["annotation_rows_per_second"],
+        }
+
+    # The worker which formats the taxonomic classification also loads the
+    # NCBI taxonomy, and writes the interval of every taxid
+    if taxonomic_classification_tsv is not None and ncbi_names_dmp is not None:
+        dmp_bytes = file_size(ncbi_names_dmp) + file_size(ncbi_nodes_dmp)
+        n_taxids = estimate_rows(ncbi_nodes_dmp)
+        stage = stages["taxonomic_classification"]
+        stage["memory"] += dmp_bytes * m["ncbi_memory_bytes_per_dmp_byte"]
+        stage["disk"] += n_taxids * m["annotation_row_disk_bytes"]
+        stage["output"] += n_taxids * m["annotation_row_packed_bytes"]
+        stage["seconds"] += dmp_bytes / m["ncbi_dmp_bytes_per_second"]
+
+    build_synteny = integrated_assembly is not None and not skip_contig_synteny
+
+    if integrated_assembly is not None:
+        size = file_size(integrated_assembly)
+        stages["integrated_assembly"] = {
+            "rows": None,
+            # Copied (or linked) through PyTables, which holds a fixed buffer
+            "memory": m["hdf5_copy_buffer_bytes"],
+            "disk": 0 if link_integrated_assembly else size,
+            "output": 0 if link_integrated_assembly else size,
+            "seconds": 0 if link_integrated_assembly else size / m["repack_bytes_per_second"],
+        }
+
+    if build_synteny:
+        if integrated_assembly.startswith("s3://"):
+            # Without reading the assembly, assume it is all gene positions,
+            # and count only the comparison of each contig to itself
+            n_rows = int(file_size(integrated_assembly) / m["gene_position_row_disk_bytes"])
+            n_pairs = n_rows
+            clusters_per_contig = 1
+        else:
+            n_rows, n_pairs, clusters_per_contig = count_synteny_pairs(
+                integrated_assembly,
+                max_cluster_contigs=synteny_max_cluster_contigs
+            )
+        # A pair of contigs is kept if it shares at least `synteny_min_prop`
+        # of the clusters of the first, and so appears that many times in the
+        # join (less the rows joining each contig to itself)
+        n_synteny_rows = int(max(0, n_pairs - n_rows) / max(1, synteny_min_prop * clusters_per_contig))
+        stages["contig_synteny"] = {
+            "rows": n_synteny_rows,
+            "memory": n_rows * m["synteny_row_memory_bytes"] + n_pairs * m["synteny_pair_memory_bytes"],
+            "disk": n_rows * m["gene_position_row_disk_bytes"] + n_synteny_rows * m["synteny_row_disk_bytes"],
+            "output": n_synteny_rows * m["synteny_row_packed_bytes"],
+            "seconds": n_rows / m["synteny_rows_per_second"] + n_pairs / m["synteny_pairs_per_second"],
+        }
+
+    # The annotation tables (and the contig synteny) are made in parallel
+    # with the abundances, and so they add to the peak memory, but not to
+    # the wall time
+    parallel_stages = ["metadata", "taxonomic_classification", "eggnog", "contig_synteny"]
+    serial_seconds = sum(v["seconds"] for k, v in stages.items() if k not in parallel_stages)
+    parallel_seconds = max([0] + [v["seconds"] for k, v in stages.items() if k in parallel_stages])
+
+    total_disk = sum(v["disk"] for v in stages.values())
+    total_output = sum(v["output"] for v in stages.values())
+
+    peak_memory = m["base_memory_bytes"] + cag_memory + max([0] + [
+        v["memory"] for k, v in stages.items() if k not in parallel_stages
+    ]) + sum(
+        v["memory"] for k, v in stages.items() if k in parallel_stages
+    )
+
+    return {
+        "stages": stages,
+        "n_samples": n_samples,
+        "genes_per_sample": genes_per_sample,
+        "peak_memory": peak_memory,
+        # The repacked copy is written next to the original
+        "temp_disk": total_disk + total_output,
+        "output_size": total_output,
+        "seconds": serial_seconds + max(0, parallel_seconds - serial_seconds) + total_disk / m["repack_bytes_per_second"],
+        "recommended": {
+            "workers": max(1, min(
+                len([k for k in stages if k in parallel_stages]),
+                os.cpu_count() or 1
+            )),
+            "write_batch_rows": recommended_batch_rows,
+        },
+        "available_memory": memory,
+    }
+
+
+def log_estimate(estimate):
+    """Write a readable summary of `estimate_build` to the log."""
+
+    def fmt_bytes(n):
+        for unit in ["B", "KB", "MB", "GB", "TB"]:
+            if abs(n) < 1000 or unit == "TB":
+                return "{:.1f}{}".format(n, unit)
+            n = n / 1000.
+
+    for stage, v in estimate["stages"].items():
+        logging.info("{}: {} rows, memory {}, temp disk {}, output {}, ~{:,.0f}s".format(
+            stage,
+            "?" if v["rows"] is None else "{:,}".format(v["rows"]),
+            fmt_bytes(v["memory"]),
+            fmt_bytes(v["disk"]),
+            fmt_bytes(v["output"]),
+            v["seconds"]
+        ))
+
+    if estimate["n_samples"] > 0:
+        logging.info("Samples: {:,} (~{:,} genes each)".format(
+            estimate["n_samples"], estimate["genes_per_sample"]
+        ))
+    logging.info("Expected peak memory: {}".format(fmt_bytes(estimate["peak_memory"])))
+    if estimate["available_memory"] is not None:
+        logging.info("Available memory: {}".format(fmt_bytes(estimate["available_memory"])))
+    logging.info("Expected temporary disk: {}".format(fmt_bytes(estimate["temp_disk"])))
+    logging.info("Expected output size: {}".format(fmt_bytes(estimate["output_size"])))
+    logging.info("Expected time: ~{:,.0f}s".format(estimate["seconds"]))
+    logging.info("Recommended: --workers {} --write-batch-rows {}".format(
+        estimate["recommended"]["workers"],
+        estimate["recommended"]["write_batch_rows"]
+    ))
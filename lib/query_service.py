@@ -0,0 +1,307 @@
+"""Serve experiment collections over local HTTP, so that warm state is shared between clients."""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import inspect
+import io
+import json
+import logging
+import numpy as np
+import pandas as pd
+import threading
+from urllib.request import Request
+from urllib.request import urlopen
+
+from lib.experiment_collection import ExperimentCollection
+
+# Methods (and attributes) of ExperimentCollection which may be queried remotely.
+# Methods which write to the server's filesystem (e.g. export_abundance_matrix)
+# or return generators (iter_table, iter_gene_abundance) are not served, and
+# any argument which would write to it (see REFUSED_ARGUMENTS) is refused.
+SERVED_METHODS = [
+    "all_samples",
+    "gene_abundance",
+    "sample_gene_abundance",
+    "cag_abundance",
+    "sample_cag_abundance",
+    "top_k",
+    "threshold",
+    "gene_summary",
+    "cag_summary",
+    "filter_genes",
+    "filter_cags",
+    "metadata",
+    "eggnog_annotation",
+    "taxonomic_annotation",
+    "genes_below_taxon",
+    "cag_membership",
+    "cag_of_gene",
+    "cags_of_genes",
+    "genes_in_cag",
+    "contigs_with_gene",
+    "contig_df",
+    "contig_synteny",
+    "sketch_similarity",
+    "nearest_samples",
+    "distance_matrix",
+    "associate",
+    "cache_stats",
+]
+
+# Arguments of the served methods which would write to the server's filesystem
+REFUSED_ARGUMENTS = [
+    "results_fp",
+]
+
+
+def encode_result(result):
+    """
+
+    Encode the result of a query as (content type, bytes).
+
+    DataFrames and Series are sent as a NumPy .npz archive with one array per
+    column, along with the index and column labels. Arrays, and dicts whose
+    values are all DataFrames, Series or arrays (e.g. `sketch_similarity`),
+    are sent the same way. Anything else is sent as JSON.
+
+    """
+
+    if isinstance(result, dict) and len(result) > 0 and all(
+        isinstance(v, (pd.DataFrame, pd.Series, np.ndarray)) for v in result.values()
+    ):
+        arrays = {
+            "kind": np.array("dict"),
+            "keys": np.array([str(k) for k in result.keys()], dtype=str),
+        }
+        for ix, value in enumerate(result.values()):
+            arrays.update(_encode_arrays(value, prefix="item_{}_".format(ix)))
+
+    elif isinstance(result, (pd.DataFrame, pd.Series, np.ndarray)):
+        arrays = _encode_arrays(result)
+
+    else:
+        return "application/json", json.dumps(result, default=_json_default).encode()
+
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return "application/x-npz", buf.getvalue()
+
+
+def _encode_arrays(result, prefix=""):
+    """Convert a DataFrame, Series or array to a dict of arrays, with names starting with `prefix`."""
+
+    if isinstance(result, np.ndarray):
+        arrays = {"kind": np.array("array")}
+        arrays.update(_plain_arrays("values", result))
+
+    else:
+        if isinstance(result, pd.Series):
+            kind = "series"
+            name = "" if result.name is None else str(result.name)
+            result = result.to_frame(name=name)
+        else:
+            kind = "frame"
+            name = ""
+
+        arrays = {
+            "kind": np.array(kind),
+            "name": np.array(name),
+            "index_name": np.array("" if result.index.name is None else str(result.index.name)),
+            "columns": np.array([str(c) for c in result.columns], dtype=str),
+        }
+        arrays.update(_plain_arrays("index", result.index))
+        for ix, col_name in enumerate(result.columns):
+            arrays.update(_plain_arrays("col_{}".format(ix), result.iloc[:, ix]))
+
+    return {prefix + k: v for k, v in arrays.items()}
+
+
+def _plain_arrays(key, values):
+    """
+
+    Convert values to arrays which can be saved without pickling.
+
+    Object values are saved as strings, so any nulls (None or NaN) are
+    recorded in a separate mask (`<key>_null`) rather than as "nan".
+
+    """
+    values = np.asarray(values)
+    if values.dtype != object:
+        return {key: values}
+
+    null = pd.isnull(values)
+    return {
+        key: np.where(null, "", values).astype(str),
+        key + "_null": null,
+    }
+
+
+def _restore_nulls(arrays, key):
+    """Read back an array saved by `_plain_arrays`, with NaN in place of any nulls."""
+    values = arrays[key]
+    if key + "_null" not in arrays.files:
+        return values
+
+    null = arrays[key + "_null"]
+    values = values.astype(object)
+    values[null] = np.nan
+    return values
+
+
+def _json_default(value):
+    """Convert NumPy scalars and arrays (e.g. inside a list) for JSON."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Cannot encode {} as JSON".format(type(value).__name__))
+
+
+def decode_result(content_type, content):
+    """Decode the bytes produced by `encode_result`."""
+
+    if content_type != "application/x-npz":
+        return json.loads(content.decode())
+
+    with np.load(io.BytesIO(content), allow_pickle=False) as arrays:
+        if str(arrays["kind"]) == "dict":
+            return {
+                str(key): _decode_arrays(arrays, prefix="item_{}_".format(ix))
+                for ix, key in enumerate(arrays["keys"])
+            }
+
+        return _decode_arrays(arrays)
+
+
+def _decode_arrays(arrays, prefix=""):
+    """Rebuild the DataFrame, Series or array saved by `_encode_arrays`."""
+
+    kind = str(arrays[prefix + "kind"])
+    if kind == "array":
+        return _restore_nulls(arrays, prefix + "values")
+
+    index = pd.Index(
+        _restore_nulls(arrays, prefix + "index"),
+        name=str(arrays[prefix + "index_name"]) or None
+    )
+    df = pd.DataFrame(
+        {
+            col_name: _restore_nulls(arrays, prefix + "col_{}".format(ix))
+            for ix, col_name in enumerate(arrays[prefix + "columns"])
+        },
+        index=index
+    )
+    if kind == "series":
+        df = df.iloc[:, 0]
+        df.name = str(arrays[prefix + "name"]) or None
+
+    return df
+
+
+def make_handler(collections, locks):
+    """Make a request handler class for a dict of ExperimentCollection objects."""
+
+    class QueryHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            """Answer a query sent to /<collection>/<method>, with a JSON body of args and kwargs."""
+            try:
+                collection_name, method_name = self.path.strip("/").split("/", 1)
+                assert collection_name in collections, "Collection not found: " + collection_name
+                assert method_name in SERVED_METHODS, "Method not available: " + method_name
+
+                length = int(self.headers.get("Content-Length", 0))
+                query = json.loads(self.rfile.read(length).decode()) if length > 0 else {}
+
+                args = query.get("args", [])
+                kwargs = query.get("kwargs", {})
+
+                # PyTables is not thread-safe, so only one query runs against each file at a time
+                with locks[collection_name]:
+                    result = getattr(collections[collection_name], method_name)
+                    if callable(result):
+                        arguments = inspect.signature(result).bind(*args, **kwargs).arguments
+                        for arg_name in REFUSED_ARGUMENTS:
+                            assert arguments.get(arg_name) is None, \
+                                "Argument not available: " + arg_name
+                        result = result(*args, **kwargs)
+
+                content_type, content = encode_result(result)
+                self.send_response(200)
+
+            except Exception as e:
+                logging.info("Failed query {}: {}".format(self.path, e))
+                content_type, content = "application/json", json.dumps(str(e)).encode()
+                self.send_response(400)
+
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            logging.info(format % args)
+
+    return QueryHandler
+
+
+def serve(collection_paths, host="127.0.0.1", port=8765, **kwargs):
+    """
+
+    Keep a set of experiment collections open and answer queries over HTTP.
+
+    `collection_paths` is a dict of names and file paths. Any other keyword
+    arguments are passed to ExperimentCollection (e.g. `cache_bytes`).
+
+    """
+
+    collections = {
+        collection_name: ExperimentCollection(fp, **kwargs)
+        for collection_name, fp in collection_paths.items()
+    }
+    locks = {collection_name: threading.Lock() for collection_name in collections}
+
+    server = ThreadingHTTPServer((host, port), make_handler(collections, locks))
+    logging.info("Serving {} on http://{}:{}".format(
+        ", ".join(collections.keys()), host, port
+    ))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class ExperimentCollectionClient:
+    """Mirror of the ExperimentCollection API, answered by a running query service."""
+
+    def __init__(self, collection_name, url="http://127.0.0.1:8765"):
+        self.collection_name = collection_name
+        self.url = url.rstrip("/")
+
+    def _query(self, method_name, *args, **kwargs):
+        request = Request(
+            "{}/{}/{}".format(self.url, self.collection_name, method_name),
+            data=json.dumps({"args": args, "kwargs": kwargs}).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        with urlopen(request) as response:
+            return decode_result(
+                response.headers.get("Content-Type"),
+                response.read()
+            )
+
+    @property
+    def all_samples(self):
+        return self._query("all_samples")
+
+    def __getattr__(self, method_name):
+        if method_name not in SERVED_METHODS:
+            raise AttributeError(method_name)
+
+        def method(*args, **kwargs):
+            return self._query(method_name, *args, **kwargs)
+
+        method.__name__ = method_name
+        return method
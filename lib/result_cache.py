@@ -0,0 +1,376 @@
+"""Per-instance, byte-budgeted LRU cache for the experiment collection reader."""
+
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import shutil
+import sys
+
+
+def parse_bytes(n):
+    """Parse a number of bytes, which may be a string like '2GB' or '512MB'."""
+    if n is None:
+        return None
+
+    if isinstance(n, (int, float)):
+        return int(n)
+
+    assert isinstance(n, str), "Cannot parse a number of bytes from {}".format(n)
+
+    n = n.strip().upper().replace(" ", "")
+    for suffix, factor in [
+        ("TB", 1e12), ("GB", 1e9), ("MB", 1e6), ("KB", 1e3), ("B", 1)
+    ]:
+        if n.endswith(suffix):
+            return int(float(n[:-len(suffix)]) * factor)
+
+    return int(float(n))
+
+
+def object_size(obj):
+    """Estimate the number of bytes held in memory by a cached object."""
+    # pandas objects (and anything else which can report its own size)
+    if hasattr(obj, "memory_usage"):
+        try:
+            size = obj.memory_usage(deep=True, index=True)
+        except TypeError:
+            size = obj.memory_usage(deep=True)
+        # DataFrames return a Series of sizes, one per column
+        if hasattr(size, "sum"):
+            size = size.sum()
+        return int(size)
+
+    # numpy arrays
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            object_size(k) + object_size(v)
+            for k, v in obj.items()
+        )
+
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(object_size(v) for v in obj)
+
+    return sys.getsizeof(obj)
+
+
+class ResultCache:
+    """LRU cache which is bounded by the total size (in bytes) of its values."""
+
+    def __init__(self, max_bytes="2GB"):
+        # None means that there is no limit to the size of the cache
+        self.max_bytes = parse_bytes(max_bytes)
+
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return a tuple of (found, value), marking the entry as recently used."""
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, self.entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        """Add a value to the cache, evicting the least recently used entries if needed."""
+        size = object_size(value)
+
+        # Replace any existing entry with the same key
+        if key in self.entries:
+            self.remove(key)
+
+        # Values which could never fit in the cache are not stored
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.current_bytes += size
+
+        while self.max_bytes is not None and self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self.remove(oldest_key)
+            self.evictions += 1
+
+    def remove(self, key):
+        """Remove a single entry from the cache."""
+        del self.entries[key]
+        self.current_bytes -= self.sizes.pop(key)
+
+    def invalidate(self, method_name=None):
+        """Remove all entries, or only those produced by a single method."""
+        if method_name is None:
+            self.entries.clear()
+            self.sizes.clear()
+            self.current_bytes = 0
+            return
+
+        for key in [k for k in self.entries if k[0] == method_name]:
+            self.remove(key)
+
+    def stats(self):
+        """Return a dict summarizing the usage of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "current_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def cache_key(method_name, *args, **kwargs):
+    """Key used to store the result of calling a method with a set of arguments."""
+    return (
+        method_name,
+        tuple(hashable_argument(v) for v in args),
+        tuple(sorted((k, hashable_argument(v)) for k, v in kwargs.items()))
+    )
+
+
+def hashable_argument(value):
+    """Convert an argument to an equivalent value which can be part of a key (e.g. a list to a tuple)."""
+    if isinstance(value, (str, bytes)):
+        return value
+
+    if isinstance(value, dict):
+        return tuple(sorted(
+            ((k, hashable_argument(v)) for k, v in value.items()),
+            key=repr
+        ))
+
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted((hashable_argument(v) for v in value), key=repr))
+
+    # numpy arrays, pandas Index and Series, and numpy scalars
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable_argument(v) for v in value)
+
+    return value
+
+
+def method_cache_key(func, instance, *args, **kwargs):
+    """
+
+    Key used to store the result of calling `func` on `instance` with a set of arguments.
+
+    The arguments are bound to the signature of `func` with every default
+    filled in, so that a call which spells out the defaults has the same key
+    as one which leaves them out. If the instance has a
+    `_normalize_cache_arguments` method, it is given the chance to fill in
+    any other defaults (e.g. those which depend on the instance).
+
+    """
+    bound = inspect.signature(func).bind(instance, *args, **kwargs)
+    bound.apply_defaults()
+
+    arguments = dict(bound.arguments)
+    arguments.pop(next(iter(arguments)))
+
+    normalize = getattr(instance, "_normalize_cache_arguments", None)
+    if normalize is not None:
+        arguments = normalize(arguments)
+
+    return cache_key(func.__name__, **arguments)
+
+
+def cached_method(func):
+    """Decorate a method so that its results are kept in `self.cache` (a ResultCache)."""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = method_cache_key(func, self, *args, **kwargs)
+
+        found, value = self.cache.get(key)
+        if found:
+            return value
+
+        value = func(self, *args, **kwargs)
+        self.cache.put(key, value)
+        return value
+
+    return wrapper
+
+
+def file_fingerprint(fp, block_size=1000000):
+    """Fingerprint a file from its size, modification time, and its first and last blocks."""
+    stat = os.stat(fp)
+    h = hashlib.sha1("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(fp, "rb") as handle:
+        h.update(handle.read(block_size))
+        if stat.st_size > block_size:
+            handle.seek(max(block_size, stat.st_size - block_size))
+            h.update(handle.read(block_size))
+    return h.hexdigest()
+
+
+def split_link_target(target):
+    """
+
+    Split the target of an HDF5 external link into its (file, node path).
+
+    Targets are formatted as <file>:<node path>. As in PyTables, they are
+    split at the ":/" which starts the node path, taking the last one, so
+    that the file may itself contain a ":" (e.g. a drive letter).
+
+    """
+    assert ":/" in target, "Not an external link target: " + target
+    target_fp, node_path = target.rsplit(":/", 1)
+    return target_fp, "/" + node_path
+
+
+def linked_files(fp):
+    """Return the files which the top-level external links of the HDF5 at `fp` point to."""
+    import tables
+
+    if not tables.is_hdf5_file(fp):
+        return []
+
+    linked_fps = set()
+    with tables.open_file(fp, mode="r") as h5:
+        for node in h5.root._f_iter_nodes():
+            if isinstance(node, tables.link.ExternalLink):
+                linked_fp, _ = split_link_target(node.target)
+                linked_fps.add(os.path.join(os.path.dirname(os.path.abspath(fp)), linked_fp))
+
+    return sorted(linked_fps)
+
+
+def collection_fingerprint(fp):
+    """Fingerprint an HDF5 file together with every file which it links to."""
+    h = hashlib.sha1(file_fingerprint(fp).encode())
+    for linked_fp in linked_files(fp):
+        h.update(linked_fp.encode())
+        h.update((file_fingerprint(linked_fp) if os.path.exists(linked_fp) else "missing").encode())
+    return h.hexdigest()
+
+
+class SidecarCache:
+    """
+
+    Folder of derived results which persists between sessions.
+
+    Every entry is tied to the fingerprint of the source file (and of any
+    files it links to), and is kept in a subfolder named for that
+    fingerprint, so that several collections can share one folder. When the
+    source changes, only the subfolders left by earlier versions of that
+    same source are removed.
+
+    """
+
+    def __init__(self, source_fp, folder=None):
+        self.source_fp = source_fp
+        self.root_folder = source_fp + ".cache" if folder is None else folder
+        self.fingerprint = collection_fingerprint(source_fp)
+        self.folder = os.path.join(self.root_folder, self.fingerprint)
+
+        source = os.path.abspath(source_fp)
+
+        # Remove any results computed from a previous version of the source
+        if os.path.exists(self.root_folder):
+            for fn in os.listdir(self.root_folder):
+                previous = self._read_manifest(os.path.join(self.root_folder, fn))
+                if previous is None or fn == self.fingerprint:
+                    continue
+                if previous.get("source") == source:
+                    logging.info("{} has changed, clearing {}".format(
+                        source_fp, os.path.join(self.root_folder, fn)
+                    ))
+                    shutil.rmtree(os.path.join(self.root_folder, fn))
+
+        fingerprint_fp = os.path.join(self.folder, "fingerprint.json")
+        if not os.path.exists(fingerprint_fp):
+            os.makedirs(self.folder, exist_ok=True)
+            with open(fingerprint_fp, "wt") as handle:
+                json.dump({"source": source, "fingerprint": self.fingerprint}, handle)
+
+    @staticmethod
+    def _read_manifest(folder):
+        """Return the source and fingerprint recorded in a subfolder (or None)."""
+        fingerprint_fp = os.path.join(folder, "fingerprint.json")
+        if not os.path.isfile(fingerprint_fp):
+            return None
+
+        try:
+            with open(fingerprint_fp, "rt") as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.folder, "{}.{}.pkl".format(key[0], digest))
+
+    def get(self, key):
+        """Return a tuple of (found, value)."""
+        fp = self._path(key)
+        if not os.path.exists(fp):
+            return False, None
+
+        with open(fp, "rb") as handle:
+            return True, pickle.load(handle)
+
+    def put(self, key, value):
+        """Save a value, logging (but otherwise ignoring) any failure to write."""
+        fp = self._path(key)
+        temp_fp = fp + ".tmp"
+        try:
+            with open(temp_fp, "wb") as handle:
+                pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_fp, fp)
+        except OSError as e:
+            logging.info("Could not write to the sidecar cache: {}".format(e))
+
+    def invalidate(self, method_name=None):
+        """Remove all entries, or only those produced by a single method."""
+        for fn in os.listdir(self.folder):
+            if not fn.endswith(".pkl"):
+                continue
+            if method_name is None or fn.startswith(method_name + "."):
+                os.remove(os.path.join(self.folder, fn))
+
+
+def persisted_method(func):
+    """Decorate a method so that its results are saved in `self.sidecar` (a SidecarCache), if set."""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.sidecar is None:
+            return func(self, *args, **kwargs)
+
+        key = method_cache_key(func, self, *args, **kwargs)
+
+        found, value = self.sidecar.get(key)
+        if found:
+            return value
+
+        value = func(self, *args, **kwargs)
+        self.sidecar.put(key, value)
+        return value
+
+    return wrapper
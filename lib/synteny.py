@@ -0,0 +1,118 @@
+"""Compare the order and orientation of shared clusters between contigs."""
+
+import numpy as np
+import pandas as pd
+
+
+def contig_synteny(gene_positions, min_prop=0.5, contigs=None, max_cluster_contigs=None):
+    """
+
+    Find every pair of contigs which share at least `min_prop` of their clusters.
+
+    `gene_positions` has one row per gene, with its `seqname` (contig),
+    `cluster`, `start` and `end`. Each row of the result describes another
+    contig (`other_contig`) relative to `contig`:
+
+        shared_prop: proportion of the clusters in `contig` also in `other_contig`
+        reverse: `other_contig` is in the opposite orientation, i.e. the median
+            change in offset between adjacent shared genes is not zero
+        offset: average offset of the shared genes (after any reversal), which
+            is subtracted from the coordinates of `other_contig` to align it
+
+    If `contigs` is provided, only those contigs are used as `contig`.
+
+    Comparing every pair of contigs with a cluster grows with the square of
+    the number of contigs it is found on, so clusters found on more than
+    `max_cluster_contigs` contigs (e.g. mobile elements) are ignored.
+
+    """
+
+    df = gene_positions.reindex(columns=["seqname", "cluster", "start", "end"]).copy()
+    for k in ["start", "end"]:
+        df[k] = df[k].astype(int)
+
+    if max_cluster_contigs is not None:
+        cluster_contigs = df.groupby("cluster")["seqname"].nunique()
+        df = df.loc[df["cluster"].isin(
+            cluster_contigs.index.values[cluster_contigs.values <= max_cluster_contigs]
+        )]
+
+    # Position of each cluster on each contig (the first, if it is repeated)
+    first = df.sort_values(by="start").drop_duplicates(subset=["seqname", "cluster"])
+
+    # Count the clusters shared by every pair of contigs
+    central = first if contigs is None else first.loc[first["seqname"].isin(contigs)]
+    pairs = central[["seqname", "cluster"]].merge(
+        first[["seqname", "cluster"]].rename(columns={"seqname": "other_contig"}),
+        on="cluster"
+    )
+    pairs = pairs.loc[pairs["seqname"] != pairs["other_contig"]]
+
+    keys = ["seqname", "other_contig"]
+    n_shared = pairs.groupby(keys).size()
+    n_clusters = central.groupby("seqname").size()
+    shared_prop = n_shared / n_clusters.reindex(n_shared.index.get_level_values(0)).values
+    shared_prop = shared_prop.loc[shared_prop >= min_prop]
+
+    columns = ["contig", "other_contig", "shared_prop", "reverse", "offset"]
+    if shared_prop.shape[0] == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Every gene on the other contig which is in a cluster on the central contig
+    genes = shared_prop.reset_index()[keys].merge(
+        df.rename(columns={"seqname": "other_contig"}),
+        on="other_contig"
+    ).merge(
+        first[["seqname", "cluster", "start"]].rename(columns={"start": "central_start"}),
+        on=["seqname", "cluster"]
+    )
+    genes["offset"] = genes["start"] - genes["central_start"]
+    genes.sort_values(by=keys + ["start"], inplace=True)
+
+    # Compare the offset of each gene to the next one along the other contig
+    genes["marginal_offset"] = genes["offset"] - genes.groupby(keys)["offset"].shift(-1)
+    reverse = genes.groupby(keys)["marginal_offset"].median().abs() >= 1.
+
+    # Flip the coordinates of the reversed contigs, and average the offsets
+    genes = genes.merge(reverse.rename("reverse").reset_index(), on=keys)
+    genes["offset"] = np.where(
+        genes["reverse"],
+        -1 * genes["end"] - genes["central_start"],
+        genes["offset"]
+    )
+
+    synteny_df = pd.DataFrame({
+        "shared_prop": shared_prop,
+        "reverse": reverse,
+        "offset": genes.groupby(keys)["offset"].mean(),
+    }).reset_index().rename(columns={"seqname": "contig"})
+
+    return synteny_df.sort_values(
+        by=["contig", "shared_prop"],
+        ascending=[True, False]
+    ).reset_index(drop=True).reindex(columns=columns)
+
+
+def contig_synteny_tables(gene_positions_fp, min_prop=0.5, max_cluster_contigs=1000):
+    """Make the `contig_synteny` table for the builder, from the `gene_positions` table in an HDF5 file."""
+    with pd.HDFStore(gene_positions_fp, mode="r") as store:
+        # Only the columns which are needed are read, if the table allows it
+        if store.get_storer("gene_positions").is_table:
+            gene_positions = store.select(
+                "gene_positions",
+                columns=["seqname", "cluster", "start", "end"]
+            )
+        else:
+            gene_positions = store["gene_positions"]
+
+    synteny_df = contig_synteny(
+        gene_positions,
+        min_prop=min_prop,
+        max_cluster_contigs=max_cluster_contigs
+    )
+
+    # An empty table is not written
+    if synteny_df.shape[0] == 0:
+        return {}
+
+    return {"contig_synteny": synteny_df}
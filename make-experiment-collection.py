@@ -2,22 +2,14 @@
 """Collect all available information about a microbiome metagenomic WGS experiment."""
 
 import argparse
-import boto3
 import logging
 import os
-import pandas as pd
 import shutil
 import sys
 import uuid
-from lib.helpers import exit_and_clean_up
-from lib.helpers import read_json
-from lib.helpers import add_abundance_to_store
-from lib.helpers import add_cags_to_store
-from lib.helpers import add_table_to_store
-from lib.helpers import format_eggnog_cluster_df
-from lib.helpers import format_eggnog_ko_df
-# from lib.helpers import format_eggnog_go_df
-from lib.helpers import repack_hdf5
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from lib.result_cache import parse_bytes
 
 
 def make_experiment_collection(
@@ -30,21 +22,126 @@ def make_experiment_collection(
     taxonomic_classification_tsv=None,
     eggnog_mapper_tsv=None,
     integrated_assembly=None,
-    temp_folder=None
+    temp_folder=None,
+    normalizations="clr",
+    clr_pseudocount=0,
+    link_integrated_assembly=False,
+    workers=3,
+    work_folder=None,
+    resume=False,
+    write_batch_rows=5000000,
+    gene_id_width=64,
+    ncbi_names_dmp=None,
+    ncbi_nodes_dmp=None,
+    ncbi_merged_dmp=None,
+    sketch_scaled=1000,
+    abundance_s3_prefix=None,
+    prefetch_depth=4,
+    prefetch_memory="2GB",
+    synteny_min_prop=0.5,
+    synteny_max_cluster_contigs=1000,
+    skip_contig_synteny=False,
+    dry_run=False
 ):
 
+    # The NCBI taxonomy needs both the names and the nodes
+    assert (ncbi_names_dmp is None) == (ncbi_nodes_dmp is None), \
+        "Specify both --ncbi-names-dmp and --ncbi-nodes-dmp"
+
+    # Linked tables are read from the path of the integrated assembly on this
+    # machine, which would not resolve for a collection uploaded elsewhere
+    assert not (link_integrated_assembly and output_hdf5.startswith("s3://")), \
+        "--link-integrated-assembly requires a local --output-hdf5"
+
     # Make sure the temporary folder exists
     assert os.path.exists(temp_folder)
 
     # Make sure that at least one of the pieces of data has been specified
     assert any([x is not None for x in [
-        abundance_sample_sheet, cags_json, metadata_table, taxonomic_classification_tsv,
-        eggnog_mapper_tsv, integrated_assembly
+        abundance_sample_sheet, abundance_s3_prefix, cags_json, metadata_table,
+        taxonomic_classification_tsv, eggnog_mapper_tsv, integrated_assembly
     ]]), "No input data has been specified"
 
-    # Make a new temp folder
-    temp_folder = os.path.join(temp_folder, str(uuid.uuid4())[:8])
-    os.mkdir(temp_folder)
+    # Only report the resources which the build is expected to need
+    if dry_run:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s %(levelname)-8s [collect-experiment] %(message)s'
+        )
+        logging.info("Dry run: estimating the resources needed for this build")
+        from lib.preflight import estimate_build
+        from lib.preflight import log_estimate
+        log_estimate(estimate_build(
+            abundance_sample_sheet=abundance_sample_sheet,
+            abundance_s3_prefix=abundance_s3_prefix,
+            cags_json=cags_json,
+            metadata_table=metadata_table,
+            taxonomic_classification_tsv=taxonomic_classification_tsv,
+            eggnog_mapper_tsv=eggnog_mapper_tsv,
+            integrated_assembly=integrated_assembly,
+            link_integrated_assembly=link_integrated_assembly,
+            ncbi_names_dmp=ncbi_names_dmp,
+            ncbi_nodes_dmp=ncbi_nodes_dmp,
+            skip_contig_synteny=skip_contig_synteny,
+            synteny_min_prop=synteny_min_prop,
+            synteny_max_cluster_contigs=synteny_max_cluster_contigs,
+            write_batch_rows=write_batch_rows,
+            prefetch_depth=prefetch_depth,
+            prefetch_memory=prefetch_memory,
+            sketch_scaled=sketch_scaled
+        ))
+        return
+
+    # pandas, PyTables and the helpers built on them are only loaded once
+    # there is a collection to build, so that --help starts quickly
+    import pandas as pd
+    from lib.helpers import exit_and_clean_up
+    from lib.helpers import read_json
+    from lib.helpers import add_abundance_to_store
+    from lib.helpers import add_sample_list_to_store
+    from lib.helpers import add_external_links
+    from lib.helpers import add_sketches_to_store
+    from lib.helpers import add_summary_to_store
+    from lib.helpers import AbundanceSummary
+    from lib.helpers import AbundanceWriteBuffer
+    from lib.helpers import add_cags_to_store
+    from lib.helpers import BuildCheckpoint
+    from lib.helpers import copy_hdf5_node
+    from lib.helpers import read_cags
+    from lib.helpers import format_eggnog_cluster_df
+    from lib.helpers import format_eggnog_ko_df
+    from lib.helpers import format_metadata_df
+    from lib.helpers import format_taxonomic_classification_df
+    from lib.helpers import format_taxonomy_intervals_df
+    from lib.helpers import minhash_sketch
+    from lib.helpers import read_tables_for_store
+    from lib.helpers import write_tables_to_store
+    # from lib.helpers import format_eggnog_go_df
+    from lib.helpers import repack_hdf5
+    from lib.helpers import s3_client
+    from lib.helpers import sample_sheet_from_s3_prefix
+    from lib.helpers import SamplePrefetcher
+
+    if work_folder is None:
+        assert not resume, "--resume requires --work-folder"
+
+        # Make a new temp folder
+        temp_folder = os.path.join(temp_folder, str(uuid.uuid4())[:8])
+        os.mkdir(temp_folder)
+        keep_work_folder = False
+    else:
+        # Use a persistent work folder, which is kept if the build fails
+        temp_folder = work_folder
+        if resume:
+            assert os.path.exists(temp_folder), "Work folder not found: " + temp_folder
+        else:
+            assert not os.path.exists(os.path.join(temp_folder, "checkpoint.json")), \
+                "Work folder contains a previous build, use --resume to continue it"
+            os.makedirs(temp_folder, exist_ok=True)
+        keep_work_folder = True
+
+    # Record each stage and sample as it is written
+    checkpoint = BuildCheckpoint(temp_folder)
 
     # Set up logging
     log_fp = os.path.join(temp_folder, "log.txt")
@@ -63,127 +160,342 @@ def make_experiment_collection(
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
 
-    # Open a connection to AWS S3
-    s3 = boto3.resource('s3')
+    # The tables which do not depend on the abundance data are parsed in worker
+    # processes while the samples are ingested. Only this process writes to the
+    # HDF5, so every table is passed back here and written in turn.
+    executor = ProcessPoolExecutor(max_workers=max(1, workers))
+    pending_tables = []
+
+    if metadata_table is not None and not checkpoint.stage_done("metadata"):
+        logging.info("Reading in the metadata table")
+        pending_tables.append((
+            "metadata",
+            executor.submit(
+                read_tables_for_store,
+                metadata_table,
+                {"metadata": format_metadata_df},
+                sep=metadata_field_sep
+            ),
+            None
+        ))
+
+    if taxonomic_classification_tsv is not None and not checkpoint.stage_done("taxonomic_classification"):
+        logging.info("Reading in the taxonomic classification table")
+
+        # With the NCBI taxonomy, number each taxid so that subtrees are ranges
+        if ncbi_names_dmp is not None:
+            taxonomy_kwargs = dict(
+                names_fp=ncbi_names_dmp,
+                nodes_fp=ncbi_nodes_dmp,
+                merged_fp=ncbi_merged_dmp
+            )
+            taxonomy_tables = {
+                "taxonomic_classification": partial(format_taxonomic_classification_df, **taxonomy_kwargs),
+                "taxonomy_intervals": partial(format_taxonomy_intervals_df, **taxonomy_kwargs),
+            }
+        else:
+            taxonomy_tables = {"taxonomic_classification": format_taxonomic_classification_df}
+
+        pending_tables.append((
+            "taxonomic_classification",
+            executor.submit(
+                read_tables_for_store,
+                taxonomic_classification_tsv,
+                taxonomy_tables,
+                sep="\t",
+                header=None,
+                names=["gene", "taxid", "evalue"]
+            ),
+            ["gene", "tax_order", "taxid"]
+        ))
+
+    if eggnog_mapper_tsv is not None and not checkpoint.stage_done("eggnog"):
+        logging.info("Reading in the eggNOG mapper results")
+        pending_tables.append((
+            "eggnog",
+            executor.submit(
+                read_tables_for_store,
+                eggnog_mapper_tsv,
+                {
+                    "eggnog_ko": format_eggnog_ko_df,
+                    # "eggnog_go": format_eggnog_go_df,
+                    "eggnog_cluster": format_eggnog_cluster_df,
+                },
+                sep="\t",
+                header=3
+            ),
+            ["gene", "ko", "go", "eggnog_cluster"]
+        ))
+
+    def write_finished_tables(store, wait=False):
+        """Write out any tables which have been parsed (waiting for all, if `wait`)."""
+        for stage, future, data_columns in list(pending_tables):
+            if not wait and not future.done():
+                continue
+
+            try:
+                write_tables_to_store(future.result(), store, data_columns=data_columns)
+                store.flush(fsync=True)
+            except:
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+            checkpoint.mark_stage_done(stage)
+            pending_tables.remove((stage, future, data_columns))
 
     # If an integrated assembly HDF5 file was specified, copy it down and add to it
     local_hdf5_fp = os.path.join(temp_folder, "experiment.hdf5")
 
-    if integrated_assembly is not None:
+    if checkpoint.stage_done("integrated_assembly"):
+        logging.info("Integrated assembly was already added, skipping")
+
+    elif integrated_assembly is not None and link_integrated_assembly:
+        logging.info("Linking to the integrated assembly at {}".format(integrated_assembly))
+
+        # The linked tables must be readable from the same filesystem
+        try:
+            assert not integrated_assembly.startswith("s3://"), \
+                "Only a local integrated assembly can be linked"
+            assert os.path.exists(integrated_assembly)
+        except:
+            exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+        integrated_assembly = os.path.abspath(integrated_assembly)
+
+    elif integrated_assembly is not None:
         logging.info("Copying integrated assembly from {}".format(integrated_assembly))
 
         if integrated_assembly.startswith("s3://"):
             bucket, key = integrated_assembly[5:].split("/", 1)
             try:
-                s3.meta.client.download_file(bucket, key, local_hdf5_fp)
+                s3_client().download_file(bucket, key, local_hdf5_fp)
             except:
-                exit_and_clean_up(temp_folder)
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
         else:
             try:
                 assert os.path.exists(integrated_assembly)
             except:
-                exit_and_clean_up(temp_folder)
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
 
             try:
                 shutil.copyfile(integrated_assembly, local_hdf5_fp)
             except:
-                exit_and_clean_up(temp_folder)
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+        checkpoint.mark_stage_done("integrated_assembly")
+
+    # Compare the order of the clusters on every pair of similar contigs
+    if skip_contig_synteny:
+        logging.info("Skipping the contig synteny table")
+
+    elif integrated_assembly is not None and not checkpoint.stage_done("contig_synteny"):
+        from lib.synteny import contig_synteny_tables
+
+        # The gene positions are copied to their own file, which the worker
+        # process reads while this process writes to the collection
+        gene_positions_fp = os.path.join(temp_folder, "gene_positions.hdf5")
+        logging.info("Copying the gene positions to {}".format(gene_positions_fp))
+        try:
+            copy_hdf5_node(
+                integrated_assembly if link_integrated_assembly else local_hdf5_fp,
+                "/gene_positions",
+                gene_positions_fp
+            )
+        except:
+            exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+        pending_tables.append((
+            "contig_synteny",
+            executor.submit(
+                contig_synteny_tables,
+                gene_positions_fp,
+                min_prop=synteny_min_prop,
+                max_cluster_contigs=synteny_max_cluster_contigs
+            ),
+            ["contig", "other_contig"]
+        ))
 
     # Add to that previous HDF5 file, if it exists, otherwise start a new one
     store = pd.HDFStore(local_hdf5_fp, mode="a")
 
-    if cags_json is not None:
+    if cags_json is not None and checkpoint.stage_done("cags"):
+        logging.info("CAGs were already added, reading them in")
+
+        try:
+            cags = read_cags(cags_json)
+        except:
+            exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+    elif cags_json is not None:
         logging.info("Reading in the CAGs and adding to the collection")
 
         try:
             cags = add_cags_to_store(cags_json, store)
+            store.flush(fsync=True)
         except:
-            exit_and_clean_up(temp_folder)
+            exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+        checkpoint.mark_stage_done("cags")
     else:
         cags = None
 
     # Read in the sample_sheet
-    if abundance_sample_sheet is not None:
-        logging.info("Reading in the sample sheet from " + abundance_sample_sheet)
-        try:
-            abundance_sample_sheet = read_json(abundance_sample_sheet)
-        except:
-            exit_and_clean_up(temp_folder)
+    has_abundances = abundance_sample_sheet is not None or abundance_s3_prefix is not None
+    if has_abundances and checkpoint.stage_done("abundance"):
+        logging.info("Sample abundances were already added, skipping")
 
-        try:
-            assert isinstance(abundance_sample_sheet, dict), "Sample sheet must be a dict"
-        except:
-            exit_and_clean_up(temp_folder)
+    elif has_abundances:
+        sample_sheet = {}
+
+        # List every sample under the S3 prefix
+        if abundance_s3_prefix is not None:
+            logging.info("Listing the samples under " + abundance_s3_prefix)
+            try:
+                sample_sheet.update(sample_sheet_from_s3_prefix(abundance_s3_prefix))
+            except:
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+        if abundance_sample_sheet is not None:
+            logging.info("Reading in the sample sheet from " + abundance_sample_sheet)
+            try:
+                abundance_sample_sheet = read_json(abundance_sample_sheet)
+            except:
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+            try:
+                assert isinstance(abundance_sample_sheet, dict), "Sample sheet must be a dict"
+            except:
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+            # Samples in the sample sheet take precedence over those found by listing
+            sample_sheet.update(abundance_sample_sheet)
 
         logging.info("Adding sample abundance data to the collection")
 
-        # Sort the sample names by length
-        # By adding the longest sample name first, we will ensure that there is enough room in the table
-        for sample_name in sorted(list(abundance_sample_sheet.keys()), key=len)[::-1]:
+        # Keep a running summary of every gene and CAG across samples
+        gene_summary = AbundanceSummary("id")
+        cag_summary = AbundanceSummary("cag_id")
 
-            sample_abundance_json_fp = abundance_sample_sheet[sample_name]
+        # Sketch the set of genes detected in each sample
+        sketches = {}
 
+        # Format the sample names
+        sample_list = []
+        for sample_name, sample_abundance_json_fp in sorted(sample_sheet.items()):
             for k in [".", "-"]:
                 sample_name = sample_name.replace(k, "_")
+            sample_list.append((sample_name, sample_abundance_json_fp))
+
+        # Fix the width of each string column up front, so that every sample fits
+        min_itemsize = {
+            "sample": max([1] + [len(sample_name) for sample_name, _ in sample_list]),
+            "id": gene_id_width,
+        }
+        if cags is not None:
+            min_itemsize["id"] = max(
+                [gene_id_width] + [len(gene_id) for gene_id_list in cags.values() for gene_id in gene_id_list]
+            )
+            min_itemsize["cag_id"] = max([len(str(cag_id)) for cag_id in cags])
+
+        # Samples are written to the store in large batches
+        write_buffer = AbundanceWriteBuffer(
+            store,
+            min_itemsize,
+            batch_rows=write_batch_rows
+        )
+
+        def flush_write_buffer():
+            """Write out the pending samples, and record them in the checkpoint."""
+            try:
+                written_samples = write_buffer.flush()
+                store.flush(fsync=True)
+            except:
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+            for sample_name in written_samples:
+                checkpoint.mark_sample_done(sample_name)
+
+        for sample_name, sample_abundance_json_fp in sample_list:
+
+            if checkpoint.sample_done(sample_name):
+                logging.info("{} was already added, reading it back in".format(sample_name))
+
+                # The summary statistics and sketches are rebuilt from the stored values
+                try:
+                    sample_dat = store.select("abundance", where="sample == '{}'".format(sample_name))
+                    gene_summary.add_sample(sample_dat)
+                    sketches[sample_name] = minhash_sketch(sample_dat["id"].values, scaled=sketch_scaled)
+                    if cags is not None:
+                        cag_summary.add_sample(
+                            store.select("cag_abundance", where="sample == '{}'".format(sample_name))
+                        )
+                except:
+                    exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+        # Download the next samples while each one is being added
+        prefetcher = SamplePrefetcher(
+            [
+                (sample_name, sample_abundance_json_fp)
+                for sample_name, sample_abundance_json_fp in sample_list
+                if not checkpoint.sample_done(sample_name)
+            ],
+            depth=prefetch_depth,
+            max_bytes=parse_bytes(prefetch_memory)
+        )
+
+        for sample_name, sample_abundance_json_fp, prefetched_dat in prefetcher:
 
             logging.info("Adding {} from {}".format(sample_name, sample_abundance_json_fp))
 
             try:
-                add_abundance_to_store(sample_name, sample_abundance_json_fp, store, cags)
+                # Remove anything left over from an interrupted attempt at this sample
+                if resume:
+                    for table_name in ["abundance", "cag_abundance"]:
+                        if table_name in store:
+                            store.remove(table_name, where="sample == '{}'".format(sample_name))
+
+                sample_dat, cag_df = add_abundance_to_store(
+                    sample_name,
+                    sample_abundance_json_fp,
+                    store,
+                    cags,
+                    normalizations=normalizations.split(","),
+                    clr_pseudocount=clr_pseudocount,
+                    write_buffer=write_buffer,
+                    sample_dat=prefetched_dat
+                )
+                gene_summary.add_sample(sample_dat)
+                if cag_df is not None:
+                    cag_summary.add_sample(cag_df)
+                sketches[sample_name] = minhash_sketch(sample_dat["id"].values, scaled=sketch_scaled)
             except:
-                exit_and_clean_up(temp_folder)
+                exit_and_clean_up(temp_folder, keep=keep_work_folder)
 
-    if metadata_table is not None:
-        logging.info("Reading in the metadata table and adding to the collection")
+            if write_buffer.is_full():
+                flush_write_buffer()
 
-        try:
-            add_table_to_store(
-                metadata_table,
-                store,
-                {"metadata": lambda df: df},
-                sep=metadata_field_sep
-            )
-        except:
-            exit_and_clean_up(temp_folder)
+            # Write any tables which were parsed in the meantime
+            write_finished_tables(store)
 
-    if taxonomic_classification_tsv is not None:
-        logging.info(
-            "Reading in the taxonomic classification table and adding to the collection")
+        # Write out the last batch of samples
+        flush_write_buffer()
 
+        logging.info("Adding summary statistics to the collection")
         try:
-            add_table_to_store(
-                taxonomic_classification_tsv,
-                store,
-                {
-                    "taxonomic_classification": lambda df: df.loc[df["taxid"] != 0, ["gene", "taxid"]]
-                },
-                sep="\t",
-                header=None,
-                names=["gene", "taxid", "evalue"],
-                data_columns=["gene"]
-            )
+            add_sample_list_to_store([sample_name for sample_name, _ in sample_list], store)
+            add_summary_to_store(gene_summary, store, "gene_summary")
+            if cags is not None:
+                add_summary_to_store(cag_summary, store, "cag_summary")
+            add_sketches_to_store(sketches, store, scaled=sketch_scaled)
+            store.flush(fsync=True)
         except:
-            exit_and_clean_up(temp_folder)
+            exit_and_clean_up(temp_folder, keep=keep_work_folder)
 
-    if eggnog_mapper_tsv is not None:
-        logging.info(
-            "Reading in the eggNOG mapper results and adding to the collection")
+        checkpoint.mark_stage_done("abundance")
 
-        try:
-            add_table_to_store(
-                eggnog_mapper_tsv,
-                store,
-                {
-                    "eggnog_ko": format_eggnog_ko_df,
-                    # "eggnog_go": format_eggnog_go_df,
-                    "eggnog_cluster": format_eggnog_cluster_df,
-                },
-                sep="\t",
-                header=3,
-                data_columns=["gene", "ko", "go", "eggnog_cluster"]
-            )
-        except:
-            exit_and_clean_up(temp_folder)
+    # Add the remaining tables as they finish parsing
+    logging.info("Adding the metadata and annotation tables to the collection")
+    write_finished_tables(store, wait=True)
+    executor.shutdown()
 
     # Close the database
     store.close()
@@ -192,7 +504,14 @@ def make_experiment_collection(
     try:
         repack_hdf5(local_hdf5_fp)
     except:
-        exit_and_clean_up(temp_folder)
+        exit_and_clean_up(temp_folder, keep=keep_work_folder)
+
+    # Point to the tables in the integrated assembly, rather than copying them
+    if integrated_assembly is not None and link_integrated_assembly:
+        try:
+            add_external_links(local_hdf5_fp, integrated_assembly)
+        except:
+            exit_and_clean_up(temp_folder, keep=keep_work_folder)
 
     # Copy the file to the output
     for local_fp, remote_fp in [(local_hdf5_fp, output_hdf5), (log_fp, output_logs)]:
@@ -201,7 +520,7 @@ def make_experiment_collection(
         ))
         if remote_fp.startswith("s3://"):
             bucket, key = remote_fp[5:].split("/", 1)
-            s3.meta.client.upload_file(local_fp, bucket, key)
+            s3_client().upload_file(local_fp, bucket, key)
         else:
             shutil.copyfile(local_fp, remote_fp)
 
@@ -225,6 +544,9 @@ if __name__ == "__main__":
     parser.add_argument("--abundance-sample-sheet",
                         type=str,
                         help="""Location for sample sheet listing abundance files (e.g. FAMLI output) [.json[.gz]].""")
+    parser.add_argument("--abundance-s3-prefix",
+                        type=str,
+                        help="""Add every abundance file [.json[.gz]] found under this S3 prefix, named by its file name.""")
     parser.add_argument("--cags-json",
                         type=str,
                         help="""Location of JSON describing CAG membership for each gene.""")
@@ -238,12 +560,76 @@ if __name__ == "__main__":
     parser.add_argument("--taxonomic-classification-tsv",
                         type=str,
                         help="""Location of TSV with output of DIAMOND taxonomic assignment for each gene.""")
+    parser.add_argument("--ncbi-names-dmp",
+                        type=str,
+                        help="""Location of names.dmp from the NCBI taxonomy, used to index the taxonomic assignments.""")
+    parser.add_argument("--ncbi-nodes-dmp",
+                        type=str,
+                        help="""Location of nodes.dmp from the NCBI taxonomy.""")
+    parser.add_argument("--ncbi-merged-dmp",
+                        type=str,
+                        help="""Location of merged.dmp from the NCBI taxonomy (optional).""")
     parser.add_argument("--eggnog-mapper-tsv",
                         type=str,
                         help="""Location of TSV with output of eggNOG mapper for each gene.""")
     parser.add_argument("--integrated-assembly",
                         type=str,
                         help="""Location of HDF5 with information on the integrated assembly.""")
+    parser.add_argument("--link-integrated-assembly",
+                        action="store_true",
+                        help="""Link to the tables in the (local) integrated assembly instead of copying them (requires a local --output-hdf5).""")
+    parser.add_argument("--normalizations",
+                        type=str,
+                        default="clr",
+                        help="""Comma-separated normalizations to store for each sample (clr, rel_abund, per_kb).""")
+    parser.add_argument("--clr-pseudocount",
+                        type=float,
+                        default=0,
+                        help="""Pseudocount added to each abundance before calculating the CLR.""")
+    parser.add_argument("--write-batch-rows",
+                        type=int,
+                        default=5000000,
+                        help="""Number of abundance rows to collect across samples before each write.""")
+    parser.add_argument("--gene-id-width",
+                        type=int,
+                        default=64,
+                        help="""Minimum number of characters reserved for gene IDs in the abundance table.""")
+    parser.add_argument("--sketch-scaled",
+                        type=int,
+                        default=1000,
+                        help="""Keep 1 in every N gene hashes when sketching the genes in each sample.""")
+    parser.add_argument("--prefetch-depth",
+                        type=int,
+                        default=4,
+                        help="""Number of upcoming abundance files to download while each sample is added.""")
+    parser.add_argument("--prefetch-memory",
+                        type=str,
+                        default="2GB",
+                        help="""Maximum size of the abundance files being downloaded ahead (e.g. 2GB).""")
+    parser.add_argument("--synteny-min-prop",
+                        type=float,
+                        default=0.5,
+                        help="""Minimum proportion of shared clusters for a pair of contigs to be added to the synteny table.""")
+    parser.add_argument("--synteny-max-cluster-contigs",
+                        type=int,
+                        default=1000,
+                        help="""Ignore clusters found on more than this many contigs when comparing contigs.""")
+    parser.add_argument("--skip-contig-synteny",
+                        action="store_true",
+                        help="""Do not build the contig synteny table from the integrated assembly.""")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=3,
+                        help="""Number of processes used to parse the metadata and annotation tables.""")
+    parser.add_argument("--work-folder",
+                        type=str,
+                        help="""Persistent folder for intermediate files, which is kept if the build fails.""")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="""Continue a failed build in --work-folder, skipping the stages and samples already written.""")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="""Inspect the inputs and report the expected memory, disk and time, without building.""")
     parser.add_argument("--temp-folder",
                         type=str,
                         default="/scratch",
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Keep experiment collections loaded and answer queries over local HTTP."""
+
+import argparse
+import logging
+import sys
+from lib.query_service import serve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Keep experiment collections loaded and answer queries over local HTTP."""
+    )
+
+    parser.add_argument("--collection",
+                        type=str,
+                        action="append",
+                        required=True,
+                        help="""Collection to serve, formatted as NAME=PATH (may be repeated).""")
+    parser.add_argument("--host",
+                        type=str,
+                        default="127.0.0.1",
+                        help="""Address to listen on.""")
+    parser.add_argument("--port",
+                        type=int,
+                        default=8765,
+                        help="""Port to listen on.""")
+    parser.add_argument("--cache-bytes",
+                        type=str,
+                        default="2GB",
+                        help="""Size of the table cache kept for each collection.""")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)-8s [serve-collection] %(message)s'
+    )
+
+    collection_paths = {}
+    for collection in args.collection:
+        assert "=" in collection, "Collections must be formatted as NAME=PATH"
+        collection_name, fp = collection.split("=", 1)
+        collection_paths[collection_name] = fp
+
+    serve(
+        collection_paths,
+        host=args.host,
+        port=args.port,
+        cache_bytes=args.cache_bytes
+    )
@@ -21,3 +21,1012 @@
   # Make sure the output files exist
   [[ -s test-experiment-collection.hdf5 ]]
 }
+
+@test "Evict the least recently used results from a bounded cache" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+from lib.result_cache import ResultCache
+
+# Each array takes 800 bytes, so the cache holds two of them
+cache = ResultCache(max_bytes=2000)
+a_key, b_key, c_key = [('gene_abundance', (name,), ()) for name in 'abc']
+cache.put(a_key, np.zeros(100))
+cache.put(b_key, np.ones(100))
+assert cache.get(a_key)[0]
+
+# Adding a third evicts b, which was used less recently than a
+cache.put(c_key, np.ones(100))
+assert cache.get(b_key) == (False, None)
+assert a_key in cache and c_key in cache
+assert cache.stats() == dict(
+    hits=1, misses=1, evictions=1, entries=2, current_bytes=1600, max_bytes=2000
+), cache.stats()
+
+# Values larger than the whole cache are not stored
+cache.put(b_key, np.zeros(1000))
+assert b_key not in cache and len(cache) == 2
+
+# Entries are removed for a single method, or all at once
+metadata_key = ('metadata', (), ())
+cache.put(metadata_key, 'metadata')
+cache.invalidate('gene_abundance')
+assert list(cache.entries) == [metadata_key]
+cache.invalidate()
+assert len(cache) == 0 and cache.stats()['current_bytes'] == 0
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "export-abundance-matrix.py in the PATH" {
+  v="$(export-abundance-matrix.py -h 2>&1 || true )"
+  [[ "$v" =~ "Export a dense gene or CAG" ]]
+}
+
+@test "serve-experiment-collection.py in the PATH" {
+  v="$(serve-experiment-collection.py -h 2>&1 || true )"
+  [[ "$v" =~ "Keep experiment collections loaded" ]]
+}
+
+@test "Import the reader without the builder, S3 or plotting libraries" {
+  run python3 -c "
+import sys, time
+sys.path.insert(0, '/usr/local/bin')
+start = time.time()
+import lib.experiment_collection
+elapsed = time.time() - start
+print('Imported lib.experiment_collection in {:.3f}s'.format(elapsed))
+assert not {'boto3', 'scipy', 'matplotlib', 'seaborn', 'lib.helpers'} & set(sys.modules), sys.modules.keys()
+# Loading pandas and PyTables takes ~0.6s, well within this budget
+assert elapsed < 5, elapsed
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Import the builder helpers without boto3" {
+  run python3 -c "
+import sys, time
+sys.path.insert(0, '/usr/local/bin')
+start = time.time()
+import lib.helpers
+elapsed = time.time() - start
+print('Imported lib.helpers in {:.3f}s'.format(elapsed))
+assert 'boto3' not in sys.modules
+assert elapsed < 5, elapsed
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Load the builder without pandas, PyTables or any stage" {
+  run python3 -c "
+import importlib.util, sys, time
+sys.path.insert(0, '/usr/local/bin')
+start = time.time()
+spec = importlib.util.spec_from_file_location('builder', '/usr/local/bin/make-experiment-collection.py')
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+elapsed = time.time() - start
+print('Loaded make-experiment-collection.py in {:.3f}s'.format(elapsed))
+assert not {'pandas', 'tables', 'boto3', 'lib.helpers', 'lib.preflight', 'lib.synteny'} & set(sys.modules), sys.modules.keys()
+# Only the standard library is loaded, in ~0.1s
+assert elapsed < 1, elapsed
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Estimate the resources for a build with --dry-run" {
+  v="$(make-experiment-collection.py \
+    --output-hdf5 dry-run.hdf5 \
+    --output-logs dry-run.log \
+    --abundance-sample-sheet /usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json \
+    --metadata-table /usr/local/tests/data/metadata.csv \
+    --taxonomic-classification-tsv /usr/local/tests/data/small_demonstration_experiment_2018.nr.tax.20180717.diamond.tax.gz \
+    --cags-json /usr/local/tests/data/small_demonstration_experiment_2018_2_samples_clr_0.05.cags.json.gz \
+    --temp-folder /scratch \
+    --dry-run 2>&1)"
+  echo "$v"
+  [[ "$v" =~ "Expected peak memory" ]]
+
+  # The full build of these inputs peaked at 385MB and wrote 12.9MB, so
+  # each estimate should be within a factor of 2 of that
+  echo "$v" | python3 -c "
+import re, sys
+log = sys.stdin.read()
+units = {'B': 1, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12}
+def parse(label):
+    value, unit = re.search(label + r': ([0-9.]+)([A-Z]+)', log).groups()
+    return float(value) * units[unit]
+peak_memory = parse('Expected peak memory')
+output_size = parse('Expected output size')
+assert 192e6 <= peak_memory <= 770e6, peak_memory
+assert 6.4e6 <= output_size <= 25.8e6, output_size
+"
+
+  # Nothing is written in a dry run
+  [[ ! -e dry-run.hdf5 ]]
+
+  # The NCBI taxonomy is loaded by the worker reading the taxonomic
+  # classification, which then needs more memory
+  mkdir -p /scratch/dry-run-test
+  python3 -c "
+with open('/scratch/dry-run-test/names.dmp', 'w') as names, open('/scratch/dry-run-test/nodes.dmp', 'w') as nodes:
+    for taxid in range(1, 10001):
+        names.write('{}\t|\tTaxon {}\t|\t\t|\tscientific name\t|\n'.format(taxid, taxid))
+        nodes.write('{}\t|\t{}\t|\tno rank\t|\n'.format(taxid, max(1, taxid // 2)))
+"
+  v_ncbi="$(make-experiment-collection.py \
+    --output-hdf5 dry-run.hdf5 \
+    --output-logs dry-run.log \
+    --taxonomic-classification-tsv /usr/local/tests/data/small_demonstration_experiment_2018.nr.tax.20180717.diamond.tax.gz \
+    --ncbi-names-dmp /scratch/dry-run-test/names.dmp \
+    --ncbi-nodes-dmp /scratch/dry-run-test/nodes.dmp \
+    --temp-folder /scratch \
+    --dry-run 2>&1)"
+  echo "$v_ncbi"
+  printf "%s\n===\n%s" "$v" "$v_ncbi" | python3 -c "
+import re, sys
+without_ncbi, with_ncbi = sys.stdin.read().split('===')
+units = {'B': 1, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12}
+def parse(log):
+    value, unit = re.search(r'taxonomic_classification: [0-9,]+ rows, memory ([0-9.]+)([A-Z]+)', log).groups()
+    return float(value) * units[unit]
+assert parse(with_ncbi) > parse(without_ncbi), (parse(with_ncbi), parse(without_ncbi))
+"
+}
+
+@test "Build the test collection in batches, reading samples ahead" {
+  rm -rf /scratch/reader-test
+  mkdir -p /scratch/reader-test
+
+  # Add a numeric field to the metadata, to test associations
+  python3 -c "
+import pandas as pd
+metadata = pd.read_csv('/usr/local/tests/data/metadata.csv')
+metadata['depth'] = [1., 2., 5., 3.]
+metadata.to_csv('/scratch/reader-test/metadata.csv', index=False)
+"
+
+  make-experiment-collection.py \
+    --output-hdf5 /scratch/reader-test/collection.hdf5 \
+    --output-logs /scratch/reader-test/collection.log \
+    --abundance-sample-sheet /usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json \
+    --metadata-table /scratch/reader-test/metadata.csv \
+    --metadata-field-sep "," \
+    --taxonomic-classification-tsv /usr/local/tests/data/small_demonstration_experiment_2018.nr.tax.20180717.diamond.tax.gz \
+    --cags-json /usr/local/tests/data/small_demonstration_experiment_2018_2_samples_clr_0.05.cags.json.gz \
+    --normalizations clr,rel_abund,per_kb \
+    --write-batch-rows 100000 \
+    --prefetch-depth 2 \
+    --temp-folder /scratch
+
+  [[ -s /scratch/reader-test/collection.hdf5 ]]
+
+  # The samples were parsed ahead of time, and written in more than one batch
+  grep -q "Parsed abundance files take" /scratch/reader-test/collection.log
+  [ "$(grep -c "samples to abundance" /scratch/reader-test/collection.log)" -gt 1 ]
+
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import pandas as pd
+from lib.experiment_collection import ExperimentCollection
+from lib.helpers import read_json
+
+sample_sheet = read_json('/usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json')
+
+with pd.HDFStore('/scratch/reader-test/collection.hdf5', mode='r') as store:
+    abund = store['abundance']
+    cag_abund = store['cag_abundance']
+
+# Every gene in every sample is written exactly once
+n_genes = abund.groupby('sample').size()
+for sample_name, fp in sample_sheet.items():
+    assert n_genes[sample_name.replace('.', '_')] == len(read_json(fp)['results']), sample_name
+assert not abund.duplicated(subset=['sample', 'id']).any()
+
+# Genes are ranked within each sample, starting from the most abundant
+for sample_name, sample_df in abund.groupby('sample'):
+    sample_df = sample_df.sort_values(by='rank')
+    assert sample_df['rank'].tolist() == list(range(1, sample_df.shape[0] + 1))
+    assert sample_df['depth'].is_monotonic_decreasing
+
+assert set(cag_abund['sample']) == set(n_genes.index)
+
+# The samples are listed for the reader
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+assert sorted(exp.all_samples) == sorted(n_genes.index)
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Read a table in chunks" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import pandas as pd
+from lib.experiment_collection import ExperimentCollection
+
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+with pd.HDFStore('/scratch/reader-test/collection.hdf5', mode='r') as store:
+    full = store['cag_abundance']
+n_rows = full.shape[0]
+
+# Every row is read once, in chunks of the requested size
+for chunksize in [1000, n_rows - 1, n_rows, n_rows + 1]:
+    chunks = list(exp.iter_table('cag_abundance', chunksize=chunksize))
+    assert [chunk.shape[0] for chunk in chunks] == [
+        min(chunksize, n_rows - start) for start in range(0, n_rows, chunksize)
+    ], chunksize
+    assert pd.concat(chunks).equals(full), chunksize
+
+# Only the requested columns and rows are read
+sample_id = exp.all_samples[0]
+chunks = list(exp.iter_table(
+    'cag_abundance',
+    columns=['cag_id', 'depth'],
+    where='sample == \'{}\''.format(sample_id),
+    chunksize=100
+))
+assert all(list(chunk.columns) == ['cag_id', 'depth'] for chunk in chunks)
+assert pd.concat(chunks)['depth'].equals(full.loc[full['sample'] == sample_id, 'depth'])
+
+# Results are combined across chunks, or returned for each one
+counts = exp.map_chunks(
+    lambda chunk: chunk.groupby('sample').size(),
+    'cag_abundance',
+    reduce_fn=lambda a, b: a.add(b, fill_value=0),
+    columns=['sample'],
+    chunksize=777
+)
+assert (counts.sort_index() == full.groupby('sample').size().sort_index()).all()
+assert exp.map_chunks(len, 'cag_abundance', chunksize=777) == [
+    min(777, n_rows - start) for start in range(0, n_rows, 777)
+]
+
+# The abundance of genes is read one sample at a time
+gene_chunks = list(exp.iter_gene_abundance(samples=[sample_id], chunksize=1000))
+assert len(gene_chunks) > 1
+genes = pd.concat(gene_chunks)
+assert (genes['sample'] == sample_id).all()
+assert genes.set_index('id')['depth'].sort_index().equals(
+    exp.sample_gene_abundance(sample_id).sort_index()
+)
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Read abundances with pushdown, top_k and threshold" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+from lib.experiment_collection import ExperimentCollection
+
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5', max_pushdown_values=100)
+assert len(exp.all_samples) == 4, exp.all_samples
+
+dense = exp.gene_abundance()
+assert dense.shape[1] == 4 and dense.shape[0] > 0, dense.shape
+
+# Reading samples in parallel gives the same table
+parallel = ExperimentCollection('/scratch/reader-test/collection.hdf5', read_workers=2).gene_abundance()
+assert parallel.index.equals(dense.index) and list(parallel.columns) == list(dense.columns)
+assert np.allclose(parallel.values, dense.values, equal_nan=True)
+
+# Each sample read for the table is kept in the cache, however the metric is spelled
+hits = exp.cache_stats()['hits']
+exp.sample_gene_abundance(exp.all_samples[0], metric='depth')
+assert exp.cache_stats()['hits'] == hits + 1
+
+for sample_id in exp.all_samples:
+    full = exp.sample_gene_abundance(sample_id)
+    assert full.shape[0] > 0
+
+    # A short list of genes is pushed down to the query, and a long one is not
+    for n_genes in [10, 1000]:
+        genes = full.index.values[:n_genes].tolist()
+        subset = exp.sample_gene_abundance(sample_id, genes=genes)
+        assert np.allclose(subset.loc[genes].values, full.loc[genes].values)
+
+# The top genes are the most abundant ones in each sample
+top = exp.top_k(5, level='gene')
+assert top.shape[0] == 5 * len(exp.all_samples), top.shape
+for sample_id, sample_top in top.groupby('sample'):
+    assert sample_top['rank'].tolist() == [1, 2, 3, 4, 5]
+    assert np.allclose(
+        sample_top['depth'].values,
+        dense[sample_id].dropna().sort_values(ascending=False).values[:5]
+    )
+
+# The number of samples in which each gene passes the threshold
+counts = exp.threshold(10., min_samples=2)
+expected = (dense > 10.).sum(axis=1)
+expected = expected.loc[expected >= 2]
+assert counts.shape[0] > 0
+assert counts.sort_index().equals(expected.sort_index().rename('n_samples'))
+
+# Every stored normalization can be filtered on, for genes and CAGs
+for level, metric in [
+    ('gene', 'clr'), ('gene', 'rel_abund'), ('gene', 'depth_per_kb'),
+    ('cag', 'depth'), ('cag', 'clr'), ('cag', 'rel_abund'),
+]:
+    if level == 'gene':
+        values = exp.gene_abundance(metric=metric)
+    else:
+        values = exp.cag_abundance(metric=metric)
+    cutoff = np.nanmedian(values.values)
+    counts = exp.threshold(cutoff, metric=metric, min_samples=2, level=level)
+    expected = (values > cutoff).sum(axis=1)
+    expected = expected.loc[expected >= 2]
+    assert counts.shape[0] > 0, (level, metric)
+    assert (counts.sort_index() == expected.sort_index()).all(), (level, metric)
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Read the summary statistics and the CAG index" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+import pandas as pd
+from lib.experiment_collection import ExperimentCollection
+
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+
+# The running summary matches the summary of the full table
+for summary, dense in [
+    (exp.gene_summary(), exp.gene_abundance()),
+    (exp.cag_summary(), exp.cag_abundance()),
+]:
+    assert summary.shape[0] == dense.shape[0] > 0
+    summary = summary.reindex(index=dense.index)
+    assert (summary['n_detected'].values == dense.notnull().sum(axis=1).values).all()
+    assert np.allclose(summary['depth_mean'].values, dense.mean(axis=1).values)
+    assert np.allclose(summary['depth_var'].values, dense.var(axis=1).fillna(0).values)
+    assert np.allclose(summary['depth_max'].values, dense.max(axis=1).values)
+
+# Filters on the summary keep the genes which pass
+prevalent = exp.filter_genes(min_prevalence=1)
+assert sorted(prevalent) == sorted(exp.gene_summary().query('prevalence >= 1').index)
+assert exp.gene_abundance(min_prevalence=1).shape[0] == len(prevalent)
+
+# The CAG index holds the same genes as the table of CAGs
+with pd.HDFStore('/scratch/reader-test/collection.hdf5', mode='r') as store:
+    cags = store['cags']
+membership = exp.cag_membership()
+assert len(membership) == cags['cag'].nunique() > 0
+for cag_id, cag_df in cags.groupby('cag'):
+    assert sorted(membership[cag_id]) == sorted(cag_df['gene'].tolist()), cag_id
+
+cag_id = cags['cag'].values[0]
+genes = exp.genes_in_cag(cag_id)
+assert len(genes) > 0
+assert all(exp.cag_of_gene(gene_id) == cag_id for gene_id in genes)
+assert exp.cag_of_gene('not_a_gene') is None
+
+cags_of_genes = exp.cags_of_genes(genes + ['not_a_gene'])
+assert (cags_of_genes.values[:-1] == cag_id).all()
+assert pd.isnull(cags_of_genes.values[-1])
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Export an abundance matrix and open it again" {
+  rm -f /scratch/reader-test/cag_clr.*
+  export-abundance-matrix.py \
+    --collection-hdf5 /scratch/reader-test/collection.hdf5 \
+    --output-prefix /scratch/reader-test/cag_clr \
+    --level cag \
+    --metric clr
+
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+from lib.experiment_collection import ExperimentCollection
+from lib.experiment_collection import open_abundance_matrix
+
+matrix, rows, columns = open_abundance_matrix('/scratch/reader-test/cag_clr')
+assert matrix.dtype == np.float32
+assert not matrix.flags.writeable
+
+# Every CAG and sample, with NaN where a CAG was not detected
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+dense = exp.cag_abundance(metric='clr')
+assert columns == exp.all_samples
+assert set(dense.index.astype(str)) <= set(rows)
+dense.index = dense.index.astype(str)
+expected = dense.reindex(index=rows, columns=columns).values.astype(np.float32)
+assert np.allclose(matrix, expected, equal_nan=True)
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Store each normalization of the abundances" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+import pandas as pd
+from lib.helpers import read_json
+
+sample_sheet = read_json('/usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json')
+cags = read_json('/usr/local/tests/data/small_demonstration_experiment_2018_2_samples_clr_0.05.cags.json.gz')
+
+for sample_name, fp in sample_sheet.items():
+    sample_name = sample_name.replace('.', '_')
+    raw = pd.DataFrame(read_json(fp)['results']).set_index('id')
+    depth = raw['depth'].astype(float)
+
+    with pd.HDFStore('/scratch/reader-test/collection.hdf5', mode='r') as store:
+        stored = store.select('abundance', where='sample == \'{}\''.format(sample_name)).set_index('id')
+        stored_cags = store.select('cag_abundance', where='sample == \'{}\''.format(sample_name)).set_index('cag_id')
+    stored = stored.reindex(index=depth.index)
+
+    # The CLR is in log10, centered on the geometric mean of the sample
+    log_gmean = np.log10(depth).mean()
+    assert np.allclose(stored['clr'], np.log10(depth) - log_gmean)
+    assert np.allclose(stored['rel_abund'], depth / depth.sum())
+    assert np.allclose(stored['depth_per_kb'], depth / (raw['length'].astype(float) / 1000.))
+
+    # CAGs are normalized against the genes in the same sample
+    for cag_id in stored_cags.index.values[:10]:
+        cag_depth = np.mean([depth.get(gene_id, 0) for gene_id in cags[cag_id]])
+        assert np.isclose(stored_cags.loc[cag_id, 'depth'], cag_depth)
+        assert np.isclose(stored_cags.loc[cag_id, 'clr'], np.log10(cag_depth) - log_gmean)
+        assert np.isclose(stored_cags.loc[cag_id, 'rel_abund'], cag_depth / depth.sum())
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Link an integrated assembly instead of copying it" {
+  rm -rf /scratch/link-test
+  mkdir -p /scratch/link-test
+
+  python3 -c "
+import pandas as pd
+gene_positions = pd.DataFrame([
+    dict(seqname=seqname, cluster=cluster, start=str(start), end=str(start + 200))
+    for seqname in ['c1', 'c2']
+    for start, cluster in [(100, 'a'), (400, 'b'), (700, 'c')]
+])
+gene_positions.to_hdf('/scratch/link-test/assembly.hdf5', 'gene_positions', format='table', data_columns=['seqname', 'cluster'])
+"
+
+  make-experiment-collection.py \
+    --output-hdf5 /scratch/link-test/collection.hdf5 \
+    --output-logs /scratch/link-test/collection.log \
+    --integrated-assembly /scratch/link-test/assembly.hdf5 \
+    --link-integrated-assembly \
+    --temp-folder /scratch
+
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import tables
+from lib.experiment_collection import ExperimentCollection
+
+# The table stays in the assembly, and is read through the link
+with tables.open_file('/scratch/link-test/collection.hdf5', mode='r') as h5:
+    link = h5.get_node('/gene_positions')
+    assert isinstance(link, tables.link.ExternalLink), link
+    assert link.target == '/scratch/link-test/assembly.hdf5:/gene_positions', link.target
+
+exp = ExperimentCollection('/scratch/link-test/collection.hdf5')
+assert exp.contig_df('c2')['cluster'].tolist() == ['a', 'b', 'c']
+assert sorted(exp.contigs_with_gene('b')) == ['c1', 'c2']
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+
+  # A link could not be followed from a collection uploaded elsewhere
+  run make-experiment-collection.py \
+    --output-hdf5 s3://bucket/collection.hdf5 \
+    --output-logs /scratch/link-test/s3.log \
+    --integrated-assembly /scratch/link-test/assembly.hdf5 \
+    --link-integrated-assembly \
+    --temp-folder /scratch
+  [ "$status" -ne 0 ]
+}
+
+@test "Answer queries from a running service" {
+  serve-experiment-collection.py \
+    --collection test=/scratch/reader-test/collection.hdf5 \
+    --port 8799 &
+  server_pid=$!
+
+  run python3 -c "
+import os, sys, time
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+from urllib.error import HTTPError
+from urllib.error import URLError
+from lib.experiment_collection import ExperimentCollection
+from lib.query_service import ExperimentCollectionClient
+
+client = ExperimentCollectionClient('test', url='http://127.0.0.1:8799')
+
+# Wait for the collection to be loaded
+for _ in range(100):
+    try:
+        samples = client.all_samples
+        break
+    except URLError:
+        time.sleep(0.2)
+
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+assert samples == exp.all_samples
+
+# Results come back as they would from the collection itself
+served = client.gene_abundance(samples=samples[:2])
+local = exp.gene_abundance(samples=samples[:2])
+assert served.index.equals(local.index) and list(served.columns) == list(local.columns)
+assert np.allclose(served.values, local.values, equal_nan=True)
+
+# Methods which would write to the server are not available
+try:
+    client._query('export_abundance_matrix', '/scratch/reader-test/served')
+    raise AssertionError('export_abundance_matrix was served')
+except HTTPError as e:
+    assert e.code == 400
+assert not os.path.exists('/scratch/reader-test/served.npy')
+
+# Associations are returned, but cannot be written on the server
+results = client.associate('depth', sample_col='Sample', level='cag')
+assert results.shape[0] > 0
+try:
+    client.associate('depth', sample_col='Sample', level='cag', results_fp='/scratch/reader-test/served.hdf5')
+    raise AssertionError('results_fp was accepted')
+except HTTPError as e:
+    assert e.code == 400
+assert not os.path.exists('/scratch/reader-test/served.hdf5')
+"
+  kill $server_pid
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Query several collections together" {
+  rm -rf /scratch/collection-set-test
+  mkdir -p /scratch/collection-set-test
+
+  # A second collection with two of the four samples
+  python3 -c "
+import json
+sample_sheet = json.load(open('/usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json'))
+sample_sheet = dict(sorted(sample_sheet.items())[:2])
+json.dump(sample_sheet, open('/scratch/collection-set-test/sample_sheet.json', 'w'))
+"
+  make-experiment-collection.py \
+    --output-hdf5 /scratch/collection-set-test/two_samples.hdf5 \
+    --output-logs /scratch/collection-set-test/two_samples.log \
+    --abundance-sample-sheet /scratch/collection-set-test/sample_sheet.json \
+    --temp-folder /scratch
+
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+from lib.collection_set import CollectionSet
+from lib.experiment_collection import ExperimentCollection
+
+collections = CollectionSet([
+    '/scratch/reader-test/collection.hdf5',
+    '/scratch/collection-set-test/two_samples.hdf5',
+], workers=2)
+assert list(collections.exp_col_fps) == ['collection', 'two_samples']
+
+# The genes of every collection are aligned in a single table
+merged = collections.gene_abundance()
+all_genes = set()
+for collection_name, fp in collections.exp_col_fps.items():
+    own = ExperimentCollection(fp).gene_abundance()
+    all_genes.update(own.index)
+
+    part = merged[collection_name]
+    assert sorted(part.columns) == sorted(own.columns)
+    assert np.allclose(
+        part.reindex(index=own.index, columns=own.columns).values,
+        own.values,
+        equal_nan=True
+    )
+
+    # Genes which are only in the other collection are missing here
+    assert part.loc[~merged.index.isin(own.index)].isnull().all().all()
+
+assert set(merged.index) == all_genes
+assert merged.shape[1] == 6
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Select the genes below a taxon" {
+  rm -rf /scratch/taxonomy-test
+  mkdir -p /scratch/taxonomy-test
+
+  # A taxonomy over every taxid in the classification, in which many of
+  # those taxids are also the parents of others
+  python3 -c "
+import json, random
+import pandas as pd
+random.seed(0)
+classification = pd.read_table(
+    '/usr/local/tests/data/small_demonstration_experiment_2018.nr.tax.20180717.diamond.tax.gz',
+    header=None, names=['gene', 'taxid', 'evalue']
+)
+taxids = sorted(set(classification['taxid'].apply(str)) - {'0', '1'})
+random.shuffle(taxids)
+parents = {'1': '1'}
+for ix, taxid in enumerate(taxids):
+    parents[taxid] = random.choice(['1'] + taxids[max(0, ix - 50):ix])
+with open('/scratch/taxonomy-test/names.dmp', 'w') as names, open('/scratch/taxonomy-test/nodes.dmp', 'w') as nodes:
+    for taxid, parent in parents.items():
+        names.write('{}\\t|\\tTaxon {}\\t|\\t\\t|\\tscientific name\\t|\\n'.format(taxid, taxid))
+        nodes.write('{}\\t|\\t{}\\t|\\tno rank\\t|\\n'.format(taxid, parent))
+json.dump(parents, open('/scratch/taxonomy-test/parents.json', 'w'))
+"
+
+  make-experiment-collection.py \
+    --output-hdf5 /scratch/taxonomy-test/collection.hdf5 \
+    --output-logs /scratch/taxonomy-test/collection.log \
+    --taxonomic-classification-tsv /usr/local/tests/data/small_demonstration_experiment_2018.nr.tax.20180717.diamond.tax.gz \
+    --ncbi-names-dmp /scratch/taxonomy-test/names.dmp \
+    --ncbi-nodes-dmp /scratch/taxonomy-test/nodes.dmp \
+    --temp-folder /scratch
+
+  run python3 -c "
+import json, sys
+sys.path.insert(0, '/usr/local/bin')
+from lib.experiment_collection import ExperimentCollection
+
+parents = json.load(open('/scratch/taxonomy-test/parents.json'))
+
+def ancestors(taxid):
+    visited = [taxid]
+    while taxid != '1':
+        taxid = parents[taxid]
+        visited.append(taxid)
+    return visited
+
+exp = ExperimentCollection('/scratch/taxonomy-test/collection.hdf5')
+annotations = exp.taxonomic_annotation()['taxid'].apply(str)
+lineages = {taxid: set(ancestors(taxid)) for taxid in annotations.unique()}
+
+# Groups with deep subtrees, and leaves with a single taxid
+n_children = {}
+for taxid, parent in parents.items():
+    n_children[parent] = n_children.get(parent, 0) + 1
+groups = sorted(n_children, key=lambda taxid: -n_children[taxid])[:5]
+groups += [taxid for taxid in parents if taxid not in n_children][:5]
+
+for group in groups:
+    expected = set(annotations.index[annotations.apply(lambda taxid: group in lineages[taxid])])
+    assert set(exp.genes_below_taxon(int(group)).index) == expected, group
+
+# Taxids with no assignments below them have no genes
+assert exp.genes_below_taxon(999999999).shape[0] == 0
+
+# Collections built without the NCBI taxonomy cannot be queried this way
+try:
+    ExperimentCollection('/scratch/reader-test/collection.hdf5').genes_below_taxon(1)
+    raise ValueError('genes_below_taxon did not fail')
+except AssertionError as e:
+    assert 'taxonomy intervals' in str(e), e
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Reuse saved results across sessions and worker counts" {
+  rm -rf /scratch/reader-test/sidecar
+  run python3 -c "
+import glob, pickle, sys
+sys.path.insert(0, '/usr/local/bin')
+from lib.experiment_collection import ExperimentCollection
+from lib.result_cache import cache_key
+from lib.result_cache import SidecarCache
+
+fp = '/scratch/reader-test/collection.hdf5'
+folder = '/scratch/reader-test/sidecar'
+first = ExperimentCollection(fp, sidecar_cache=folder).cag_abundance(workers=1)
+saved = glob.glob(folder + '/*/cag_abundance.*.pkl')
+assert len(saved) == 1, saved
+
+# The number of workers does not change the result, and so shares the entry
+second = ExperimentCollection(fp, sidecar_cache=folder).cag_abundance(workers=2)
+assert second.equals(first)
+assert glob.glob(folder + '/*/cag_abundance.*.pkl') == saved
+
+# The saved entry is read, rather than the collection
+with open(saved[0], 'wb') as handle:
+    pickle.dump('saved', handle)
+assert ExperimentCollection(fp, sidecar_cache=folder).cag_abundance(workers=3) == 'saved'
+
+# Results are kept until a file linked from the collection changes
+link_fp = '/scratch/link-test/collection.hdf5'
+key = cache_key('contig_df', 'c1')
+SidecarCache(link_fp).put(key, 'saved')
+assert SidecarCache(link_fp).get(key) == (True, 'saved')
+
+import pandas as pd
+with pd.HDFStore('/scratch/link-test/assembly.hdf5', mode='a') as store:
+    store.append('gene_positions', store['gene_positions'].head(1))
+assert SidecarCache(link_fp).get(key) == (False, None)
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Declare the type of each column" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+import pandas as pd
+from lib.helpers import apply_schema
+from lib.helpers import TABLE_SCHEMAS
+
+# Without a schema, numbers are parsed and repeated strings become categories
+inferred = apply_schema(pd.DataFrame({
+    'count': ['1', '2', '3', '4'],
+    'value': ['1.5', None, '2', '3'],
+    'group': ['a', 'a', 'b', 'a'],
+    'name': ['w', 'x', 'y', 'z'],
+}))
+assert inferred['count'].dtype == np.int64
+assert inferred['value'].dtype == np.float64 and inferred['value'].isnull().sum() == 1
+assert inferred['group'].dtype.name == 'category'
+assert inferred['name'].tolist() == ['w', 'x', 'y', 'z']
+
+# With a schema, each column is converted, and anything else is left alone
+declared = apply_schema(
+    pd.DataFrame({'gene': [1, 2], 'taxid': ['5', '6'], 'evalue': ['0.1', 'x'], 'other': [1, 2]}),
+    TABLE_SCHEMAS['taxonomic_classification']
+)
+assert declared['gene'].tolist() == ['1', '2']
+assert declared['taxid'].dtype == np.int64
+assert declared['evalue'].dtype == np.float64 and np.isnan(declared['evalue'].values[1])
+assert declared['other'].dtype == np.int64
+
+# The types are kept in the collection
+with pd.HDFStore('/scratch/reader-test/collection.hdf5', mode='r') as store:
+    taxonomy = store['taxonomic_classification']
+    metadata = store['metadata']
+assert taxonomy['taxid'].dtype == np.int64
+assert metadata['depth'].dtype == np.float64
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Compare samples with sketches, distances and associations" {
+  run python3 -c "
+import os, sys
+sys.path.insert(0, '/usr/local/bin')
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist
+from scipy.stats import linregress
+from lib.experiment_collection import ExperimentCollection
+
+exp = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+dense = exp.gene_abundance()
+
+# The sketches estimate the overlap of the genes detected in each sample
+jaccard = exp.sketch_similarity()['jaccard']
+assert sorted(jaccard.index) == sorted(exp.all_samples)
+assert np.allclose(np.diag(jaccard.values), 1)
+assert np.allclose(jaccard.values, jaccard.values.T)
+detected = dense.notnull()
+for a in exp.all_samples:
+    for b in exp.all_samples:
+        exact = (detected[a] & detected[b]).sum() / (detected[a] | detected[b]).sum()
+        assert abs(jaccard.loc[a, b] - exact) < 0.2, (a, b, jaccard.loc[a, b], exact)
+
+# Distances match those computed from the dense matrix
+for level, dense in [('gene', dense), ('cag', exp.cag_abundance())]:
+    x = dense.reindex(columns=exp.all_samples).fillna(0).T.values
+    log_x = np.log(x + 1)
+    log_x = log_x - log_x.mean(axis=1, keepdims=True)
+    for metric, expected in [('braycurtis', pdist(x, 'braycurtis')), ('aitchison', pdist(log_x))]:
+        distances = exp.distance_matrix(metric=metric, level=level, block_bytes='100KB')
+        assert np.allclose(distances, expected), (level, metric)
+
+# Associations match a regression of each CAG on the metadata
+results_fp = '/scratch/reader-test/associations.hdf5'
+if os.path.exists(results_fp):
+    os.remove(results_fp)
+results = exp.associate('depth', sample_col='Sample', level='cag', results_fp=results_fp)
+assert results.shape[0] > 0
+
+depth = exp.metadata().set_index('Sample')['depth']
+clr = exp.cag_abundance(metric='clr')
+for cag_id in results.index.values[:10]:
+    y = clr.loc[cag_id].fillna(clr.loc[cag_id].min())
+    x = depth.reindex([sample_id.replace('_', '.') for sample_id in y.index]).values
+    assert np.isclose(linregress(x, y.values).slope, results.loc[cag_id, 'estimate']), cag_id
+
+# The results are saved in their own file, and not in the collection
+with pd.HDFStore(results_fp, mode='r') as store:
+    assert len(store.keys()) == 1
+with pd.HDFStore('/scratch/reader-test/collection.hdf5', mode='r') as store:
+    assert not any(k.startswith('/associations') for k in store.keys())
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Add the synteny of contigs from an integrated assembly" {
+  rm -rf /scratch/synteny-test
+  mkdir -p /scratch/synteny-test
+
+  # Contig c2 is c1 shifted by 1000bp, c3 is c1 reversed, and c4 shares nothing
+  python3 -c "
+import pandas as pd
+rows = []
+for ix, cluster in enumerate(['a', 'b', 'c', 'd']):
+    start = 100 + ix * 300
+    rows.append(dict(seqname='c1', cluster=cluster, start=start, end=start + 200))
+    rows.append(dict(seqname='c2', cluster=cluster, start=start + 1000, end=start + 1200))
+    rows.append(dict(seqname='c3', cluster=cluster, start=4800 - start, end=5000 - start))
+rows.append(dict(seqname='c4', cluster='z', start=1, end=100))
+gene_positions = pd.DataFrame(rows)
+for k in ['start', 'end']:
+    gene_positions[k] = gene_positions[k].apply(str)
+gene_positions.to_hdf('/scratch/synteny-test/assembly.hdf5', 'gene_positions', format='table', data_columns=['seqname', 'cluster'])
+"
+
+  make-experiment-collection.py \
+    --output-hdf5 /scratch/synteny-test/collection.hdf5 \
+    --output-logs /scratch/synteny-test/collection.log \
+    --integrated-assembly /scratch/synteny-test/assembly.hdf5 \
+    --temp-folder /scratch
+
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+from lib.experiment_collection import ExperimentCollection
+
+exp = ExperimentCollection('/scratch/synteny-test/collection.hdf5')
+synteny = exp.contig_synteny('c1').set_index('other_contig')
+assert sorted(synteny.index) == ['c2', 'c3'], synteny
+
+assert synteny.loc['c2', 'shared_prop'] == 1
+assert not synteny.loc['c2', 'reverse']
+assert synteny.loc['c2', 'offset'] == 1000
+assert synteny.loc['c3', 'reverse']
+
+assert exp.contig_synteny('c4').shape[0] == 0
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+
+  # The table is left out with --skip-contig-synteny
+  make-experiment-collection.py \
+    --output-hdf5 /scratch/synteny-test/skipped.hdf5 \
+    --output-logs /scratch/synteny-test/skipped.log \
+    --integrated-assembly /scratch/synteny-test/assembly.hdf5 \
+    --skip-contig-synteny \
+    --temp-folder /scratch
+  python3 -c "
+import pandas as pd
+with pd.HDFStore('/scratch/synteny-test/skipped.hdf5', mode='r') as store:
+    assert '/contig_synteny' not in store.keys()
+"
+
+  # The dry run counts the contigs compared on each cluster, within the
+  # same limits as the build
+  dry_run() {
+    make-experiment-collection.py \
+      --output-hdf5 /scratch/synteny-test/dry-run.hdf5 \
+      --output-logs /scratch/synteny-test/dry-run.log \
+      --integrated-assembly /scratch/synteny-test/assembly.hdf5 \
+      --temp-folder /scratch \
+      --dry-run "$@" 2>&1
+  }
+  v="$(dry_run)"
+  echo "$v"
+  [[ "$v" =~ "contig_synteny: 14 rows" ]]
+  v="$(dry_run --synteny-max-cluster-contigs 2)"
+  echo "$v"
+  [[ "$v" =~ "contig_synteny: 0 rows" ]]
+  v="$(dry_run --skip-contig-synteny)"
+  echo "$v"
+  [[ ! "$v" =~ "contig_synteny" ]]
+}
+
+@test "Resume an interrupted build from its work folder" {
+  rm -rf /scratch/resume-test
+  mkdir -p /scratch/resume-test
+
+  # The last sample cannot be read on the first attempt
+  python3 -c "
+import json
+sample_sheet = json.load(open('/usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json'))
+json.dump(sample_sheet, open('/scratch/resume-test/sample_sheet.json', 'w'))
+sample_sheet['SRR628279.5M'] = '/scratch/resume-test/missing.json.gz'
+json.dump(sample_sheet, open('/scratch/resume-test/broken_sample_sheet.json', 'w'))
+"
+
+  run make-experiment-collection.py \
+    --output-hdf5 /scratch/resume-test/collection.hdf5 \
+    --output-logs /scratch/resume-test/collection.log \
+    --abundance-sample-sheet /scratch/resume-test/broken_sample_sheet.json \
+    --cags-json /usr/local/tests/data/small_demonstration_experiment_2018_2_samples_clr_0.05.cags.json.gz \
+    --write-batch-rows 1 \
+    --work-folder /scratch/resume-test/work \
+    --temp-folder /scratch
+  [ "$status" -ne 0 ]
+  [[ -s /scratch/resume-test/work/checkpoint.json ]]
+  [[ ! -e /scratch/resume-test/collection.hdf5 ]]
+
+  run make-experiment-collection.py \
+    --output-hdf5 /scratch/resume-test/collection.hdf5 \
+    --output-logs /scratch/resume-test/collection.log \
+    --abundance-sample-sheet /scratch/resume-test/sample_sheet.json \
+    --cags-json /usr/local/tests/data/small_demonstration_experiment_2018_2_samples_clr_0.05.cags.json.gz \
+    --write-batch-rows 1 \
+    --work-folder /scratch/resume-test/work \
+    --temp-folder /scratch \
+    --resume
+  echo "$output"
+  [ "$status" -eq 0 ]
+  [[ "$output" =~ "CAGs were already added" ]]
+  [[ "$output" =~ "SRR514265_5M was already added" ]]
+
+  # The resumed collection matches one built in a single attempt
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+import pandas as pd
+from lib.experiment_collection import ExperimentCollection
+
+resumed = ExperimentCollection('/scratch/resume-test/collection.hdf5')
+single = ExperimentCollection('/scratch/reader-test/collection.hdf5')
+assert sorted(resumed.all_samples) == sorted(single.all_samples)
+
+with pd.HDFStore('/scratch/resume-test/collection.hdf5', mode='r') as store:
+    abund = store['abundance']
+assert not abund.duplicated(subset=['sample', 'id']).any()
+
+for summary_name in ['gene_summary', 'cag_summary']:
+    a = getattr(resumed, summary_name)().sort_index()
+    b = getattr(single, summary_name)().sort_index()
+    assert a.shape[0] == b.shape[0] > 0, summary_name
+    assert (a['n_detected'] == b['n_detected']).all(), summary_name
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}
+
+@test "Read samples ahead in order, within the memory limit" {
+  run python3 -c "
+import sys
+sys.path.insert(0, '/usr/local/bin')
+from lib.helpers import read_json
+from lib.helpers import SamplePrefetcher
+
+sample_sheet = read_json('/usr/local/tests/data/small_demonstration_experiment_2018.sample_sheet.Docker.json')
+sample_list = sorted(sample_sheet.items())
+
+for max_bytes in [2e9, 1]:
+    prefetched = list(SamplePrefetcher(sample_list, depth=2, max_bytes=max_bytes))
+    assert [(name, fp) for name, fp, _ in prefetched] == sample_list
+    for name, fp, dat in prefetched:
+        assert dat == read_json(fp), name
+"
+  echo "$output"
+  [ "$status" -eq 0 ]
+}